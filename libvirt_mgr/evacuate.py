@@ -0,0 +1,95 @@
+import argparse
+import logging
+from typing import List, Optional, Tuple
+
+from .migrate import build_tasks, run_tasks
+from .placement import DomainFootprint, HostCapacity, PlacementError, apply_moves, format_plan, plan_evacuation
+from .utils import Config, ConnectionPool, HostConfig
+from .utils.domains import DomainRecord, get_domain_resources, list_domains
+from .utils.lazy import libvirt
+from .utils.libvirt import get_list_flags
+from .utils.probe import HostStats, probe_hosts
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_UTILIZATION = 0.9
+
+
+def launch_evacuate(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    src_host: HostConfig = config.hosts.get(args.host)
+    if not src_host:
+        raise Exception(f'Host "{args.host}" not found in configuration')
+    group_name = args.group or src_host.group
+    if group_name not in config.groups:
+        raise Exception(f'Group "{group_name}" not found in configuration')
+    if getattr(args, 'parallel', 1) < 1:
+        raise Exception('Number of parallel migrations must be at least 1')
+    dst_hosts = [h for h in config.hosts.values() if h.group == group_name and h.name != src_host.name]
+    if not dst_hosts:
+        raise Exception(f'Group "{group_name}" has no other hosts to evacuate to')
+
+    if pool is None:
+        with ConnectionPool() as pool:
+            return _launch_evacuate(args, config, pool, src_host, dst_hosts)
+    return _launch_evacuate(args, config, pool, src_host, dst_hosts)
+
+
+def _launch_evacuate(
+    args: argparse.Namespace,
+    config: Config,
+    pool: ConnectionPool,
+    src_host: HostConfig,
+    dst_hosts: List[HostConfig],
+):
+    try:
+        src_conn = pool.get(src_host)
+    except libvirt.libvirtError:
+        logger.critical('Cannot connect to source hypervisor "%s"', src_host.name)
+        raise
+    states = getattr(args, 'state', None) or ['active']
+    dom_list = list_domains(src_conn, get_list_flags(states))
+    if not dom_list:
+        logger.info('Host "%s" has no %s domains to evacuate', src_host.name, ', '.join(states))
+        return
+    get_domain_resources(src_conn, dom_list)
+
+    host_stats = probe_hosts(dst_hosts + [src_host], pool)
+    capacities = [capacity_from_stats(s) for s in host_stats.values() if s.name != src_host.name]
+    if not capacities:
+        raise Exception('No destination hosts are reachable')
+    try:
+        moves = plan_evacuation_moves(src_host, dom_list, capacities, args.max_utilization)
+    except PlacementError as e:
+        logger.error('Cannot evacuate host "%s": %s', src_host.name, e)
+        raise SystemExit(1)
+
+    footprints = [(DomainFootprint(d.name, d.memory, d.vcpus), src_host.name, dst.name) for d, dst in moves]
+    if src_host.name in host_stats:
+        capacities.insert(0, capacity_from_stats(host_stats[src_host.name]))
+    plan = format_plan(footprints, capacities, apply_moves(capacities, footprints))
+    if args.dry_run:
+        print(plan)
+        return
+    logger.info('Evacuating host "%s"\n%s', src_host.name, plan)
+    tasks = build_tasks(config, pool, src_host, [(d, config.hosts[dst.name]) for d, dst in moves])
+    return run_tasks(args, config, tasks)
+
+
+def capacity_from_stats(stats: HostStats) -> HostCapacity:
+    return HostCapacity(stats.name, stats.memory_total, stats.memory_total - stats.memory_free, stats.cpus)
+
+
+def plan_evacuation_moves(
+    src_host: HostConfig,
+    domains: List[DomainRecord],
+    capacities: List[HostCapacity],
+    max_utilization: float = DEFAULT_MAX_UTILIZATION,
+) -> List[Tuple[DomainRecord, HostCapacity]]:
+    """Returns the destination for every domain on src_host, raises PlacementError if they do not all fit"""
+    footprints = [DomainFootprint(d.name, d.memory, d.vcpus) for d in domains]
+    placement = plan_evacuation(footprints, capacities, max_utilization)
+    by_name = {c.name: c for c in capacities}
+    moves = [(d, by_name[placement[d.name]]) for d in domains]
+    logger.debug('Evacuation plan for "%s": %s', src_host.name, placement)
+    return moves
@@ -0,0 +1,50 @@
+import argparse
+import datetime
+import logging
+from typing import List, Optional
+
+from .utils import Config, ConnectionPool
+from .utils.inventory import InventoryEntry, open_inventory, refresh_inventory
+from .utils.monitor import format_size, format_table
+
+
+logger = logging.getLogger(__name__)
+
+
+def launch_find(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    if args.max_age is not None and args.max_age < 0:
+        raise Exception('Maximum inventory age cannot be negative')
+
+    with open_inventory(getattr(args, 'inventory', None)) as inventory:
+        entries = [] if args.refresh or args.max_age is not None else inventory.find(args.pattern)
+        if not entries:
+            # Only connect to hosts if the inventory cannot answer
+            max_age = None if args.refresh else args.max_age
+            if pool is None:
+                with ConnectionPool() as pool:
+                    refresh_inventory(inventory, list(config.hosts.values()), pool, max_age=max_age)
+            else:
+                refresh_inventory(inventory, list(config.hosts.values()), pool, max_age=max_age)
+            entries = inventory.find(args.pattern)
+    if not entries:
+        logger.error('No domain matching "%s" found on any host', args.pattern)
+        raise SystemExit(1)
+    print(format_entries(entries))
+    return entries
+
+
+def format_entries(entries: List[InventoryEntry]) -> str:
+    """Returns a human readable table of inventory entries"""
+    header = ('NAME', 'HOST', 'STATE', 'MEMORY', 'VCPUS', 'UUID', 'UPDATED')
+    rows = [header]
+    for e in entries:
+        rows.append((
+            e.name,
+            e.host,
+            'active' if e.active else 'inactive',
+            format_size(e.memory) if e.memory is not None else '-',
+            str(e.vcpus) if e.vcpus is not None else '-',
+            e.uuid,
+            datetime.datetime.fromtimestamp(e.updated).strftime('%Y-%m-%d %H:%M:%S'),
+        ))
+    return format_table(rows)
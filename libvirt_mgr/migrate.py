@@ -1,96 +1,442 @@
 import argparse
+import functools
 import logging
+import threading
 import time
-from typing import List, Optional, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
-import libvirt
-
-from .utils import Config, HostConfig
+from .utils import Config, ConnectionPool, GroupConfig, HostConfig
+from .utils.adaptive import AdaptiveController, LinkBudget
+from .utils.domains import DomainRecord
+from .utils.estimate import (ORDER_GIVEN, ORDER_SHORTEST, Estimate, EstimateHistory, MigrationEstimator,
+                             format_duration, format_plan, get_history_path, order_tasks, simulate_schedule)
+from .utils.events import wait_for_shutdown
+from .utils.inventory import Inventory, InventoryEntry, open_inventory, refresh_inventory
+from .utils.journal import (PHASE_FAILED, PHASE_MIGRATED, PHASE_MIGRATING, PHASE_SKIPPED, PHASE_STARTED,
+                            PHASE_STOPPED, Journal, JournalEntry, open_journal)
+from .utils.lazy import libvirt
+from .utils.monitor import (DEFAULT_PROGRESS_INTERVAL, OBSERVER_POLL_INTERVAL, ProgressReporter, get_completed_job_stats,
+                            summarize_job_stats)
+from .utils.postcopy import PostCopySwitch
+from .utils.preflight import preflight_tasks
+from .utils.probe import HostStats, probe_hosts
+from .utils.profile import profile_span
+from .utils.selector import DomainSelector
+from .utils.storage import copy_domain_disks
 
 
 logger = logging.getLogger(__name__)
 
+STATUS_MIGRATED = 'migrated'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+# Running domains shutdown ahead of their offline migration in batches
+DEFAULT_LOOKAHEAD = 1
+# Domains started on their destination at once after offline migrations in batches
+DEFAULT_START_WORKERS = 4
+
+
+class MigrationTask:
+    """A single domain to be migrated between two hypervisors"""
+    __slots__ = ('domain', 'src_host', 'dst_host', 'src_conn', 'dst_conn', 'flags', 'params', 'group')
+
+    def __init__(
+        self,
+        domain: DomainRecord,
+        src_host: HostConfig,
+        dst_host: HostConfig,
+        src_conn: 'libvirt.virConnect',
+        dst_conn: 'libvirt.virConnect',
+        flags: int,
+        params: Dict[str, Any],
+        group: GroupConfig,
+    ):
+        self.domain = domain
+        self.src_host = src_host
+        self.dst_host = dst_host
+        self.src_conn = src_conn
+        self.dst_conn = dst_conn
+        self.flags = flags
+        self.params = params
+        # Group of the source host, determines migration policy
+        self.group = group
+
+
+class MigrationResult:
+    """Outcome of a single domain migration"""
+    __slots__ = ('name', 'src_host', 'dst_host', 'status', 'duration', 'error', 'data_processed', 'start_error',
+                 'concurrent')
+
+    def __init__(
+        self,
+        name: str,
+        src_host: str,
+        dst_host: str,
+        status: str,
+        duration: float = 0.0,
+        error: Optional[str] = None,
+        data_processed: Optional[int] = None,
+        start_error: Optional[str] = None,
+        concurrent: Optional[int] = None,
+    ):
+        self.name = name
+        self.src_host = src_host
+        self.dst_host = dst_host
+        self.status = status
+        self.duration = duration
+        self.error = error
+        # Bytes transferred according to the job statistics, None if unknown
+        self.data_processed = data_processed
+        # Why a migrated domain could not be started on the destination, it is left stopped there
+        self.start_error = start_error
+        # Most live migrations from the source host running at once while this one was, None for offline migrations
+        self.concurrent = concurrent
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class MigrationLimits:
+    """Caps the number of concurrent outgoing and incoming migrations per host based on group configuration"""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._outgoing: Dict[str, threading.BoundedSemaphore] = {}
+        self._incoming: Dict[str, threading.BoundedSemaphore] = {}
+
+    def _get_semaphore(
+        self,
+        semaphores: Dict[str, threading.BoundedSemaphore],
+        host: HostConfig,
+        limit: Optional[int],
+    ) -> Optional[threading.BoundedSemaphore]:
+        if limit is None:
+            return None
+        with self._lock:
+            if host.name not in semaphores:
+                semaphores[host.name] = threading.BoundedSemaphore(limit)
+            return semaphores[host.name]
+
+    @contextmanager
+    def acquire(self, src_host: HostConfig, dst_host: HostConfig):
+        # Always acquire outgoing before incoming to avoid deadlocks between workers
+        outgoing = self._get_semaphore(self._outgoing, src_host, self.config.groups[src_host.group].max_outgoing)
+        incoming = self._get_semaphore(self._incoming, dst_host, self.config.groups[dst_host.group].max_incoming)
+        if outgoing:
+            outgoing.acquire()
+        try:
+            if incoming:
+                incoming.acquire()
+            try:
+                yield
+            finally:
+                if incoming:
+                    incoming.release()
+        finally:
+            if outgoing:
+                outgoing.release()
+
+
+def launch_migrate(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    # Find the source host of domains selected by name only in the inventory
+    if args.src_host is None and not args.all and get_selector(args).exact:
+        if pool is None:
+            with ConnectionPool() as pool:
+                return launch_migrate(args, config, pool)
+        with open_inventory(getattr(args, 'inventory', None)) as inventory:
+            hosts = {name: locate_domain(config, name, pool, inventory) for name in get_selector(args).names}
+        if len({h.name for h in hosts.values()}) > 1:
+            found = ', '.join(f'"{name}" on "{h.name}"' for name, h in hosts.items())
+            raise Exception(f'Domains are on different hosts ({found}), migrate them separately')
+        src_host = next(iter(hosts.values()))
+        logger.info('Found %s on host "%s"', ', '.join(f'"{n}"' for n in hosts), src_host.name)
+        args.src_host = src_host.name
 
-def launch_migrate(args: argparse.Namespace, config: Config):
     # Validate arguments vs config
-    src_host: HostConfig = config.hosts.get(args.src_host)
+    src_name = args.src_host or 'localhost'
+    src_host: HostConfig = config.hosts.get(src_name)
     if not src_host:
-        raise Exception(f'Source host "{args.src_host}" not found in configuration')
+        raise Exception(f'Source host "{src_name}" not found in configuration')
     dst_host: Optional[HostConfig] = None
     if args.dst_group:
-        exclude_dst_hosts = [src_host.name]
-        dst_host = get_host_from_group(config, args.dst_group, exclude_dst_hosts)
+        if args.dst_group not in config.groups:
+            raise Exception(f'Destination group "{args.dst_group}" not found in configuration')
     else:
         dst_host = config.hosts.get(args.dst_host)
         if not dst_host:
             raise Exception(f'Destination host "{args.dst_host}" not found in configuration')
         elif src_host == dst_host:
             raise Exception('Source and destination host cannot be the same')
+    if getattr(args, 'parallel', 1) < 1:
+        raise Exception('Number of parallel migrations must be at least 1')
 
+    if pool is None:
+        with ConnectionPool() as pool:
+            return _launch_migrate(args, config, pool, src_host, dst_host)
+    return _launch_migrate(args, config, pool, src_host, dst_host)
+
+
+def _launch_migrate(
+    args: argparse.Namespace,
+    config: Config,
+    pool: ConnectionPool,
+    src_host: HostConfig,
+    dst_host: Optional[HostConfig],
+):
     # Connect to source hypervisor
     try:
-        src_conn = libvirt.open(src_host.uri)
+        src_conn = pool.get(src_host)
     except libvirt.libvirtError:
         logger.critical('Cannot connect to source hypervisor "%s"', src_host.name)
         raise
 
-    dom_list: List[libvirt.virDomain] = []
-    if args.all:
-        id_list = src_conn.listDomainsID()
-        if not id_list:
-            logger.info('Source host "%s" has no active domains.', src_host.name)
-            return
-        for dom_id in id_list:
-            dom = get_domain(src_conn, dom_id)
-            if dom is None:
-                logger.warning('Cannot find domain with ID "%d" on host "%s"', dom_id, src_host.name)
-                continue
-            dom_list.append(dom)
-    else:
-        dom = get_domain(src_conn, args.name)
-        if dom is None:
-            logger.error('Cannot find domain with name "%s" on host "%s"', args.name, src_host.name)
-            raise SystemExit(1)
-        dom_list.append(dom)
-
+    selector = get_selector(args)
+    dom_list = selector.select(src_conn)
+    missing = selector.missing()
+    for name in missing:
+        logger.error('Cannot find domain with name "%s" on host "%s"', name, src_host.name)
+    if missing:
+        raise SystemExit(1)
     if not dom_list:
-        logger.info('No domains found on host "%s"', src_host.name)
+        logger.info('No domains on host "%s" match the selection', src_host.name)
         return
 
-    # Connect to destination hypervisor
+    # Pick a destination for each domain
+    assignments: List[Tuple[DomainRecord, HostConfig]] = []
+    for domain in dom_list:
+        if args.dst_group:
+            dst_host = get_host_from_group(config, args.dst_group, [src_host.name], memory=domain.memory, pool=pool)
+            logger.info('Selected host "%s" as destination for "%s"', dst_host.name, domain.name)
+        assignments.append((domain, dst_host))
+
+    tasks = build_tasks(config, pool, src_host, assignments)
+    return run_tasks(args, config, tasks)
+
+
+def get_selector(args: argparse.Namespace) -> DomainSelector:
+    """Returns the selector of domains to migrate, all active domains with --all unless states are given"""
+    states = getattr(args, 'state', None) or (['active'] if args.all else None)
+    return DomainSelector.from_string(
+        None if args.all else args.name,
+        states=states,
+        min_memory=getattr(args, 'min_memory', None),
+        max_memory=getattr(args, 'max_memory', None),
+        min_vcpus=getattr(args, 'min_vcpus', None),
+        max_vcpus=getattr(args, 'max_vcpus', None),
+        tags=getattr(args, 'tag', None),
+    )
+
+
+def build_tasks(
+    config: Config,
+    pool: ConnectionPool,
+    src_host: HostConfig,
+    assignments: List[Tuple[DomainRecord, HostConfig]],
+) -> List[MigrationTask]:
+    """Returns migration tasks for domains on src_host, connecting to their destination hosts"""
+    src_conn = pool.get(src_host)
+    group = config.groups[src_host.group]
+    tasks = []
+    for domain, dst_host in assignments:
+        try:
+            dst_conn = pool.get(dst_host)
+        except libvirt.libvirtError:
+            logger.critical('Cannot connect to destination hypervisor "%s"', dst_host.name)
+            raise
+        flags, params = get_migrate_options(config, src_host, dst_host)
+        tasks.append(MigrationTask(domain, src_host, dst_host, src_conn, dst_conn, flags, params, group))
+    return tasks
+
+
+def run_tasks(
+    args: argparse.Namespace,
+    config: Config,
+    tasks: List[MigrationTask],
+    journal: Optional[Journal] = None,
+) -> List[MigrationResult]:
+    """Runs migration tasks with the options common to all migrating commands
+
+    Tasks whose domain cannot run on its destination are failed by preflight checks before any domain is touched.
+    The rest are ordered by their predicted duration according to --order, with --plan the predicted schedule is
+    printed instead. Tasks are recorded as a new batch in the journal, unless an existing journal is given to continue
+    its batch.
+    """
+    failed = []
+    if not getattr(args, 'no_preflight', False):
+        tasks, failed = preflight(tasks, not getattr(args, 'no_start', False), journal)
+    order = getattr(args, 'order', ORDER_SHORTEST)
+    plan = getattr(args, 'plan', False)
+    estimator = MigrationEstimator(config, EstimateHistory(get_history_path(getattr(args, 'estimates', None))))
+    measure = plan or (getattr(args, 'measure_dirty_rates', False) and order != ORDER_GIVEN and len(tasks) > 1)
+    estimates = estimator.estimate_all(tasks, measure)
+    tasks, estimates = order_tasks(tasks, estimates, order)
+    if plan:
+        print(format_plan(config, tasks, estimates, getattr(args, 'parallel', 1)))
+        return failed
+    if len(tasks) > 1:
+        schedule = simulate_schedule(config, tasks, estimates, getattr(args, 'parallel', 1))
+        logger.info('Migrating %d domains, predicted to take %s', len(tasks), format_duration(max(e for _, e in schedule)))
+    if journal is None:
+        with open_journal(getattr(args, 'journal', None)) as journal:
+            journal.begin(
+                [journal_entry(t) for t in tasks], not args.no_stop, not args.no_start, getattr(args, 'command', None),
+            )
+            return failed + _run_tasks(args, config, tasks, journal, estimator, estimates)
+    return failed + _run_tasks(args, config, tasks, journal, estimator, estimates)
+
+
+def preflight(
+    tasks: List[MigrationTask],
+    auto_start: bool = True,
+    journal: Optional[Journal] = None,
+) -> Tuple[List[MigrationTask], List[MigrationResult]]:
+    """Returns tasks which passed preflight checks and results of those which did not"""
+    passed, failed = [], []
+    for task, problems in zip(tasks, preflight_tasks(tasks, auto_start)):
+        if not problems:
+            passed.append(task)
+            continue
+        result = MigrationResult(task.domain.name, task.src_host.name, task.dst_host.name, STATUS_FAILED,
+                                 error=f'preflight: {"; ".join(problems)}')
+        logger.error('Cannot migrate "%s" to "%s": %s', result.name, result.dst_host, '; '.join(problems))
+        if journal is not None:
+            journal.record(task.domain.uuid, PHASE_FAILED, result.error)
+        failed.append(result)
+    return passed, failed
+
+
+def _run_tasks(
+    args: argparse.Namespace,
+    config: Config,
+    tasks: List[MigrationTask],
+    journal: Journal,
+    estimator: MigrationEstimator,
+    estimates: List[Estimate],
+) -> List[MigrationResult]:
+    reporter = ProgressReporter(
+        interval=getattr(args, 'progress_interval', DEFAULT_PROGRESS_INTERVAL),
+        metrics_file=getattr(args, 'metrics_file', None),
+    )
     try:
-        dst_conn = libvirt.open(dst_host.uri)
-    except libvirt.libvirtError:
-        logger.critical('Cannot connect to destination hypervisor "%s"', dst_host.name)
-        raise
+        results = migrate_domains(
+            tasks=tasks,
+            auto_stop=not args.no_stop,
+            auto_start=not args.no_start,
+            parallel=getattr(args, 'parallel', 1),
+            limits=MigrationLimits(config),
+            reporter=reporter,
+            lookahead=getattr(args, 'lookahead', DEFAULT_LOOKAHEAD),
+            journal=journal,
+        )
+    finally:
+        reporter.close()
+    for task, estimate, result in zip(tasks, estimates, results):
+        if result.status == STATUS_MIGRATED:
+            estimator.learn(task, estimate, result.duration, result.data_processed, result.concurrent or 1)
+    estimator.history.save()
+    record_moves(args, results)
+    return results
+
+
+def record_moves(args: argparse.Namespace, results: List[MigrationResult]):
+    """Updates the inventory with successful migrations"""
+    moves = [(r.name, r.src_host, r.dst_host) for r in results if r.status == STATUS_MIGRATED]
+    if moves:
+        with open_inventory(getattr(args, 'inventory', None)) as inventory:
+            inventory.move(moves)
+
+
+def journal_entry(task: MigrationTask) -> JournalEntry:
+    return JournalEntry(
+        task.domain.uuid,
+        task.domain.name,
+        task.src_host.name,
+        task.dst_host.name,
+        active=task.domain.active,
+        offline=bool(task.flags & libvirt.VIR_MIGRATE_OFFLINE),
+    )
+
+
+def locate_domain(config: Config, name: str, pool: ConnectionPool, inventory: Inventory) -> HostConfig:
+    """Returns the host of a domain according to the inventory
+
+    All hosts are scanned if the domain is unknown or no longer on the host the inventory has it on. An active domain
+    is preferred over inactive copies defined on other hosts.
+    """
+    for refreshed in (False, True):
+        if refreshed:
+            logger.info('Domain "%s" is not in the inventory, scanning all hosts', name)
+            refresh_inventory(inventory, list(config.hosts.values()), pool)
+        entries: List[InventoryEntry] = [
+            e for e in inventory.find(name) if e.host in config.hosts and name in (e.name, e.uuid)
+        ]
+        candidates = [e for e in entries if e.active] or entries
+        # The implicit localhost is usually also configured under its real name
+        if len(candidates) > 1:
+            candidates = [e for e in candidates if e.host != 'localhost'] or candidates
+        if len(candidates) > 1:
+            hosts = ', '.join(f'"{e.host}"' for e in candidates)
+            raise Exception(f'Domain "{name}" is defined on multiple hosts ({hosts}), use --src-host to pick one')
+        if not candidates:
+            continue
+        host = config.hosts[candidates[0].host]
+        if refreshed or get_domain(pool.get(host), name) is not None:
+            return host
+    raise Exception(f'Domain "{name}" not found on any host')
+
 
-    # Determine migration flags
+def get_migrate_options(config: Config, src_host: HostConfig, dst_host: HostConfig) -> Tuple[int, Dict[str, Any]]:
+    """Returns the migration flags and parameters to use between two hosts, based on the source host's group"""
+    group = config.groups[src_host.group]
     if src_host.group == dst_host.group:
-        flags = config.groups[src_host.group].same_group_flags
+        flags, params = group.same_group_flags, group.same_group_params
         logger.info('Using flags for migration within the same group')
     else:
-        flags = config.groups[src_host.group].different_group_flags
+        flags, params = group.different_group_flags, group.different_group_params
         logger.info('Using flags for migration between different groups')
-    logger.debug(f'Migration flags {flags:b}')
-    migrate_domains(
-        src_conn=src_conn,
-        dst_conn=dst_conn,
-        domains=dom_list,
-        flags=flags,
-        auto_stop=not args.no_stop,
-        auto_start=not args.no_start,
-    )
-    src_conn.close()
-    logger.debug('Closed source connection')
-    dst_conn.close()
-    logger.debug('Closed destination connection')
+    logger.debug(f'Migration flags {flags:b}, parameters {params}')
+    return flags, params
+
 
+def get_host_from_group(
+    config: Config,
+    group_name: str,
+    exclude: Optional[List[str]] = None,
+    memory: int = 0,
+    pool: Optional[ConnectionPool] = None,
+) -> HostConfig:
+    """Returns the least loaded reachable host in a group with at least memory bytes free
 
-def get_host_from_group(config: Config, group_name: str, exclude: Optional[List[str]] = None) -> HostConfig:
-    raise NotImplementedError
+    Host stats are cached for a short time, the selected host's cached stats are updated to account for the new domain.
+    """
+    if group_name not in config.groups:
+        raise Exception(f'Group "{group_name}" not found in configuration')
+    exclude = exclude or []
+    candidates = [h for h in config.hosts.values() if h.group == group_name and h.name not in exclude]
+    if not candidates:
+        raise Exception(f'Group "{group_name}" has no hosts available')
+    if pool is None:
+        with ConnectionPool() as pool:
+            host_stats = probe_hosts(candidates, pool)
+    else:
+        host_stats = probe_hosts(candidates, pool)
+    best: Optional[HostStats] = None
+    for stats in host_stats.values():
+        if stats.memory_free < memory:
+            logger.debug('Host "%s" does not have enough free memory', stats.name)
+            continue
+        if best is None or stats.score > best.score:
+            best = stats
+    if best is None:
+        raise Exception(f'No reachable host in group "{group_name}" can fit the domain')
+    best.reserve(memory)
+    return config.hosts[best.name]
 
 
-def get_domain(conn: libvirt.virConnect, dom: Union[int, str]) -> Optional[libvirt.virDomain]:
+def get_domain(conn: 'libvirt.virConnect', dom: Union[int, str]) -> Optional['libvirt.virDomain']:
     try:
         if isinstance(dom, int):
             return conn.lookupByID(dom)
@@ -102,42 +448,338 @@ def get_domain(conn: libvirt.virConnect, dom: Union[int, str]) -> Optional[libvi
 
 
 def migrate_domains(
-    src_conn: libvirt.virConnect,
-    dst_conn: libvirt.virConnect,
-    domains: List[libvirt.virDomain],
-    flags: int,
+    tasks: List[MigrationTask],
     auto_stop: bool = True,
     auto_start: bool = True,
-):
+    parallel: int = 1,
+    limits: Optional[MigrationLimits] = None,
+    reporter: Optional[ProgressReporter] = None,
+    lookahead: int = DEFAULT_LOOKAHEAD,
+    journal: Optional[Journal] = None,
+) -> List[MigrationResult]:
+    """Migrates all tasks, up to parallel at a time, and logs a summary once done
+
+    Batches with offline migrations are pipelined, see OfflinePipeline.
+    """
+    if lookahead < 0:
+        raise Exception('Lookahead cannot be negative')
+    if reporter is None:
+        reporter = ProgressReporter()
+    # Live migrations from the same host share its link bandwidth
+    links = LinkBudget()
+    pipeline = None
+    if len(tasks) > 1 and any(t.flags & libvirt.VIR_MIGRATE_OFFLINE for t in tasks):
+        pipeline = OfflinePipeline(tasks, lookahead if auto_stop else 0, journal)
+    run_task = functools.partial(
+        _run_task, auto_stop=auto_stop, auto_start=auto_start, limits=limits, reporter=reporter, links=links,
+        pipeline=pipeline, journal=journal,
+    )
+    start = time.monotonic()
+    try:
+        if parallel <= 1 or len(tasks) <= 1:
+            results = [run_task(t) for t in tasks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(parallel, len(tasks))) as executor:
+                results = list(executor.map(run_task, tasks))
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+    log_summary(results, time.monotonic() - start)
+    return results
+
+
+def _run_task(
+    task: MigrationTask,
+    auto_stop: bool,
+    auto_start: bool,
+    limits: Optional[MigrationLimits],
+    reporter: ProgressReporter,
+    links: LinkBudget,
+    pipeline: Optional['OfflinePipeline'],
+    journal: Optional[Journal],
+) -> MigrationResult:
+    if limits is None:
+        result = migrate_domain(task, auto_stop, auto_start, reporter, links, pipeline, journal)
+    else:
+        with limits.acquire(task.src_host, task.dst_host):
+            result = migrate_domain(task, auto_stop, auto_start, reporter, links, pipeline, journal)
+    if journal is not None and result.status != STATUS_MIGRATED:
+        journal.record(task.domain.uuid, PHASE_FAILED if result.status == STATUS_FAILED else PHASE_SKIPPED, result.error)
+    return result
+
+
+def migrate_domain(
+    task: MigrationTask,
+    auto_stop: bool = True,
+    auto_start: bool = True,
+    reporter: Optional[ProgressReporter] = None,
+    links: Optional[LinkBudget] = None,
+    pipeline: Optional['OfflinePipeline'] = None,
+    journal: Optional[Journal] = None,
+) -> MigrationResult:
+    """Migrates a single domain, stopping and starting it for offline migrations if needed
+
+    With a pipeline the domain may already have been shutdown ahead of time, and is started in the background. Each
+    step is recorded in the journal before it is taken.
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
+    if links is None:
+        links = LinkBudget()
+    domain = task.domain
+    dom = domain.dom
+    flags = task.flags
+    result = MigrationResult(domain.name, task.src_host.name, task.dst_host.name, STATUS_SKIPPED)
     live_migration = flags & libvirt.VIR_MIGRATE_LIVE
     offline_migration = flags & libvirt.VIR_MIGRATE_OFFLINE
-    for dom in domains:
-        logger.info('Migrating "%s"', dom.name())
-        if not dom.isActive() and live_migration:
-            logger.warning('"%s" is offline, cannot live migrate', dom.name())
-            continue
-        if dom.isActive() and offline_migration:
-            if auto_stop:
-                logger.warning('"%s" is running, shutting down before offline migration', dom.name())
-                dom.shutdown()
-                logger.info('Waiting for "%s" to shutdown', dom.name())
-                while dom.isActive():
-                    time.sleep(1)
-                logger.info('"%s" has shutdown', dom.name())
-            else:
-                logger.error('"%s" is running, cannot perform offline migration', dom.name())
-                continue
+    start = time.monotonic()
+    # Whether the domain was shutdown for an offline migration
+    stopped = False
+    logger.info('Migrating "%s"', domain.name)
+    if pipeline is not None:
+        pipeline.begin(task)
+    if not domain.active and live_migration:
+        logger.warning('"%s" is offline, cannot live migrate', domain.name)
+        result.error = 'offline, cannot live migrate'
+        result.duration = time.monotonic() - start
+        reporter.report_result(result.name, result.src_host, result.dst_host, result.status, result.duration)
+        return result
+    if domain.active and offline_migration:
+        if auto_stop:
+            try:
+                if not (pipeline.stop(task) if pipeline is not None else stop_for_migration(task)):
+                    result.error = 'did not shutdown in time'
+            except libvirt.libvirtError as e:
+                logger.error('Cannot shutdown "%s"', domain.name, exc_info=e)
+                result.error = f'cannot shutdown: {e}'
+            if result.error is not None:
+                result.status = STATUS_FAILED
+                result.duration = time.monotonic() - start
+                reporter.report_result(result.name, result.src_host, result.dst_host, result.status, result.duration)
+                return result
+            domain.active = False
+            stopped = True
+            if journal is not None:
+                journal.record(domain.uuid, PHASE_STOPPED)
+        else:
+            logger.error('"%s" is running, cannot perform offline migration', domain.name)
+            result.error = 'running, cannot perform offline migration'
+            result.duration = time.monotonic() - start
+            reporter.report_result(result.name, result.src_host, result.dst_host, result.status, result.duration)
+            return result
+    copied = []
+    # Hosts of the same group share storage
+    if offline_migration and task.group.copy_disks and task.src_host.group != task.dst_host.group:
         try:
-            new_dom = dom.migrate(dst_conn, flags, None, None, 0)
-            if offline_migration and auto_start and not new_dom.isActive():
-                logger.info('Starting "%s" after offline migration', new_dom.name())
-                new_dom.create()
-        except libvirt.libvirtError as e:
-            logger.error('Migration of "%s" from "%s" to "%s" failed', dom.name(), src_conn.getURI(), dst_conn.getURI(), exc_info=e)
-            # Check for a couple of seconds if the domain has shutdown
-            for _ in range(5):
-                if not dom.isActive():
-                    logger.warning('Starting "%s" after migration failure', dom.name())
-                    dom.create()
-                    break
-                time.sleep(1)
+            copied = copy_domain_disks(
+                dom, task.src_conn, task.dst_conn, verify=task.group.verify_disks, progress_interval=reporter.interval,
+            )
+        except Exception as e:
+            result.status = STATUS_FAILED
+            result.error = f'disk copy failed: {e}'
+            logger.error('Copying disks of "%s" to "%s" failed', domain.name, task.dst_host.name, exc_info=e)
+            if stopped:
+                logger.warning('Starting "%s" after disk copy failure', domain.name)
+                restart_after_failure(dom, domain.name)
+            result.duration = time.monotonic() - start
+            reporter.report_result(result.name, result.src_host, result.dst_host, result.status, result.duration, None)
+            return result
+    stats = None
+    observers = []
+    switch = None
+    if live_migration and flags & libvirt.VIR_MIGRATE_POSTCOPY and task.group.postcopy is not None:
+        switch = PostCopySwitch(task.group.postcopy, domain.name)
+        observers.append(switch)
+    if live_migration and task.group.adaptive is not None:
+        observers.append(AdaptiveController(
+            task.group.adaptive, domain.name, task.src_host.name, links, reporter.metrics,
+        ))
+    if journal is not None:
+        journal.record(domain.uuid, PHASE_MIGRATING)
+    try:
+        if live_migration:
+            poll_interval = OBSERVER_POLL_INTERVAL if observers else None
+            with links.use(task.src_host.name) as link, \
+                    reporter.monitor(dom, domain.name, observers, poll_interval) as monitor:
+                new_dom = dom.migrate3(task.dst_conn, task.params, flags)
+            stats = monitor.last_stats
+            result.concurrent = link.peak
+        else:
+            new_dom = dom.migrate3(task.dst_conn, task.params, flags)
+        result.status = STATUS_MIGRATED
+        if journal is not None:
+            journal.record(domain.uuid, PHASE_MIGRATED)
+        stats = get_completed_job_stats(new_dom) or stats
+        if stats:
+            result.data_processed = summarize_job_stats(stats)['data_processed'] or None
+        if offline_migration and auto_start:
+            if pipeline is not None:
+                pipeline.start(task, result, new_dom)
+            else:
+                try:
+                    start_after_migration(new_dom, domain.uuid, journal)
+                except libvirt.libvirtError as e:
+                    record_start_error(result, e, domain.uuid, journal)
+    except libvirt.libvirtError as e:
+        result.status = STATUS_FAILED
+        result.error = str(e)
+        logger.error('Migration of "%s" from "%s" to "%s" failed', domain.name, task.src_host.name, task.dst_host.name, exc_info=e)
+        for vol in copied:
+            try:
+                vol.delete(0)
+            except libvirt.libvirtError as delete_error:
+                logger.error('Cannot delete copied volume "%s": %s', vol.name(), delete_error)
+        if switch is not None and switch.switched:
+            # Memory is split between both hosts, starting the source again would lose the destination's changes
+            result.error = f'failed during post-copy, manual recovery required: {e}'
+            logger.critical('"%s" failed after switching to post-copy, manual recovery required', domain.name)
+        elif stopped:
+            logger.warning('Starting "%s" after migration failure', domain.name)
+            restart_after_failure(dom, domain.name)
+    result.duration = time.monotonic() - start
+    reporter.report_result(result.name, result.src_host, result.dst_host, result.status, result.duration, stats)
+    return result
+
+
+def restart_after_failure(dom: 'libvirt.virDomain', name: str):
+    """Starts a domain shutdown for a migration which failed again, errors are logged to keep the original one"""
+    try:
+        dom.create()
+    except libvirt.libvirtError as e:
+        logger.error('Cannot start "%s" again: %s', name, e)
+
+
+def stop_for_migration(task: MigrationTask) -> bool:
+    """Shuts down the domain of an offline migration task, returns False if it is still running"""
+    logger.warning('"%s" is running, shutting down before offline migration', task.domain.name)
+    with profile_span(task.src_host.name, 'shutdown_domain'):
+        return shutdown_domain(task.domain.dom, task.group.shutdown_timeout, task.group.shutdown_timeout_action)
+
+
+def start_after_migration(dom: 'libvirt.virDomain', uuid: Optional[str] = None, journal: Optional[Journal] = None):
+    if not dom.isActive():
+        logger.info('Starting "%s" after offline migration', dom.name())
+        dom.create()
+    if journal is not None:
+        journal.record(uuid or dom.UUIDString(), PHASE_STARTED)
+
+
+def record_start_error(result: MigrationResult, error: Exception, uuid: str, journal: Optional[Journal] = None):
+    """Records that a domain was migrated but could not be started, it still counts as migrated"""
+    result.start_error = str(error)
+    if journal is not None:
+        journal.record(uuid, PHASE_FAILED, f'cannot start on destination: {error}')
+    logger.error('Cannot start "%s" on "%s" after offline migration', result.name, result.dst_host, exc_info=error)
+
+
+class OfflinePipeline:
+    """Overlaps the shutdown, migration and start of domains in a batch of offline migrations
+
+    Running domains are shutdown up to lookahead tasks ahead of the latest task to begin, and migrated domains are
+    started on their destination in the background. Domains shutdown ahead of time whose task never got to migrate
+    them are started again on close.
+    """
+
+    def __init__(self, tasks: List[MigrationTask], lookahead: int = DEFAULT_LOOKAHEAD, journal: Optional[Journal] = None):
+        self.tasks = tasks
+        self.lookahead = lookahead
+        self.journal = journal
+        self._index = {id(t): i for i, t in enumerate(tasks)}
+        self._lock = threading.Lock()
+        # Shutdowns issued ahead of time by task index, removed once their task collects them
+        self._stops: Dict[int, Future] = {}
+        self._begun: Set[int] = set()
+        self._starts: List[Tuple[MigrationTask, MigrationResult, Future]] = []
+        self._stop_executor = ThreadPoolExecutor(max_workers=lookahead) if lookahead > 0 else None
+        self._start_executor = ThreadPoolExecutor(max_workers=DEFAULT_START_WORKERS)
+
+    @staticmethod
+    def _needs_stop(task: MigrationTask) -> bool:
+        return task.domain.active and bool(task.flags & libvirt.VIR_MIGRATE_OFFLINE)
+
+    def begin(self, task: MigrationTask):
+        """Marks task as being migrated and issues shutdowns for the tasks following it"""
+        index = self._index[id(task)]
+        with self._lock:
+            self._begun.add(index)
+            if self._stop_executor is None:
+                return
+            for i in range(index + 1, min(index + 1 + self.lookahead, len(self.tasks))):
+                upcoming = self.tasks[i]
+                if i in self._stops or i in self._begun or not self._needs_stop(upcoming):
+                    continue
+                self._stops[i] = self._stop_executor.submit(stop_for_migration, upcoming)
+
+    def stop(self, task: MigrationTask) -> bool:
+        """Waits for the shutdown issued ahead of time, or shuts the domain down now if there was none"""
+        with self._lock:
+            future = self._stops.pop(self._index[id(task)], None)
+        if future is None:
+            return stop_for_migration(task)
+        return future.result()
+
+    def start(self, task: MigrationTask, result: MigrationResult, dom: 'libvirt.virDomain'):
+        """Starts a migrated domain in the background, result gets a start error on close if it cannot be started"""
+        future = self._start_executor.submit(start_after_migration, dom, task.domain.uuid, self.journal)
+        self._starts.append((task, result, future))
+
+    def close(self):
+        with self._lock:
+            leftover = list(self._stops.items())
+            self._stops.clear()
+        for index, future in leftover:
+            domain = self.tasks[index].domain
+            try:
+                if not future.result():
+                    continue
+                logger.warning('Starting "%s", it was shutdown but not migrated', domain.name)
+                domain.dom.create()
+            except Exception as e:
+                logger.error('Cannot start "%s" again: %s', domain.name, e)
+        if self._stop_executor is not None:
+            self._stop_executor.shutdown()
+        for task, result, future in self._starts:
+            try:
+                future.result()
+            except Exception as e:
+                record_start_error(result, e, task.domain.uuid, self.journal)
+        self._start_executor.shutdown()
+
+
+def shutdown_domain(dom: 'libvirt.virDomain', timeout: Optional[float] = None, timeout_action: str = 'abort') -> bool:
+    """Gracefully shuts down a domain, returns False if it is still running
+
+    If the domain has not stopped after timeout seconds, it is either destroyed or left running depending on timeout_action.
+    """
+    start = time.monotonic()
+    dom.shutdown()
+    logger.info('Waiting for "%s" to shutdown', dom.name())
+    if wait_for_shutdown(dom, timeout):
+        logger.info('"%s" has shutdown after %.1fs', dom.name(), time.monotonic() - start)
+        return True
+    if timeout_action == 'destroy':
+        logger.warning('"%s" did not shutdown within %ss, destroying', dom.name(), timeout)
+        dom.destroy()
+        return True
+    logger.error('"%s" did not shutdown within %ss, aborting', dom.name(), timeout)
+    return False
+
+
+def log_summary(results: List[MigrationResult], duration: float):
+    """Logs an aggregated summary of a batch of migrations"""
+    counts = {STATUS_MIGRATED: 0, STATUS_SKIPPED: 0, STATUS_FAILED: 0}
+    for r in results:
+        counts[r.status] += 1
+    logger.info(
+        'Migrated %d, skipped %d, failed %d of %d domains in %.1fs',
+        counts[STATUS_MIGRATED], counts[STATUS_SKIPPED], counts[STATUS_FAILED], len(results), duration,
+    )
+    for r in results:
+        if r.status == STATUS_MIGRATED and r.start_error:
+            logger.error('"%s" migrated to "%s" but cannot be started there: %s', r.name, r.dst_host, r.start_error)
+        elif r.status == STATUS_MIGRATED:
+            logger.debug('"%s" migrated from "%s" to "%s" in %.1fs', r.name, r.src_host, r.dst_host, r.duration)
+        elif r.status == STATUS_SKIPPED:
+            logger.info('"%s" skipped: %s', r.name, r.error)
+        else:
+            logger.error('"%s" failed to migrate from "%s" to "%s": %s', r.name, r.src_host, r.dst_host, r.error)
@@ -0,0 +1,198 @@
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+from .utils.base import SlotsRepr
+
+
+class PlacementError(Exception):
+    pass
+
+
+class DomainFootprint:
+    """Resources used by a domain"""
+    __slots__ = ('name', 'memory', 'vcpus')
+
+    def __init__(self, name: str, memory: int, vcpus: int = 1):
+        self.name = name
+        # Memory in bytes
+        self.memory = memory
+        self.vcpus = vcpus
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={repr(self.name)}, memory={self.memory}, vcpus={self.vcpus})'
+
+
+class HostCapacity(SlotsRepr):
+    """Resources of a host and how much of them is in use"""
+    __slots__ = ('name', 'memory_total', 'memory_used', 'cpus', 'vcpus_used')
+
+    def __init__(self, name: str, memory_total: int, memory_used: int, cpus: int = 1, vcpus_used: int = 0):
+        self.name = name
+        # Memory in bytes, used includes everything running on the host, not only domains
+        self.memory_total = memory_total
+        self.memory_used = memory_used
+        self.cpus = cpus
+        self.vcpus_used = vcpus_used
+
+    def copy(self) -> 'HostCapacity':
+        return HostCapacity(self.name, self.memory_total, self.memory_used, self.cpus, self.vcpus_used)
+
+    @property
+    def utilization(self) -> float:
+        """Fraction of memory in use"""
+        return self.memory_used / self.memory_total if self.memory_total else 1.0
+
+    @property
+    def vcpu_ratio(self) -> float:
+        """vCPUs per physical CPU"""
+        return self.vcpus_used / self.cpus if self.cpus else float(self.vcpus_used)
+
+    def utilization_with(self, domain: DomainFootprint) -> float:
+        return (self.memory_used + domain.memory) / self.memory_total if self.memory_total else 1.0
+
+    def fits(self, domain: DomainFootprint, max_utilization: float = 1.0) -> bool:
+        return self.utilization_with(domain) <= max_utilization
+
+    def add(self, domain: DomainFootprint):
+        self.memory_used += domain.memory
+        self.vcpus_used += domain.vcpus
+
+    def remove(self, domain: DomainFootprint):
+        self.memory_used -= domain.memory
+        self.vcpus_used -= domain.vcpus
+
+
+def plan_evacuation(
+    domains: List[DomainFootprint],
+    hosts: List[HostCapacity],
+    max_utilization: float = 1.0,
+) -> Dict[str, str]:
+    """Returns a mapping of domain name to host name which keeps the peak host memory utilization as low as possible
+
+    Domains are placed largest first, each on the host with the lowest utilization after adding it, ties are broken
+    by vCPU ratio. Hosts are not modified. Raises PlacementError if a domain does not fit without exceeding
+    max_utilization on any host.
+    """
+    planned = [h.copy() for h in hosts]
+    placement: Dict[str, str] = {}
+    for domain in sorted(domains, key=lambda d: (d.memory, d.vcpus), reverse=True):
+        best: Optional[HostCapacity] = None
+        best_key = None
+        for host in planned:
+            if not host.fits(domain, max_utilization):
+                continue
+            key = (host.utilization_with(domain), host.vcpu_ratio)
+            if best is None or key < best_key:
+                best, best_key = host, key
+        if best is None:
+            raise PlacementError(f'Domain "{domain.name}" does not fit on any host')
+        best.add(domain)
+        placement[domain.name] = best.name
+    return placement
+
+
+def plan_rebalance(
+    hosts: List[HostCapacity],
+    domains: Dict[str, List[DomainFootprint]],
+    tolerance: float = 0.1,
+    max_utilization: float = 1.0,
+    max_moves: Optional[int] = None,
+) -> List[Tuple[DomainFootprint, str, str]]:
+    """Returns (domain, source, destination) moves which bring host memory utilization within tolerance of each other
+
+    domains maps host names to the domains running on them. Greedy: the most utilized host repeatedly sends the
+    domain closest in size to the ideal transfer to the least utilized host that can take it, every domain moves at
+    most once. Stops once the spread between hosts is within tolerance, no move improves it or max_moves is reached.
+    Hosts are not modified.
+    """
+    planned = {h.name: h.copy() for h in hosts}
+    # Movable domains per host, sorted by memory
+    movable: Dict[str, List[Tuple[int, int, DomainFootprint]]] = {}
+    for host_name, host_domains in domains.items():
+        if host_name in planned:
+            # Index breaks ties between domains of the same size, keeping plans deterministic
+            movable[host_name] = sorted((d.memory, i, d) for i, d in enumerate(host_domains))
+    moves: List[Tuple[DomainFootprint, str, str]] = []
+    # Hosts which cannot send any more domains
+    stuck = set()
+    while max_moves is None or len(moves) < max_moves:
+        by_utilization = sorted(planned.values(), key=lambda h: h.utilization)
+        if by_utilization[-1].utilization - by_utilization[0].utilization <= tolerance:
+            break
+        senders = [h for h in reversed(by_utilization) if h.name not in stuck and movable.get(h.name)]
+        if not senders:
+            break
+        src = senders[0]
+        move = _best_move(src, movable[src.name], by_utilization, max_utilization)
+        if move is None:
+            stuck.add(src.name)
+            continue
+        index, dst = move
+        domain = movable[src.name].pop(index)[2]
+        src.remove(domain)
+        dst.add(domain)
+        moves.append((domain, src.name, dst.name))
+    return moves
+
+
+def _best_move(
+    src: HostCapacity,
+    candidates: List[Tuple[int, int, DomainFootprint]],
+    by_utilization: List[HostCapacity],
+    max_utilization: float,
+) -> Optional[Tuple[int, HostCapacity]]:
+    """Returns the index of the domain to move from src and its destination, if any move reduces imbalance"""
+    for dst in by_utilization:
+        if dst.utilization >= src.utilization:
+            break
+        gap = src.utilization - dst.utilization
+        # Memory which would leave both hosts equally utilized
+        ideal = gap / (1 / src.memory_total + 1 / dst.memory_total)
+        pos = bisect.bisect_left(candidates, (ideal,))
+        # The closest larger domain, and the closest smaller domain which fits on dst
+        indexes = [pos] if pos < len(candidates) else []
+        for index in range(pos - 1, -1, -1):
+            if dst.fits(candidates[index][2], max_utilization):
+                indexes.append(index)
+                break
+        best = None
+        best_gap = gap
+        for index in indexes:
+            domain = candidates[index][2]
+            if not dst.fits(domain, max_utilization):
+                continue
+            new_gap = abs((src.memory_used - domain.memory) / src.memory_total - dst.utilization_with(domain))
+            if new_gap < best_gap:
+                best, best_gap = index, new_gap
+        if best is not None:
+            return best, dst
+    return None
+
+
+def apply_moves(hosts: List[HostCapacity], moves: List[Tuple[DomainFootprint, str, str]]) -> Dict[str, HostCapacity]:
+    """Returns copies of hosts with each (domain, source, destination) move applied"""
+    planned = {h.name: h.copy() for h in hosts}
+    for domain, src, dst in moves:
+        if src in planned:
+            planned[src].remove(domain)
+        if dst in planned:
+            planned[dst].add(domain)
+    return planned
+
+
+def format_plan(
+    moves: List[Tuple[DomainFootprint, str, str]],
+    hosts_before: List[HostCapacity],
+    hosts_after: Dict[str, HostCapacity],
+) -> str:
+    """Returns a human readable table of planned moves and the resulting host memory utilization"""
+    lines = ['Domain migrations:']
+    name_width = max([len(d.name) for d, _, _ in moves] + [6])
+    for domain, src, dst in moves:
+        lines.append(f'  {domain.name:<{name_width}}  {src} -> {dst}  ({domain.memory / 1024 ** 3:.1f} GiB, {domain.vcpus} vCPUs)')
+    lines.append('Host memory utilization:')
+    host_width = max([len(h.name) for h in hosts_before] + [4])
+    for host in hosts_before:
+        after = hosts_after.get(host.name, host)
+        lines.append(f'  {host.name:<{host_width}}  {host.utilization:6.1%} -> {after.utilization:6.1%}')
+    return '\n'.join(lines)
@@ -0,0 +1,71 @@
+import argparse
+import logging
+from typing import Dict, List, Optional
+
+from .evacuate import capacity_from_stats
+from .migrate import MigrationTask, build_tasks, run_tasks
+from .placement import DomainFootprint, apply_moves, format_plan, plan_rebalance
+from .utils import Config, ConnectionPool
+from .utils.domains import DomainRecord
+from .utils.probe import snapshot_hosts
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOLERANCE = 0.1
+
+
+def launch_rebalance(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    if args.group not in config.groups:
+        raise Exception(f'Group "{args.group}" not found in configuration')
+    if getattr(args, 'parallel', 1) < 1:
+        raise Exception('Number of parallel migrations must be at least 1')
+    if not 0 <= args.tolerance <= 1:
+        raise Exception('Tolerance must be between 0 and 1')
+    if args.max_moves is not None and args.max_moves < 1:
+        raise Exception('Maximum number of migrations must be at least 1')
+
+    if pool is None:
+        with ConnectionPool() as pool:
+            return _launch_rebalance(args, config, pool)
+    return _launch_rebalance(args, config, pool)
+
+
+def _launch_rebalance(args: argparse.Namespace, config: Config, pool: ConnectionPool):
+    hosts = [h for h in config.hosts.values() if h.group == args.group]
+    snapshots = snapshot_hosts(hosts, pool)
+    if len(snapshots) < 2:
+        raise Exception(f'Group "{args.group}" needs at least 2 reachable hosts to rebalance')
+
+    capacities = [capacity_from_stats(s.stats) for s in snapshots.values()]
+    footprints: Dict[str, List[DomainFootprint]] = {}
+    records: Dict[int, DomainRecord] = {}
+    for name, snapshot in snapshots.items():
+        footprints[name] = []
+        for record in snapshot.domains:
+            footprint = DomainFootprint(record.name, record.memory, record.vcpus)
+            footprints[name].append(footprint)
+            records[id(footprint)] = record
+
+    moves = plan_rebalance(
+        capacities,
+        footprints,
+        tolerance=args.tolerance,
+        max_utilization=args.max_utilization,
+        max_moves=args.max_moves,
+    )
+    if not moves:
+        logger.info('Group "%s" is balanced within %.0f%%, nothing to do', args.group, args.tolerance * 100)
+        return
+    plan = format_plan(moves, capacities, apply_moves(capacities, moves))
+    if args.dry_run:
+        print(plan)
+        return
+    logger.info('Rebalancing group "%s" with %d migrations\n%s', args.group, len(moves), plan)
+
+    tasks: List[MigrationTask] = []
+    for src_name in snapshots:
+        assignments = [(records[id(d)], config.hosts[dst]) for d, src, dst in moves if src == src_name]
+        if assignments:
+            tasks.extend(build_tasks(config, pool, config.hosts[src_name], assignments))
+    return run_tasks(args, config, tasks)
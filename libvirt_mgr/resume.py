@@ -0,0 +1,135 @@
+import argparse
+import datetime
+import logging
+from typing import List, Optional, Union
+
+from .migrate import (STATUS_FAILED, STATUS_MIGRATED, MigrationResult, MigrationTask, build_tasks, record_moves,
+                      run_tasks, start_after_migration)
+from .utils import Config, ConnectionPool, HostConfig
+from .utils.domains import DomainRecord
+from .utils.journal import PHASE_FAILED, PHASE_MIGRATED, Journal, JournalEntry, open_journal
+from .utils.lazy import libvirt
+
+
+logger = logging.getLogger(__name__)
+
+
+def launch_resume(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    with open_journal(getattr(args, 'journal', None)) as journal:
+        # Failed migrations may have left their domain stopped, they are checked but not retried
+        entries = [e for e in journal.entries.values()
+                   if not journal.is_finished(e) or (e.phase == PHASE_FAILED and e.active)]
+        if not entries:
+            logger.info('No unfinished batch in journal %s', journal.path)
+            return []
+        if pool is None:
+            with ConnectionPool() as pool:
+                return _launch_resume(args, config, pool, journal, entries)
+        return _launch_resume(args, config, pool, journal, entries)
+
+
+def _launch_resume(
+    args: argparse.Namespace,
+    config: Config,
+    pool: ConnectionPool,
+    journal: Journal,
+    entries: List[JournalEntry],
+) -> List[MigrationResult]:
+    batch = journal.batch
+    started = datetime.datetime.fromtimestamp(batch['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+    logger.info('Resuming "%s" batch started at %s, %d domains to check', batch.get('command'), started, len(entries))
+    # Continue with the options of the interrupted batch
+    args.no_stop = not batch.get('auto_stop', True)
+    args.no_start = not batch.get('auto_start', True)
+
+    results: List[MigrationResult] = []
+    tasks: List[MigrationTask] = []
+    for entry in entries:
+        outcome = reconcile_entry(config, pool, journal, entry, not args.no_start)
+        if isinstance(outcome, MigrationTask):
+            tasks.append(outcome)
+        elif outcome is not None:
+            results.append(outcome)
+    record_moves(args, results)
+    if tasks:
+        logger.info('Migrating %d remaining domains', len(tasks))
+        results.extend(run_tasks(args, config, tasks, journal))
+    return results
+
+
+def get_host(config: Config, name: str) -> HostConfig:
+    host = config.hosts.get(name)
+    if host is None:
+        raise Exception(f'Host "{name}" from the journal not found in configuration')
+    return host
+
+
+def lookup_uuid(conn: 'libvirt.virConnect', uuid: str) -> Optional['libvirt.virDomain']:
+    try:
+        return conn.lookupByUUIDString(uuid)
+    except libvirt.libvirtError:
+        return None
+
+
+def reconcile_entry(
+    config: Config,
+    pool: ConnectionPool,
+    journal: Journal,
+    entry: JournalEntry,
+    auto_start: bool,
+) -> Union[MigrationResult, MigrationTask, None]:
+    """Compares a journal entry with where the domain actually is
+
+    Returns a result if nothing is left to migrate and a task if the domain still has to be migrated. Failed entries
+    only have their domain started again if it was left stopped, on the destination if it was migrated. None is
+    returned for them unless they were migrated.
+    """
+    src_host, dst_host = get_host(config, entry.src_host), get_host(config, entry.dst_host)
+    src_dom = lookup_uuid(pool.get(src_host), entry.uuid)
+    dst_dom = lookup_uuid(pool.get(dst_host), entry.uuid)
+    src_active = src_dom is not None and bool(src_dom.isActive())
+    dst_active = dst_dom is not None and bool(dst_dom.isActive())
+
+    if src_active and dst_active:
+        # Left unfinished in the journal, so the next resume checks it again
+        error = 'running on both hosts, a migration may still be in progress'
+        logger.error('"%s" is %s', entry.name, error)
+        return MigrationResult(entry.name, src_host.name, dst_host.name, STATUS_FAILED, error=error)
+
+    # Gone from the source, or kept there but running on the destination
+    if dst_dom is not None and (src_dom is None or dst_active):
+        if entry.phase == PHASE_FAILED:
+            if dst_active or not entry.active:
+                return None
+            # Migrated but could not be started
+            logger.warning('Starting "%s" on "%s", it was migrated but not started', entry.name, dst_host.name)
+            start_after_migration(dst_dom, entry.uuid, journal)
+            return MigrationResult(entry.name, src_host.name, dst_host.name, STATUS_MIGRATED)
+        logger.info('"%s" was migrated to "%s" before the interruption', entry.name, dst_host.name)
+        if entry.phase != PHASE_MIGRATED:
+            journal.record(entry.uuid, PHASE_MIGRATED)
+        if entry.offline and auto_start:
+            start_after_migration(dst_dom, entry.uuid, journal)
+        return MigrationResult(entry.name, src_host.name, dst_host.name, STATUS_MIGRATED)
+
+    if src_dom is None:
+        if entry.phase == PHASE_FAILED:
+            return None
+        error = 'not found on source or destination'
+        logger.error('"%s" was %s when interrupted but is %s, check it manually', entry.name, entry.phase, error)
+        journal.record(entry.uuid, PHASE_FAILED, error)
+        return MigrationResult(entry.name, src_host.name, dst_host.name, STATUS_FAILED, error=error)
+
+    domain = DomainRecord(src_dom, active=src_active)
+    if entry.phase == PHASE_FAILED:
+        if entry.active and not domain.active:
+            logger.warning('Starting "%s" on "%s", its migration failed', entry.name, src_host.name)
+            src_dom.create()
+        return None
+    if entry.active and not domain.active and not entry.offline:
+        # Stopped by a failed live migration, it has to run to be live migrated
+        logger.warning('Starting "%s" on "%s", it was running before the interruption', entry.name, src_host.name)
+        src_dom.create()
+        domain.active = True
+    logger.info('"%s" was %s when interrupted, migrating it again', entry.name, entry.phase)
+    return build_tasks(config, pool, src_host, [(domain, dst_host)])[0]
@@ -0,0 +1,244 @@
+import argparse
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .evacuate import DEFAULT_MAX_UTILIZATION, capacity_from_stats
+from .migrate import STATUS_MIGRATED, MigrationResult, MigrationTask, build_tasks, run_tasks
+from .placement import DomainFootprint, HostCapacity, PlacementError, plan_evacuation
+from .utils import Config, ConnectionPool, HostConfig
+from .utils.domains import DomainRecord
+from .utils.lazy import libvirt
+from .utils.probe import snapshot_hosts
+from .utils.selector import DomainSelector
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOOK_TIMEOUT = 3600
+DEFAULT_RECONNECT_TIMEOUT = 900
+# Seconds between connection attempts while waiting for a host to come back
+RECONNECT_INTERVAL = 5
+
+
+def launch_rolling(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    if args.group not in config.groups:
+        raise Exception(f'Group "{args.group}" not found in configuration')
+    hosts = sorted((h for h in config.hosts.values() if h.group == args.group), key=lambda h: h.name)
+    if args.max_hosts_down < 1:
+        raise Exception('Maximum number of hosts down must be at least 1')
+    if args.max_hosts_down >= len(hosts):
+        raise Exception(f'Group "{args.group}" has {len(hosts)} hosts, at least one has to stay up')
+    if getattr(args, 'parallel', 1) < 1:
+        raise Exception('Number of parallel migrations must be at least 1')
+
+    waves = plan_waves(hosts, args.max_hosts_down)
+    if args.dry_run:
+        for i, wave in enumerate(waves, start=1):
+            print(f'Wave {i}: {", ".join(h.name for h in wave)}')
+        return
+    if pool is None:
+        with ConnectionPool() as pool:
+            return _launch_rolling(args, config, pool, hosts, waves)
+    return _launch_rolling(args, config, pool, hosts, waves)
+
+
+def plan_waves(hosts: List[HostConfig], max_down: int) -> List[List[HostConfig]]:
+    """Splits hosts into waves of at most max_down hosts, which are drained and serviced together"""
+    return [hosts[i:i + max_down] for i in range(0, len(hosts), max_down)]
+
+
+def _launch_rolling(
+    args: argparse.Namespace,
+    config: Config,
+    pool: ConnectionPool,
+    hosts: List[HostConfig],
+    waves: List[List[HostConfig]],
+) -> List[MigrationResult]:
+    results: List[MigrationResult] = []
+    for i, wave in enumerate(waves, start=1):
+        names = ', '.join(f'"{h.name}"' for h in wave)
+        logger.info('Wave %d of %d: draining %s', i, len(waves), names)
+        # Domains moved to hosts of later waves would have to move again
+        serviced = [h for w in waves[:i - 1] for h in w]
+        pending = [h for w in waves[i:] for h in w]
+        drained, wave_results = drain_hosts(args, config, pool, wave, serviced, pending)
+        results.extend(wave_results)
+        hooked = run_hooks(args.hook, drained, args.hook_timeout)
+        back = wait_for_hosts(pool, hooked, args.reconnect_delay, args.reconnect_timeout)
+        if args.move_back and back:
+            results.extend(move_back(args, config, pool, back, wave_results))
+        # Stop before taking more hosts down, failed ones may still be down or hold domains
+        failed = [h.name for h in wave if h not in back]
+        if failed:
+            raise Exception(f'Rolling maintenance of group "{args.group}" stopped after wave {i}, '
+                            f'check {", ".join(failed)}')
+        logger.info('Wave %d of %d done: %s', i, len(waves), names)
+    logger.info('Rolling maintenance of group "%s" finished', args.group)
+    return results
+
+
+def drain_hosts(
+    args: argparse.Namespace,
+    config: Config,
+    pool: ConnectionPool,
+    wave: List[HostConfig],
+    serviced: List[HostConfig],
+    pending: List[HostConfig],
+) -> Tuple[List[HostConfig], List[MigrationResult]]:
+    """Migrates all running domains off the hosts in wave, returns the hosts left empty and results
+
+    Domains go to already serviced hosts, and only to hosts still to be serviced if they do not fit. All domains are
+    migrated in a single batch, so --parallel caps concurrent migrations across all drained hosts.
+    """
+    snapshots = snapshot_hosts(wave + serviced + pending, pool)
+    serviced_capacities = [capacity_from_stats(snapshots[h.name].stats) for h in serviced if h.name in snapshots]
+    pending_capacities = [capacity_from_stats(snapshots[h.name].stats) for h in pending if h.name in snapshots]
+    if not serviced_capacities and not pending_capacities:
+        raise Exception(f'No hosts of group "{args.group}" are reachable to drain onto')
+    drainable: List[HostConfig] = []
+    tasks: List[MigrationTask] = []
+    for host in wave:
+        if host.name not in snapshots:
+            logger.error('Cannot drain host "%s", it is unreachable', host.name)
+            continue
+        domains = snapshots[host.name].domains
+        try:
+            moves = plan_drain_moves(domains, serviced_capacities, pending_capacities, args.max_utilization)
+        except PlacementError as e:
+            logger.error('Cannot drain host "%s": %s', host.name, e)
+            continue
+        # Later hosts of the wave have to fit on what is left
+        for domain, capacity in moves:
+            capacity.add(DomainFootprint(domain.name, domain.memory, domain.vcpus))
+        if moves:
+            tasks.extend(build_tasks(config, pool, host, [(d, config.hosts[c.name]) for d, c in moves]))
+        drainable.append(host)
+    results = run_tasks(args, config, tasks) if tasks else []
+    failed = {r.src_host for r in results if r.status != STATUS_MIGRATED}
+    for name in failed:
+        logger.error('Host "%s" was not drained completely', name)
+    return [h for h in drainable if h.name not in failed], results
+
+
+def plan_drain_moves(
+    domains: List[DomainRecord],
+    serviced: List[HostCapacity],
+    pending: List[HostCapacity],
+    max_utilization: float = DEFAULT_MAX_UTILIZATION,
+) -> List[Tuple[DomainRecord, HostCapacity]]:
+    """Returns the destination for every domain, raises PlacementError if they do not all fit
+
+    Domains are placed largest first on serviced hosts, those which do not fit there on pending hosts. Capacities are
+    not modified.
+    """
+    planned = {c.name: c.copy() for c in serviced + pending}
+    by_name = {c.name: c for c in serviced + pending}
+    moves: List[Tuple[DomainRecord, HostCapacity]] = []
+    for domain in sorted(domains, key=lambda d: (d.memory or 0, d.vcpus or 0), reverse=True):
+        footprint = DomainFootprint(domain.name, domain.memory, domain.vcpus)
+        for tier in (serviced, pending):
+            try:
+                name = plan_evacuation([footprint], [planned[c.name] for c in tier], max_utilization)[domain.name]
+            except PlacementError:
+                continue
+            if tier is pending and serviced:
+                logger.info('"%s" does not fit on serviced hosts, moving it to "%s"', domain.name, name)
+            planned[name].add(footprint)
+            moves.append((domain, by_name[name]))
+            break
+        else:
+            raise PlacementError(f'Domain "{domain.name}" does not fit on any host')
+    return moves
+
+
+def run_hook(hook: str, host: HostConfig, timeout: Optional[float] = DEFAULT_HOOK_TIMEOUT) -> bool:
+    """Runs the hook command for a drained host, returns whether it succeeded
+
+    The host's name and URI are passed in the VIRTMGR_HOST and VIRTMGR_URI environment variables.
+    """
+    env = dict(os.environ, VIRTMGR_HOST=host.name, VIRTMGR_URI=host.uri)
+    logger.info('Running hook for "%s": %s', host.name, hook)
+    try:
+        proc = subprocess.run(hook, shell=True, env=env, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.error('Hook for "%s" did not finish within %ss', host.name, timeout)
+        return False
+    if proc.returncode != 0:
+        logger.error('Hook for "%s" failed with exit code %d', host.name, proc.returncode)
+        return False
+    return True
+
+
+def run_hooks(hook: str, hosts: List[HostConfig], timeout: Optional[float] = DEFAULT_HOOK_TIMEOUT) -> List[HostConfig]:
+    """Runs the hook for all hosts concurrently, returns those for which it succeeded"""
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        ok = list(executor.map(lambda h: run_hook(hook, h, timeout), hosts))
+    return [h for h, success in zip(hosts, ok) if success]
+
+
+def wait_for_host(pool: ConnectionPool, host: HostConfig, timeout: float) -> bool:
+    """Reconnects to host until it succeeds or timeout seconds have passed"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            pool.get(host)
+            return True
+        except libvirt.libvirtError as e:
+            if time.monotonic() + RECONNECT_INTERVAL > deadline:
+                logger.error('Host "%s" did not come back within %ss: %s', host.name, timeout, e)
+                return False
+            logger.debug('Host "%s" is not back yet: %s', host.name, e)
+        time.sleep(RECONNECT_INTERVAL)
+
+
+def wait_for_hosts(
+    pool: ConnectionPool,
+    hosts: List[HostConfig],
+    delay: float = 0,
+    timeout: float = DEFAULT_RECONNECT_TIMEOUT,
+) -> List[HostConfig]:
+    """Waits for serviced hosts to accept connections again, after delay seconds, returns those which did"""
+    if not hosts:
+        return []
+    # Connections opened before the hook are dead if it rebooted the host
+    for host in hosts:
+        pool.close(host)
+    if delay:
+        time.sleep(delay)
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        back = list(executor.map(lambda h: wait_for_host(pool, h, timeout), hosts))
+    for host, ok in zip(hosts, back):
+        if ok:
+            logger.info('Host "%s" is back', host.name)
+    return [h for h, ok in zip(hosts, back) if ok]
+
+
+def move_back(
+    args: argparse.Namespace,
+    config: Config,
+    pool: ConnectionPool,
+    hosts: List[HostConfig],
+    results: List[MigrationResult],
+) -> List[MigrationResult]:
+    """Migrates domains drained off hosts back to them from wherever they were migrated to"""
+    names = {h.name for h in hosts}
+    by_dst: Dict[str, Dict[str, str]] = {}
+    for r in results:
+        if r.status == STATUS_MIGRATED and r.src_host in names:
+            by_dst.setdefault(r.dst_host, {})[r.name] = r.src_host
+    tasks: List[MigrationTask] = []
+    for dst_name, origins in by_dst.items():
+        dst_host = config.hosts[dst_name]
+        # One call finds all domains to move back from this host
+        domains = DomainSelector(list(origins)).select(pool.get(dst_host))
+        tasks.extend(build_tasks(config, pool, dst_host, [(d, config.hosts[origins[d.name]]) for d in domains]))
+    if not tasks:
+        return []
+    logger.info('Moving %d domains back to %s', len(tasks), ', '.join(f'"{n}"' for n in sorted(names)))
+    return run_tasks(args, config, tasks)
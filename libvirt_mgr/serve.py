@@ -0,0 +1,475 @@
+import argparse
+import http.server
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .migrate import DEFAULT_LOOKAHEAD, MigrationResult, launch_migrate
+from .status import DomainStatus, get_host_status, get_status_flags, print_statuses, select_hosts
+from .utils import Config, ConnectionPool, HostConfig
+from .utils.inventory import Inventory, open_inventory
+from .utils.estimate import ORDER_SHORTEST
+from .utils.lazy import libvirt
+from .utils.monitor import DEFAULT_PROGRESS_INTERVAL, summarize_job_stats
+from .utils.probe import DEFAULT_PROBE_TIMEOUT, run_on_hosts
+from .utils.profile import escape_label, get_profiler
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SWEEP_INTERVAL = 60
+DEFAULT_METRICS_ADDRESS = '127.0.0.1:9710'
+# LIBVIRT_MGR_SOCKET overrides it
+DEFAULT_SOCKET_PATH = '/run/libvirt-mgr/virtmgr.sock'
+# Commands a server runs for clients, list is answered from the cache
+SERVER_COMMANDS: Dict[str, Callable] = {'migrate': launch_migrate}
+_LIST_OPTIONS = {'group': None, 'host': None}
+# Options clients may set for each command with their defaults, anything else is rejected. Paths of files the server
+# writes, such as the journal, always come from the server's own command line.
+SERVER_OPTIONS: Dict[str, Dict[str, Any]] = {
+    'list': _LIST_OPTIONS,
+    'status': _LIST_OPTIONS,
+    'migrate': {
+        'src_host': None, 'name': None, 'all': False, 'dst_host': None, 'dst_group': None, 'state': None,
+        'min_memory': None, 'max_memory': None, 'min_vcpus': None, 'max_vcpus': None, 'tag': None,
+        'no_start': False, 'no_stop': False, 'parallel': 1, 'lookahead': DEFAULT_LOOKAHEAD, 'order': ORDER_SHORTEST,
+        'measure_dirty_rates': False, 'no_preflight': False, 'progress_interval': DEFAULT_PROGRESS_INTERVAL,
+    },
+}
+# Options of the server's command line passed on to every command
+SERVER_PATHS = ('inventory', 'journal', 'estimates')
+
+
+class HostState:
+    """Cached domains of a host and how fresh they are"""
+    __slots__ = ('name', 'up', 'last_sweep', 'sweep_duration', 'domains')
+
+    def __init__(self, name: str):
+        self.name = name
+        # Whether the last sweep succeeded
+        self.up = False
+        # Unix timestamp and duration in seconds of the last successful sweep
+        self.last_sweep: Optional[float] = None
+        self.sweep_duration: Optional[float] = None
+        # Statuses by UUID
+        self.domains: Dict[str, DomainStatus] = {}
+
+
+class DomainCache:
+    """Latest known status of every domain, fed by periodic sweeps and domain events, reading it costs no RPCs"""
+
+    def __init__(self, hosts: List[str]):
+        self._lock = threading.Lock()
+        self.hosts: Dict[str, HostState] = {name: HostState(name) for name in hosts}
+        # Summarized stats of the last completed job of each domain by UUID, with its host and name
+        self.jobs: Dict[str, Tuple[str, str, Dict[str, Any]]] = {}
+
+    def replace_host(self, host: str, statuses: List[DomainStatus], duration: float):
+        with self._lock:
+            state = self.hosts[host]
+            state.up = True
+            state.last_sweep = time.time()
+            state.sweep_duration = duration
+            state.domains = {s.uuid: s for s in statuses}
+
+    def mark_down(self, host: str):
+        with self._lock:
+            self.hosts[host].up = False
+
+    def update(self, status: DomainStatus):
+        with self._lock:
+            self.hosts[status.host].domains[status.uuid] = status
+
+    def remove(self, host: str, uuid: str):
+        with self._lock:
+            self.hosts[host].domains.pop(uuid, None)
+
+    def set_job(self, host: str, name: str, uuid: str, summary: Dict[str, Any]):
+        with self._lock:
+            self.jobs[uuid] = (host, name, summary)
+
+    def statuses(self, hosts: Optional[List[str]] = None) -> List[DomainStatus]:
+        """Returns cached statuses sorted by host and name"""
+        with self._lock:
+            states = [self.hosts[h] for h in hosts or self.hosts]
+            return [s for state in states for s in sorted(state.domains.values(), key=lambda s: s.name)]
+
+    def unreachable(self, hosts: Optional[List[str]] = None) -> List[str]:
+        with self._lock:
+            return [h for h in hosts or self.hosts if not self.hosts[h].up]
+
+    def format_metrics(self) -> str:
+        """Returns the cache in the Prometheus text format"""
+        metrics: Dict[str, Tuple[str, str, List[str]]] = {}
+
+        def _add(name: str, kind: str, help_text: str, labels: Dict[str, str], value):
+            if value is None:
+                return
+            label_str = ','.join(f'{k}="{escape_label(str(v))}"' for k, v in labels.items())
+            metrics.setdefault(name, (kind, help_text, []))[2].append(f'{name}{{{label_str}}} {value}')
+
+        with self._lock:
+            for state in self.hosts.values():
+                labels = {'host': state.name}
+                _add('libvirt_mgr_host_up', 'gauge', 'Whether the last sweep of the host succeeded', labels, int(state.up))
+                _add('libvirt_mgr_host_last_sweep_timestamp_seconds', 'gauge', 'Time of the last successful sweep',
+                     labels, state.last_sweep)
+                _add('libvirt_mgr_host_sweep_duration_seconds', 'gauge', 'Duration of the last successful sweep',
+                     labels, state.sweep_duration)
+                _add('libvirt_mgr_host_domains', 'gauge', 'Domains defined on the host', labels, len(state.domains))
+                for s in state.domains.values():
+                    labels = {'host': s.host, 'domain': s.name, 'uuid': s.uuid}
+                    _add('libvirt_mgr_domain_info', 'gauge', 'Domain state, always 1', {**labels, 'state': s.state}, 1)
+                    _add('libvirt_mgr_domain_active', 'gauge', 'Whether the domain is running', labels, int(s.active))
+                    _add('libvirt_mgr_domain_vcpus', 'gauge', 'Current vCPUs', labels, s.vcpus)
+                    _add('libvirt_mgr_domain_memory_bytes', 'gauge', 'Maximum memory', labels, s.memory)
+                    _add('libvirt_mgr_domain_balloon_bytes', 'gauge', 'Current balloon size', labels, s.balloon)
+                    _add('libvirt_mgr_domain_block_read_bytes_total', 'counter', 'Bytes read from all disks', labels,
+                         s.block_read)
+                    _add('libvirt_mgr_domain_block_written_bytes_total', 'counter', 'Bytes written to all disks',
+                         labels, s.block_write)
+                    _add('libvirt_mgr_domain_disk_capacity_bytes', 'gauge', 'Capacity of all disks', labels,
+                         s.disk_capacity)
+                    _add('libvirt_mgr_domain_disk_allocation_bytes', 'gauge', 'Allocation of all disks', labels,
+                         s.disk_allocation)
+            for uuid, (host, name, summary) in self.jobs.items():
+                labels = {'host': host, 'domain': name, 'uuid': uuid}
+                _add('libvirt_mgr_domain_last_job_seconds', 'gauge', 'Duration of the last completed job', labels,
+                     summary['elapsed'])
+                _add('libvirt_mgr_domain_last_job_downtime_seconds', 'gauge',
+                     'Downtime of the last completed migration', labels, summary['downtime'])
+                _add('libvirt_mgr_domain_last_job_processed_bytes', 'gauge', 'Data sent by the last completed job',
+                     labels, summary['data_processed'])
+
+        lines = []
+        for name, (kind, help_text, samples) in metrics.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+class Server:
+    """Long running process keeping connections to all hosts and a DomainCache up to date
+
+    The cache is served as Prometheus metrics over HTTP, and clients send commands as JSON lines over a Unix socket.
+    Commands which migrate domains run one at a time, so group migration limits hold across clients.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        pool: ConnectionPool,
+        sweep_interval: float = DEFAULT_SWEEP_INTERVAL,
+        timeout: float = DEFAULT_PROBE_TIMEOUT,
+        inventory: Optional[Inventory] = None,
+        paths: Optional[Dict[str, Optional[str]]] = None,
+    ):
+        self.config = config
+        self.pool = pool
+        self.sweep_interval = sweep_interval
+        self.timeout = timeout
+        # Updated after every sweep, if given
+        self.inventory = inventory
+        # Files commands use instead of the defaults, by SERVER_PATHS option
+        self.paths = {k: (paths or {}).get(k) for k in SERVER_PATHS}
+        self.cache = DomainCache(list(config.hosts))
+        self._stop = threading.Event()
+        self._command_lock = threading.Lock()
+        # Event callbacks by host name, registered again when the pool reconnects
+        self._callbacks: Dict[str, Tuple['libvirt.virConnect', List[int]]] = {}
+        self._callbacks_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._servers: List[socketserver.BaseServer] = []
+        self._socket_path: Optional[str] = None
+        # Hosts whose sweep has not returned yet, a hung host gets no further sweeps until it does
+        self._sweeping: Set[str] = set()
+        self._sweeping_lock = threading.Lock()
+
+    def _connect(self, host: HostConfig) -> 'libvirt.virConnect':
+        """Returns the connection to host, subscribing to its domain events if it is new"""
+        conn = self.pool.get(host)
+        with self._callbacks_lock:
+            registered = self._callbacks.get(host.name)
+            if registered is not None and registered[0] is conn:
+                return conn
+            callback_ids = [
+                conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle_callback,
+                                            host.name),
+                conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_JOB_COMPLETED, self._job_callback,
+                                            host.name),
+            ]
+            self._callbacks[host.name] = (conn, callback_ids)
+        logger.debug('Subscribed to domain events of "%s"', host.name)
+        return conn
+
+    def _lifecycle_callback(self, _conn, dom, event, _detail, host_name):
+        self._queue.put((host_name, dom, event, None))
+
+    def _job_callback(self, _conn, dom, params, host_name):
+        self._queue.put((host_name, dom, None, params))
+
+    def _run_events(self):
+        # Refreshing a domain requires RPCs, which cannot be made from the event loop thread
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            host_name, dom, event, params = item
+            try:
+                self._handle_event(host_name, dom, event, params)
+            except libvirt.libvirtError as e:
+                logger.warning('Cannot refresh domain after event on "%s": %s', host_name, e)
+            except Exception as e:
+                logger.error('Cannot handle domain event on "%s"', host_name, exc_info=e)
+
+    def _handle_event(self, host_name: str, dom: 'libvirt.virDomain', event: Optional[int], params: Optional[Dict]):
+        if params is not None:
+            self.cache.set_job(host_name, dom.name(), dom.UUIDString(), summarize_job_stats(params))
+            return
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.cache.remove(host_name, dom.UUIDString())
+            return
+        stats = dom.connect().domainListGetStats([dom], get_status_flags())
+        if not stats:
+            # Transient domains are gone once stopped
+            self.cache.remove(host_name, dom.UUIDString())
+            return
+        self.cache.update(DomainStatus.from_stats(host_name, *stats[0]))
+        logger.debug('Refreshed "%s" on "%s" after event %d', dom.name(), host_name, event)
+
+    def sweep(self) -> List[str]:
+        """Replaces the cached domains of every host with a getAllDomainStats call each, returns hosts which failed
+
+        Hosts still busy with a previous sweep are skipped and count as failed.
+        """
+
+        def _sweep(host: HostConfig) -> Tuple[List[DomainStatus], float]:
+            try:
+                start = time.monotonic()
+                statuses = get_host_status(self._connect(host), host.name)
+                return statuses, time.monotonic() - start
+            finally:
+                with self._sweeping_lock:
+                    self._sweeping.discard(host.name)
+
+        hosts = list(self.config.hosts.values())
+        with self._sweeping_lock:
+            busy = [h.name for h in hosts if h.name in self._sweeping]
+            to_sweep = [h for h in hosts if h.name not in self._sweeping]
+            self._sweeping.update(h.name for h in to_sweep)
+        for name in busy:
+            logger.warning('Previous sweep of host "%s" has not returned, skipping it', name)
+        results = run_on_hosts(to_sweep, _sweep, self.timeout)
+        for name, (statuses, duration) in results.items():
+            self.cache.replace_host(name, statuses, duration)
+            if self.inventory is not None:
+                self.inventory.replace_host(name, [s.to_record() for s in statuses])
+        failed = [h.name for h in hosts if h.name not in results]
+        for name in failed:
+            self.cache.mark_down(name)
+        logger.debug('Swept %d hosts, %d failed', len(hosts), len(failed))
+        return failed
+
+    def get_args(self, command: str, options: Dict[str, Any]) -> argparse.Namespace:
+        """Returns the arguments of a client command, only options in SERVER_OPTIONS are accepted"""
+        allowed = SERVER_OPTIONS.get(command)
+        if allowed is None:
+            raise Exception(f'Unknown command "{command}"')
+        if not isinstance(options, dict):
+            raise Exception('Command arguments must be an object')
+        unknown = sorted(set(options) - set(allowed))
+        if unknown:
+            raise Exception(f'Command "{command}" does not accept {", ".join(unknown)}')
+        return argparse.Namespace(command=command, **{**allowed, **options, **self.paths})
+
+    def handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Runs a client command and returns its reply"""
+        command = request.get('command')
+        args = self.get_args(command, request.get('args', {}))
+        if command in ('list', 'status'):
+            hosts = [h.name for h in select_hosts(args, self.config)]
+            statuses = self.cache.statuses(hosts)
+            return {'domains': [s.to_dict() for s in statuses], 'unreachable': self.cache.unreachable(hosts)}
+        launcher = SERVER_COMMANDS[command]
+        with self._command_lock:
+            results = launcher(args, self.config, self.pool) or []
+        return {'results': [r.to_dict() for r in results]}
+
+    def start(self, metrics_address: Optional[str] = DEFAULT_METRICS_ADDRESS, socket_path: Optional[str] = None):
+        """Starts serving metrics and commands in background threads, after a first sweep"""
+        self._start_thread(self._run_events, 'server-events')
+        self.sweep()
+        if metrics_address:
+            host, _, port = metrics_address.rpartition(':')
+            httpd = _MetricsHTTPServer((host or '127.0.0.1', int(port)), _MetricsHandler)
+            httpd.cache = self.cache
+            self._servers.append(httpd)
+            self._start_thread(httpd.serve_forever, 'server-metrics')
+            logger.info('Serving metrics on http://%s:%d/metrics', *httpd.server_address[:2])
+        if socket_path:
+            os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+            if os.path.exists(socket_path):
+                # Left behind by a server which did not exit cleanly
+                os.unlink(socket_path)
+            # Created without access for others, commands run as the server's user
+            umask = os.umask(0o117)
+            try:
+                unix_server = _CommandServer(socket_path, _CommandHandler)
+            finally:
+                os.umask(umask)
+            unix_server.owner = self
+            self._socket_path = socket_path
+            self._servers.append(unix_server)
+            self._start_thread(unix_server.serve_forever, 'server-commands')
+            logger.info('Accepting commands on %s', socket_path)
+
+    def _start_thread(self, target: Callable, name: str):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def run(self):
+        """Sweeps all hosts every sweep_interval seconds until stopped"""
+        while not self._stop.wait(self.sweep_interval):
+            self.sweep()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        """Stops serving and unsubscribes from all hosts"""
+        self._stop.set()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers.clear()
+        if self._socket_path is not None and os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        with self._callbacks_lock:
+            for name, (conn, callback_ids) in self._callbacks.items():
+                for callback_id in callback_ids:
+                    try:
+                        conn.domainEventDeregisterAny(callback_id)
+                    except libvirt.libvirtError as e:
+                        logger.debug('Cannot deregister event callback on "%s": %s', name, e)
+            self._callbacks.clear()
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+
+class _MetricsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    cache: DomainCache
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        text = self.server.cache.format_metrics()
+        profiler = get_profiler()
+        if profiler is not None:
+            text += profiler.format_prometheus()
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logger.debug('%s - %s', self.address_string(), fmt % args)
+
+
+class _CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    owner: Server
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            reply = self.server.owner.handle_request(json.loads(line))
+        except SystemExit as e:
+            reply = {'error': f'Command exited with status {e.code}, see the server log'}
+        except Exception as e:
+            logger.exception('Command failed')
+            reply = {'error': str(e)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+def get_socket_path(path: Optional[str] = None) -> str:
+    return path or os.getenv('LIBVIRT_MGR_SOCKET', DEFAULT_SOCKET_PATH)
+
+
+def request_server(path: str, request: Dict[str, Any]) -> Dict[str, Any]:
+    """Sends a command to a server and returns its reply, waits as long as the command runs"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('r', encoding='utf-8') as f:
+            line = f.readline()
+    if not line:
+        raise Exception(f'Server at {path} closed the connection without replying')
+    reply = json.loads(line)
+    if 'error' in reply:
+        raise Exception(f'Server error: {reply["error"]}')
+    return reply
+
+
+def launch_remote(args: argparse.Namespace, config: Config):
+    """Runs a command on the server at args.server, reusing its connections and cache"""
+    if args.command not in SERVER_COMMANDS and args.command not in ('list', 'status'):
+        raise Exception(f'Command "{args.command}" cannot be run by a server')
+    if getattr(args, 'plan', False):
+        raise Exception('The predicted schedule cannot be printed by a server, run --plan without --server')
+    path = get_socket_path(args.server)
+    request_args = {k: v for k, v in vars(args).items() if k in SERVER_OPTIONS[args.command]}
+    reply = request_server(path, {'command': args.command, 'args': request_args})
+    if 'domains' in reply:
+        statuses = [DomainStatus(None, **d) for d in reply['domains']]
+        print_statuses(args, statuses, reply['unreachable'])
+        return statuses, reply['unreachable']
+    results = [MigrationResult(**r) for r in reply['results']]
+    for r in results:
+        if r.error:
+            logger.error('"%s" %s migrating from "%s" to "%s": %s', r.name, r.status, r.src_host, r.dst_host, r.error)
+        elif r.start_error:
+            logger.error('"%s" migrated to "%s" but cannot be started there: %s', r.name, r.dst_host, r.start_error)
+        else:
+            logger.info('"%s" %s from "%s" to "%s" in %.1fs', r.name, r.status, r.src_host, r.dst_host, r.duration)
+    return results
+
+
+def launch_serve(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    if args.interval <= 0:
+        raise Exception('Sweep interval must be positive')
+    if pool is None:
+        with ConnectionPool() as pool:
+            return launch_serve(args, config, pool)
+    with open_inventory(getattr(args, 'inventory', None)) as inventory:
+        paths = {k: getattr(args, k, None) for k in SERVER_PATHS}
+        server = Server(config, pool, args.interval, args.timeout, inventory, paths)
+        signal.signal(signal.SIGTERM, lambda *_: server.stop())
+        try:
+            server.start(args.listen, get_socket_path(args.socket))
+            server.run()
+        except KeyboardInterrupt:
+            logger.info('Interrupted, shutting down')
+        finally:
+            server.close()
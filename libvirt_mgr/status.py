@@ -0,0 +1,170 @@
+import argparse
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from .utils import Config, ConnectionPool, HostConfig
+from .utils.domains import DomainRecord
+from .utils.inventory import open_inventory
+from .utils.lazy import libvirt
+from .utils.libvirt import get_state_name
+from .utils.monitor import format_size, format_table
+from .utils.probe import DEFAULT_PROBE_TIMEOUT, run_on_hosts
+
+
+logger = logging.getLogger(__name__)
+
+
+class DomainStatus:
+    """State and resource usage of a domain, from a single getAllDomainStats entry"""
+    __slots__ = ('dom', 'host', 'name', 'uuid', 'state', 'vcpus', 'memory', 'balloon', 'block_read', 'block_write',
+                 'disk_capacity', 'disk_allocation')
+
+    def __init__(
+        self,
+        dom: 'libvirt.virDomain',
+        host: str,
+        name: str,
+        uuid: str,
+        state: str,
+        vcpus: Optional[int] = None,
+        memory: Optional[int] = None,
+        balloon: Optional[int] = None,
+        block_read: int = 0,
+        block_write: int = 0,
+        disk_capacity: int = 0,
+        disk_allocation: int = 0,
+    ):
+        self.dom = dom
+        self.host = host
+        self.name = name
+        self.uuid = uuid
+        self.state = state
+        self.vcpus = vcpus
+        # Maximum and current balloon memory in bytes
+        self.memory = memory
+        self.balloon = balloon
+        # Totals of all block devices in bytes
+        self.block_read = block_read
+        self.block_write = block_write
+        self.disk_capacity = disk_capacity
+        self.disk_allocation = disk_allocation
+
+    def __repr__(self):
+        attrs = []
+        for k in self.__slots__[1:]:
+            attrs.append(f'{k}={repr(getattr(self, k))}')
+        return f'{self.__class__.__name__}({", ".join(attrs)})'
+
+    @property
+    def active(self) -> bool:
+        return self.state not in ('shutoff', 'crashed', 'nostate')
+
+    @classmethod
+    def from_stats(cls, host: str, dom: 'libvirt.virDomain', stats: Dict[str, Any]):
+        ret = cls(dom, host, dom.name(), dom.UUIDString(), get_state_name(stats.get('state.state', 0)))
+        ret.vcpus = stats.get('vcpu.current', stats.get('vcpu.maximum'))
+        if 'balloon.maximum' in stats:
+            ret.memory = stats['balloon.maximum'] * 1024
+        if 'balloon.current' in stats:
+            ret.balloon = stats['balloon.current'] * 1024
+        for i in range(stats.get('block.count', 0)):
+            ret.block_read += stats.get(f'block.{i}.rd.bytes', 0)
+            ret.block_write += stats.get(f'block.{i}.wr.bytes', 0)
+            ret.disk_capacity += stats.get(f'block.{i}.capacity', 0)
+            ret.disk_allocation += stats.get(f'block.{i}.allocation', 0)
+        return ret
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__ if k != 'dom'}
+
+    def to_record(self) -> DomainRecord:
+        record = DomainRecord(self.dom, active=self.active, name=self.name, uuid=self.uuid)
+        record.memory = self.memory
+        record.vcpus = self.vcpus
+        return record
+
+
+def get_status_flags() -> int:
+    """Returns the stats groups needed by DomainStatus"""
+    return (libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON |
+            libvirt.VIR_DOMAIN_STATS_BLOCK)
+
+
+def get_host_status(conn: 'libvirt.virConnect', host: str) -> List[DomainStatus]:
+    """Returns the status of all domains on a host with a single getAllDomainStats call"""
+    return [DomainStatus.from_stats(host, dom, stats) for dom, stats in conn.getAllDomainStats(get_status_flags())]
+
+
+def select_hosts(args: argparse.Namespace, config: Config) -> List[HostConfig]:
+    """Returns hosts matching the group and host filters of the list command"""
+    hosts: List[HostConfig] = list(config.hosts.values())
+    if args.group:
+        if args.group not in config.groups:
+            raise Exception(f'Group "{args.group}" not found in configuration')
+        hosts = [h for h in hosts if h.group == args.group]
+    if args.host:
+        for name in args.host:
+            if name not in config.hosts:
+                raise Exception(f'Host "{name}" not found in configuration')
+        hosts = [h for h in hosts if h.name in args.host]
+    if not hosts:
+        raise Exception('No hosts match the given filters')
+    return hosts
+
+
+def launch_list(args: argparse.Namespace, config: Config, pool: Optional[ConnectionPool] = None):
+    hosts = select_hosts(args, config)
+    if pool is None:
+        with ConnectionPool() as pool:
+            return _launch_list(args, hosts, pool)
+    return _launch_list(args, hosts, pool)
+
+
+def _launch_list(args: argparse.Namespace, hosts: List[HostConfig], pool: ConnectionPool):
+    timeout = getattr(args, 'timeout', DEFAULT_PROBE_TIMEOUT)
+    results = run_on_hosts(hosts, lambda h: get_host_status(pool.get(h), h.name), timeout)
+    unreachable = [h.name for h in hosts if h.name not in results]
+    statuses = [s for h in hosts for s in sorted(results.get(h.name, []), key=lambda s: s.name)]
+
+    # Stats include everything the inventory needs, keep it up to date for free
+    with open_inventory(getattr(args, 'inventory', None)) as inventory:
+        for name, host_statuses in results.items():
+            inventory.replace_host(name, [s.to_record() for s in host_statuses])
+
+    print_statuses(args, statuses, unreachable)
+    return statuses, unreachable
+
+
+def print_statuses(args: argparse.Namespace, statuses: List[DomainStatus], unreachable: List[str]):
+    if args.json:
+        print(json.dumps({'domains': [s.to_dict() for s in statuses], 'unreachable': unreachable}, indent=2))
+    else:
+        print(format_statuses(statuses, unreachable))
+
+
+def format_statuses(statuses: List[DomainStatus], unreachable: List[str]) -> str:
+    """Returns a human readable table of domain statuses, followed by unreachable hosts"""
+
+    def _size(value: Optional[int]) -> str:
+        return format_size(value) if value else '-'
+
+    header = ('HOST', 'NAME', 'STATE', 'VCPUS', 'MEMORY', 'BALLOON', 'DISK', 'DISK USED', 'READ', 'WRITTEN')
+    rows = [header]
+    for s in statuses:
+        rows.append((
+            s.host,
+            s.name,
+            s.state,
+            str(s.vcpus) if s.vcpus is not None else '-',
+            _size(s.memory),
+            _size(s.balloon),
+            _size(s.disk_capacity),
+            _size(s.disk_allocation),
+            _size(s.block_read),
+            _size(s.block_write),
+        ))
+    lines = [format_table(rows)]
+    for name in unreachable:
+        lines.append(f'{name}: unreachable')
+    return '\n'.join(lines)
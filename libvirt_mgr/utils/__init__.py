@@ -1 +1,2 @@
-from .config import Config, HostConfig
+from .config import Config, GroupConfig, HostConfig
+from .connection import ConnectionPool
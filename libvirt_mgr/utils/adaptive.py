@@ -0,0 +1,171 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .config import AdaptiveConfig
+from .lazy import libvirt
+from .monitor import MetricsWriter, format_size, summarize_job_stats
+
+
+logger = logging.getLogger(__name__)
+
+# Remaining data has to drop below this fraction each pre-copy iteration, otherwise max downtime is raised
+CONVERGENCE_RATIO = 0.9
+# Bandwidth changes smaller than this fraction are not applied, saves an RPC on almost every poll
+BANDWIDTH_TOLERANCE = 0.1
+
+
+class LinkUse:
+    """A migration counted by a LinkBudget"""
+    __slots__ = ('peak',)
+
+    def __init__(self):
+        # Most migrations from the host running at once while this one was, itself included
+        self.peak = 1
+
+
+class LinkBudget:
+    """Counts outgoing live migrations of each host, so they can split its link bandwidth evenly"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active: Dict[str, List[LinkUse]] = {}
+
+    @contextmanager
+    def use(self, host: str) -> Iterator[LinkUse]:
+        """Counts a migration from host while the context is active"""
+        usage = LinkUse()
+        with self._lock:
+            users = self._active.setdefault(host, [])
+            users.append(usage)
+            for user in users:
+                user.peak = max(user.peak, len(users))
+        try:
+            yield usage
+        finally:
+            with self._lock:
+                users.remove(usage)
+                if not users:
+                    del self._active[host]
+
+    def active(self, host: str) -> int:
+        with self._lock:
+            return len(self._active.get(host, ()))
+
+
+class AdaptiveController:
+    """Job observer adjusting max downtime and bandwidth of a live migration within group bounds
+
+    Max downtime starts at the minimum and is doubled, or raised to the expected downtime, whenever a pre-copy iteration
+    fails to shrink the remaining data. Bandwidth is capped at the host's share of its link and, with a target time and
+    other migrations sharing the link, lowered to what is needed to finish in time, never below what sends the
+    remaining data within max downtime. Every change is logged and written to metrics.
+    """
+
+    def __init__(
+        self,
+        policy: AdaptiveConfig,
+        name: str,
+        host: str,
+        links: Optional[LinkBudget] = None,
+        metrics: Optional[MetricsWriter] = None,
+    ):
+        self.policy = policy
+        self.domain_name = name
+        # Source host, whose link is shared
+        self.host = host
+        self.links = links or LinkBudget()
+        self.metrics = metrics
+        # Last applied max downtime in milliseconds and bandwidth in MiB/s, None until set
+        self.downtime: Optional[int] = None
+        self.bandwidth: Optional[int] = None
+        self._iteration = 0
+        self._iteration_remaining = 0
+
+    def next_downtime(self, summary: Dict[str, Any]) -> Tuple[Optional[int], str]:
+        """Returns the max downtime to apply and why, None if it should not change"""
+        policy = self.policy
+        iteration = summary['iteration']
+        remaining = summary['data_remaining']
+        previous = None
+        if iteration > self._iteration:
+            if self._iteration:
+                previous = self._iteration_remaining
+            self._iteration, self._iteration_remaining = iteration, remaining
+        if self.downtime is None:
+            return policy.min_downtime, 'starting at the minimum'
+        if previous is None or self.downtime >= policy.max_downtime or remaining < CONVERGENCE_RATIO * previous:
+            return None, ''
+        downtime = self.downtime * 2
+        if summary['expected_downtime'] is not None:
+            downtime = max(downtime, math.ceil(summary['expected_downtime'] * 1000))
+        return (min(downtime, policy.max_downtime),
+                f'iteration {iteration} started with {format_size(remaining)} left, {format_size(previous)} before')
+
+    def next_bandwidth(self, summary: Dict[str, Any]) -> Tuple[Optional[int], str]:
+        """Returns the bandwidth to apply and why, None if it should not change"""
+        policy = self.policy
+        limit, reason = policy.max_bandwidth, f'group limit of {policy.max_bandwidth} MiB/s'
+        if policy.link_bandwidth:
+            count = max(1, self.links.active(self.host))
+            share = max(1, policy.link_bandwidth // count)
+            if limit is None or share < limit:
+                limit, reason = share, f'{count} migrations share {policy.link_bandwidth} MiB/s'
+        if limit is None:
+            return None, ''
+        bandwidth = limit
+        count = self.links.active(self.host) if policy.link_bandwidth else 0
+        # Bandwidth given up is only of use to other migrations sharing the link
+        if policy.target_time is not None and count > 1:
+            left = policy.target_time - summary['elapsed']
+            if left <= 0:
+                reason = f'target time of {policy.target_time}s exceeded, {reason}'
+            else:
+                # Send what is left in time while keeping up with newly dirtied memory, but fast enough for the
+                # remaining data to fit in max downtime so the migration can still converge
+                needed = math.ceil(max(
+                    summary['data_remaining'] / left + summary['dirty_rate'],
+                    summary['data_remaining'] / (policy.max_downtime / 1000),
+                ) / 1024 ** 2)
+                if needed < limit:
+                    bandwidth, reason = needed, f'{needed} MiB/s finishes within {left:.0f}s'
+        if policy.min_bandwidth:
+            bandwidth = max(bandwidth, policy.min_bandwidth)
+        if self.bandwidth is not None and abs(bandwidth - self.bandwidth) <= BANDWIDTH_TOLERANCE * self.bandwidth:
+            return None, ''
+        return bandwidth, reason
+
+    def __call__(self, dom: 'libvirt.virDomain', stats: Dict[str, Any]):
+        summary = summarize_job_stats(stats)
+        downtime, reason = self.next_downtime(summary)
+        if downtime is not None and downtime != self.downtime:
+            dom.migrateSetMaxDowntime(downtime, 0)
+            self._record(summary, 'max_downtime', self.downtime, downtime, 'ms', reason)
+            self.downtime = downtime
+        bandwidth, reason = self.next_bandwidth(summary)
+        if bandwidth is not None and bandwidth != self.bandwidth:
+            dom.migrateSetMaxSpeed(bandwidth, 0)
+            self._record(summary, 'bandwidth', self.bandwidth, bandwidth, ' MiB/s', reason)
+            self.bandwidth = bandwidth
+
+    def _record(self, summary: Dict[str, Any], setting: str, old: Optional[int], new: int, unit: str, reason: str):
+        logger.info(
+            'Setting %s of "%s" to %d%s (was %s), %s; %s remaining, %s/s, dirty %s/s, iteration %d',
+            setting, self.domain_name, new, unit, '-' if old is None else f'{old}{unit}', reason,
+            format_size(summary['data_remaining']), format_size(summary['throughput']),
+            format_size(summary['dirty_rate']), summary['iteration'],
+        )
+        if self.metrics:
+            self.metrics.write({
+                'event': 'decision',
+                'domain': self.domain_name,
+                'timestamp': time.time(),
+                'setting': setting,
+                'old': old,
+                'new': new,
+                'reason': reason,
+                **summary,
+            })
@@ -0,0 +1,9 @@
+class SlotsRepr:
+    """Represents instances by the values of their slots"""
+    __slots__ = ()
+
+    def __repr__(self):
+        attrs = []
+        for k in self.__slots__:
+            attrs.append(f'{k}={repr(getattr(self, k))}')
+        return f'{self.__class__.__name__}({", ".join(attrs)})'
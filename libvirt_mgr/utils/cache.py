@@ -0,0 +1,58 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Thread-safe cache whose entries expire after ttl seconds
+
+    Concurrent loads of the same key wait for the first one instead of repeating its calls.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Time the value was set and the value by key
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._loading: Dict[Hashable, threading.Lock] = {}
+
+    def _fresh(self, key: Hashable) -> Optional[Tuple[float, Any]]:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry
+
+    def get(self, key: Hashable) -> Any:
+        """Returns the value of key, None if it is missing or expired"""
+        with self._lock:
+            entry = self._fresh(key)
+        return None if entry is None else entry[1]
+
+    def set(self, key: Hashable, value: Any, timestamp: Optional[float] = None):
+        """Stores value for key, it expires ttl seconds after timestamp, which defaults to now"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() if timestamp is None else timestamp, value)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def load(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """Returns the value of key, calling func to get and store it if it is missing or expired"""
+        with self._lock:
+            entry = self._fresh(key)
+            if entry is not None:
+                return entry[1]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                entry = self._fresh(key)
+                if entry is not None:
+                    return entry[1]
+            value = func()
+            self.set(key, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,11 +1,16 @@
+import functools
+import hashlib
 import inspect
 import logging
 import os
-from typing import Dict, List, Optional
+import pickle
+import sys
+import tempfile
+from typing import Any, Dict, FrozenSet, List, Optional
 
-import libvirt
-
-from .libvirt import get_migrate_flags
+from .. import __version__
+from .base import SlotsRepr
+from .libvirt import get_migrate_flags, get_migrate_params
 
 try:
     import tomllib as toml
@@ -15,21 +20,53 @@ except ModuleNotFoundError:
 logger = logging.getLogger(__name__)
 
 DEFAULT_HOST_GROUP = 'live'
-DEFAULT_SAME_GROUP_FLAGS = (libvirt.VIR_MIGRATE_PERSIST_DEST | libvirt.VIR_MIGRATE_UNDEFINE_SOURCE |
-                            libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_PEER2PEER |
-                            libvirt.VIR_MIGRATE_TUNNELLED)
-DEFAULT_DIFFERENT_GROUP_FLAGS = (libvirt.VIR_MIGRATE_PERSIST_DEST | libvirt.VIR_MIGRATE_UNDEFINE_SOURCE |
-                                 libvirt.VIR_MIGRATE_OFFLINE)
+# Names of VIR_MIGRATE_* flags, resolved when a group is created so importing this module does not import libvirt
+DEFAULT_SAME_GROUP_FLAGS = ('persist_dest', 'undefine_source', 'live', 'peer2peer', 'tunnelled')
+DEFAULT_DIFFERENT_GROUP_FLAGS = ('persist_dest', 'undefine_source', 'offline')
+DEFAULT_SHUTDOWN_TIMEOUT = 300
+SHUTDOWN_TIMEOUT_ACTIONS = ('abort', 'destroy')
+DEFAULT_POSTCOPY_MAX_ITERATIONS = 5
+DEFAULT_POSTCOPY_DIRTY_RATIO = 0.8
+DEFAULT_ADAPTIVE_MIN_DOWNTIME = 300
+DEFAULT_ADAPTIVE_MAX_DOWNTIME = 2000
 
+# Compiled configs are stored here, LIBVIRT_MGR_CACHE_DIR overrides it
+DEFAULT_CONFIG_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'libvirt-mgr')
+# Journal and migration history, kept across runs
+DEFAULT_STATE_DIR = os.path.join(os.getenv('XDG_STATE_HOME', os.path.expanduser('~/.local/state')), 'libvirt-mgr')
 
-class BaseConfig:
-    __slots__ = ()
 
-    def __repr__(self):
-        attrs = []
-        for k in self.__slots__:
-            attrs.append(f'{k}={repr(getattr(self, k))}')
-        return f'{self.__class__.__name__}({", ".join(attrs)})'
+@functools.lru_cache(maxsize=None)
+def get_init_params(cls: type) -> FrozenSet[str]:
+    """Returns the names of keyword arguments accepted by cls"""
+    return frozenset(k for k in inspect.signature(cls.__init__).parameters.keys() if k != 'self')
+
+
+def get_positive_limit(value: Optional[int], what: str) -> Optional[int]:
+    """Validates an optional limit which has to be a positive integer, None or 0 means unlimited"""
+    if value is None or value == 0:
+        return None
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise Exception(f'{what} must be a positive integer')
+    return value
+
+
+def get_group_table(cls: type, group: str, key: str, values: Any):
+    """Creates cls from a table nested in a group, unknown parameters are ignored with a warning"""
+    if not isinstance(values, dict):
+        raise Exception(f'Group "{group}" {key} must be a table')
+    kwargs = {}
+    params = get_init_params(cls)
+    for k, v in values.items():
+        if k == 'group' or k not in params:
+            logger.warning('Group "%s" %s contains unknown parameter "%s"', group, key, k)
+            continue
+        kwargs[k] = v
+    return cls(group, **kwargs)
+
+
+class BaseConfig(SlotsRepr):
+    __slots__ = ()
 
 
 class HostConfig(BaseConfig):
@@ -76,29 +113,153 @@ class HostConfig(BaseConfig):
         return self.name == other.name and self.uri == other.uri
 
 
+class PostCopyConfig(BaseConfig):
+    """When to switch a live migration from pre-copy to post-copy, any condition being met triggers the switch"""
+    __slots__ = ('max_iterations', 'max_time', 'dirty_ratio')
+
+    def __init__(
+        self,
+        group: str,
+        max_iterations: Optional[int] = DEFAULT_POSTCOPY_MAX_ITERATIONS,
+        max_time: Optional[float] = None,
+        dirty_ratio: Optional[float] = DEFAULT_POSTCOPY_DIRTY_RATIO,
+    ):
+        # Pre-copy iterations of memory, None or 0 disables the condition
+        self.max_iterations = get_positive_limit(max_iterations, f'Group "{group}" postcopy max_iterations')
+        # Seconds of pre-copy, None or 0 disables the condition
+        self.max_time: Optional[float] = max_time or None
+        if self.max_time is not None and self.max_time < 0:
+            raise Exception(f'Group "{group}" postcopy max_time cannot be negative')
+        # Memory dirty rate divided by transfer rate, pre-copy cannot converge when it nears 1
+        self.dirty_ratio: Optional[float] = dirty_ratio or None
+        if self.dirty_ratio is not None and self.dirty_ratio < 0:
+            raise Exception(f'Group "{group}" postcopy dirty_ratio cannot be negative')
+
+
+class AdaptiveConfig(BaseConfig):
+    """Bounds within which max downtime and bandwidth of live migrations are adjusted while they run"""
+    __slots__ = ('min_downtime', 'max_downtime', 'min_bandwidth', 'max_bandwidth', 'link_bandwidth', 'target_time')
+
+    def __init__(
+        self,
+        group: str,
+        min_downtime: int = DEFAULT_ADAPTIVE_MIN_DOWNTIME,
+        max_downtime: int = DEFAULT_ADAPTIVE_MAX_DOWNTIME,
+        min_bandwidth: Optional[int] = None,
+        max_bandwidth: Optional[int] = None,
+        link_bandwidth: Optional[int] = None,
+        target_time: Optional[float] = None,
+    ):
+        # Milliseconds the domain may be paused for at the end of the migration
+        self.min_downtime = get_positive_limit(min_downtime, f'Group "{group}" adaptive min_downtime')
+        self.max_downtime = get_positive_limit(max_downtime, f'Group "{group}" adaptive max_downtime')
+        if self.min_downtime is None or self.max_downtime is None:
+            raise Exception(f'Group "{group}" adaptive downtime limits must be positive integers')
+        if self.min_downtime > self.max_downtime:
+            raise Exception(f'Group "{group}" adaptive min_downtime must be at most max_downtime')
+        # MiB/s of a single migration, None means no limit
+        self.min_bandwidth = get_positive_limit(min_bandwidth, f'Group "{group}" adaptive min_bandwidth')
+        self.max_bandwidth = get_positive_limit(max_bandwidth, f'Group "{group}" adaptive max_bandwidth')
+        if self.min_bandwidth and self.max_bandwidth and self.min_bandwidth > self.max_bandwidth:
+            raise Exception(f'Group "{group}" adaptive min_bandwidth must be at most max_bandwidth')
+        # MiB/s shared by all outgoing migrations of a host, None means they are not throttled together
+        self.link_bandwidth = get_positive_limit(link_bandwidth, f'Group "{group}" adaptive link_bandwidth')
+        # Seconds each migration should complete in, migrations sharing a link are slowed to what is needed to meet it
+        self.target_time: Optional[float] = target_time or None
+        if self.target_time is not None and self.target_time < 0:
+            raise Exception(f'Group "{group}" adaptive target_time cannot be negative')
+        if self.target_time is not None and not self.link_bandwidth:
+            raise Exception(f'Group "{group}" adaptive target_time requires link_bandwidth')
+
+
 class GroupConfig(BaseConfig):
-    __slots__ = ('name', 'same_group_flags', 'different_group_flags')
+    __slots__ = ('name', 'same_group_flags', 'different_group_flags', 'same_group_params', 'different_group_params',
+                 'max_outgoing', 'max_incoming', 'shutdown_timeout', 'shutdown_timeout_action', 'copy_disks',
+                 'verify_disks', 'postcopy', 'adaptive')
 
     def __init__(
         self,
         name: str,
         same_group_flags: Optional[List[str]] = None,
         different_group_flags: Optional[List[str]] = None,
+        same_group_params: Optional[Dict[str, Any]] = None,
+        different_group_params: Optional[Dict[str, Any]] = None,
+        max_outgoing: Optional[int] = None,
+        max_incoming: Optional[int] = None,
+        shutdown_timeout: Optional[float] = DEFAULT_SHUTDOWN_TIMEOUT,
+        shutdown_timeout_action: str = 'abort',
+        copy_disks: bool = False,
+        verify_disks: bool = True,
+        postcopy: Optional[Dict[str, Any]] = None,
+        adaptive: Optional[Dict[str, Any]] = None,
     ):
         self.name = name
-        self.same_group_flags: int = DEFAULT_SAME_GROUP_FLAGS
-        if same_group_flags is not None:
-            self.same_group_flags = get_migrate_flags(same_group_flags)
+        # Concurrent migrations per host in this group, None means no limit
+        self.max_outgoing = get_positive_limit(max_outgoing, f'Group "{name}" max_outgoing')
+        self.max_incoming = get_positive_limit(max_incoming, f'Group "{name}" max_incoming')
+
+        # Seconds to wait for a graceful shutdown before offline migrations, None or 0 waits forever
+        self.shutdown_timeout: Optional[float] = shutdown_timeout or None
+        if self.shutdown_timeout is not None and self.shutdown_timeout < 0:
+            raise Exception(f'Group "{name}" shutdown_timeout cannot be negative')
+        if shutdown_timeout_action not in SHUTDOWN_TIMEOUT_ACTIONS:
+            raise Exception(f'Group "{name}" shutdown_timeout_action must be one of {", ".join(SHUTDOWN_TIMEOUT_ACTIONS)}')
+        self.shutdown_timeout_action = shutdown_timeout_action
+        # Copy disks to the same storage pool on the destination before offline migrations, optionally comparing checksums
+        self.copy_disks = bool(copy_disks)
+        self.verify_disks = bool(verify_disks)
+        if same_group_flags is None:
+            same_group_flags = DEFAULT_SAME_GROUP_FLAGS
+        self.same_group_flags: int = get_migrate_flags(same_group_flags)
+
+        if different_group_flags is None:
+            different_group_flags = DEFAULT_DIFFERENT_GROUP_FLAGS
+        self.different_group_flags: int = get_migrate_flags(different_group_flags)
+
+        # Typed parameters passed to migrate3, flags they depend on are added automatically
+        self.same_group_params: Dict[str, Any] = {}
+        if same_group_params:
+            self.same_group_params, required_flags = get_migrate_params(same_group_params)
+            self.same_group_flags |= required_flags
+        self.different_group_params: Dict[str, Any] = {}
+        if different_group_params:
+            self.different_group_params, required_flags = get_migrate_params(different_group_params)
+            self.different_group_flags |= required_flags
+
+        # Live migrations switch to post-copy if pre-copy does not converge, None never switches
+        self.postcopy: Optional[PostCopyConfig] = None
+        if postcopy is not None:
+            self.postcopy = get_group_table(PostCopyConfig, name, 'postcopy', postcopy)
+            postcopy_flag, live_flag, tunnelled_flag = (get_migrate_flags([f]) for f in ('postcopy', 'live', 'tunnelled'))
+            # Only live migrations can switch, libvirt does not support post-copy over tunnelled connections
+            for attr in ('same_group_flags', 'different_group_flags'):
+                flags = getattr(self, attr)
+                if not flags & live_flag:
+                    continue
+                if flags & tunnelled_flag:
+                    raise Exception(f'Group "{name}" postcopy cannot be used with tunnelled {attr}')
+                setattr(self, attr, flags | postcopy_flag)
 
-        self.different_group_flags: int = DEFAULT_DIFFERENT_GROUP_FLAGS
-        if different_group_flags is not None:
-            self.different_group_flags = get_migrate_flags(different_group_flags)
+        # Live migrations have their max downtime and bandwidth adjusted while they run, None leaves them as is
+        self.adaptive: Optional[AdaptiveConfig] = None
+        if adaptive is not None:
+            self.adaptive = get_group_table(AdaptiveConfig, name, 'adaptive', adaptive)
 
     def __repr__(self) -> str:
         attrs = (
             f'name={repr(self.name)}',
             f'same_group_flags=0b{self.same_group_flags:b}',
             f'different_group_flags=0b{self.different_group_flags:b}',
+            f'same_group_params={repr(self.same_group_params)}',
+            f'different_group_params={repr(self.different_group_params)}',
+            f'max_outgoing={repr(self.max_outgoing)}',
+            f'max_incoming={repr(self.max_incoming)}',
+            f'shutdown_timeout={repr(self.shutdown_timeout)}',
+            f'shutdown_timeout_action={repr(self.shutdown_timeout_action)}',
+            f'copy_disks={repr(self.copy_disks)}',
+            f'verify_disks={repr(self.verify_disks)}',
+            f'postcopy={repr(self.postcopy)}',
+            f'adaptive={repr(self.adaptive)}',
         )
         return f'{self.__class__.__name__}({", ".join(attrs)})'
 
@@ -120,8 +281,7 @@ class Config(BaseConfig):
     @classmethod
     def from_dict(cls, data: dict):
         groups = {}
-        groups_spec = inspect.signature(GroupConfig.__init__)
-        groups_params = {k for k in groups_spec.parameters.keys() if k != 'self'}
+        groups_params = get_init_params(GroupConfig)
         for name, values in data.get('groups', {}).items():
             kwargs = {"name": name}
             for k, v in values.items():
@@ -132,8 +292,7 @@ class Config(BaseConfig):
             groups[name] = GroupConfig(**kwargs)
 
         hosts = {}
-        hosts_spec = inspect.signature(HostConfig.__init__)
-        hosts_params = {k for k in hosts_spec.parameters.keys() if k != 'self'}
+        hosts_params = get_init_params(HostConfig)
         for name, values in data.get('hosts', {}).items():
             kwargs = {"name": name}
             for k, v in values.items():
@@ -163,9 +322,93 @@ class Config(BaseConfig):
         )
 
     @classmethod
-    def from_file(cls, file_path: str):
+    def from_file(cls, file_path: str, cache_dir: Optional[str] = None, use_cache: bool = True):
+        """Loads a config file, reusing the compiled config from cache_dir if the file has not changed since"""
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"Could not find config file: {file_path}")
+        if not use_cache:
+            return cls._parse_file(file_path)
+        cache = ConfigCache(cache_dir or os.getenv('LIBVIRT_MGR_CACHE_DIR', DEFAULT_CONFIG_CACHE_DIR))
+        config = cache.load(file_path)
+        if config is None:
+            config = cls._parse_file(file_path)
+            cache.store(file_path, config)
+        return config
+
+    @classmethod
+    def _parse_file(cls, file_path: str):
         open_mode = 'rb' if toml.__name__ == 'tomllib' else 'r'
         with open(file_path, open_mode) as f:
             return cls.from_dict(toml.load(f))
+
+
+@functools.lru_cache(maxsize=None)
+def get_config_cache_version() -> str:
+    """Returns a digest of the package version and of the code parsing configs, changes invalidate cached configs
+
+    Parsing, defaults and validation live in this module and the flag helpers, so their source is part of the digest.
+    """
+    layout = [(cls.__name__, cls.__slots__) for cls in (HostConfig, PostCopyConfig, AdaptiveConfig, GroupConfig, Config)]
+    digest = hashlib.sha1(repr((__version__, layout)).encode())
+    for module in (sys.modules[__name__], sys.modules[get_migrate_flags.__module__]):
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()
+
+
+class ConfigCache:
+    """Stores compiled configs on disk, keyed by the config file's path, modification time and size
+
+    Cache files are only loaded if they are owned by the current user, since loading them unpickles arbitrary objects.
+    """
+    __slots__ = ('cache_dir',)
+
+    def __init__(self, cache_dir: str = DEFAULT_CONFIG_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(cache_dir={repr(self.cache_dir)})'
+
+    def _path(self, file_path: str) -> str:
+        digest = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'config-{digest}.pickle')
+
+    @staticmethod
+    def _key(file_path: str) -> tuple:
+        st = os.stat(file_path)
+        return get_config_cache_version(), os.path.abspath(file_path), st.st_mtime_ns, st.st_size
+
+    def load(self, file_path: str) -> Optional[Config]:
+        """Returns the cached config for file_path, None if there is none or it is stale"""
+        path = self._path(file_path)
+        try:
+            if os.stat(path).st_uid != os.getuid():
+                logger.warning('Ignoring config cache %s owned by another user', path)
+                return None
+            with open(path, 'rb') as f:
+                key, config = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.debug('Cannot read config cache %s: %s', path, e)
+            return None
+        if key != self._key(file_path) or not isinstance(config, Config):
+            logger.debug('Config cache %s is stale', path)
+            return None
+        logger.debug('Loaded compiled config from %s', path)
+        return config
+
+    def store(self, file_path: str, config: Config):
+        """Writes config to the cache atomically, failures are logged and otherwise ignored"""
+        path = self._path(file_path)
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.config-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump((self._key(file_path), config), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.debug('Cannot write config cache %s: %s', path, e)
@@ -0,0 +1,103 @@
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+from .config import HostConfig
+from .events import start_event_loop
+from .lazy import libvirt
+from .profile import get_profiler
+
+
+logger = logging.getLogger(__name__)
+
+# Send a keepalive message after this many seconds of inactivity
+DEFAULT_KEEPALIVE_INTERVAL = 5
+# Consider the connection dead after this many unanswered keepalive messages
+DEFAULT_KEEPALIVE_COUNT = 3
+
+
+class ConnectionPool:
+    """Lazily opens hypervisor connections and reuses them, keyed by URI
+
+    Dead connections are reopened transparently, all connections are closed by close() or when used as a context manager.
+    """
+
+    def __init__(
+        self,
+        keepalive_interval: int = DEFAULT_KEEPALIVE_INTERVAL,
+        keepalive_count: int = DEFAULT_KEEPALIVE_COUNT,
+        opener: Optional[Callable[[str], 'libvirt.virConnect']] = None,
+    ):
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        # Opens a connection to a URI, libvirt.open unless overridden (e.g. for a fake hypervisor)
+        self.opener = opener or libvirt.open
+        self._lock = threading.Lock()
+        self._conns: Dict[str, 'libvirt.virConnect'] = {}
+        # Per URI locks, so a slow handshake with one host does not block the others
+        self._uri_locks: Dict[str, threading.Lock] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _uri_lock(self, uri: str) -> threading.Lock:
+        with self._lock:
+            if uri not in self._uri_locks:
+                self._uri_locks[uri] = threading.Lock()
+            return self._uri_locks[uri]
+
+    def get(self, host: HostConfig) -> 'libvirt.virConnect':
+        """Returns an open connection to host, connecting if needed"""
+        with self._uri_lock(host.uri):
+            conn = self._conns.get(host.uri)
+            if conn is not None:
+                if conn.isAlive():
+                    return conn
+                logger.warning('Connection to "%s" is dead, reconnecting', host.name)
+                self._close_conn(host.uri, conn)
+            conn = self._open(host)
+            with self._lock:
+                self._conns[host.uri] = conn
+            return conn
+
+    def _open(self, host: HostConfig) -> 'libvirt.virConnect':
+        # Keepalive and domain events both require a running event loop
+        start_event_loop()
+        logger.debug('Connecting to "%s" at %s', host.name, host.uri)
+        profiler = get_profiler()
+        if profiler is None:
+            conn = self.opener(host.uri)
+        else:
+            # Includes SSH setup and authentication for remote URIs
+            conn = profiler.wrap(profiler.call(host.name, 'open', self.opener, host.uri), host.name)
+        try:
+            conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        except libvirt.libvirtError as e:
+            # Not supported by local drivers
+            logger.debug('Cannot enable keepalive for "%s": %s', host.name, e)
+        return conn
+
+    def _close_conn(self, uri: str, conn: 'libvirt.virConnect'):
+        with self._lock:
+            if self._conns.get(uri) is conn:
+                del self._conns[uri]
+        try:
+            conn.close()
+        except libvirt.libvirtError as e:
+            logger.debug('Error closing connection to %s: %s', uri, e)
+
+    def close(self, host: Optional[HostConfig] = None):
+        """Closes the connection to host, or all connections if no host is given"""
+        with self._lock:
+            if host is None:
+                conns = list(self._conns.items())
+            elif host.uri in self._conns:
+                conns = [(host.uri, self._conns[host.uri])]
+            else:
+                conns = []
+        for uri, conn in conns:
+            self._close_conn(uri, conn)
+            logger.debug('Closed connection to %s', uri)
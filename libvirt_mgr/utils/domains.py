@@ -0,0 +1,79 @@
+import logging
+from typing import List, Optional
+
+from .lazy import libvirt
+
+
+logger = logging.getLogger(__name__)
+
+
+class DomainRecord:
+    """Domain with its name and state cached, avoids repeating RPCs for information that does not change"""
+    __slots__ = ('dom', 'name', 'uuid', 'active', 'memory', 'vcpus')
+
+    def __init__(self, dom: 'libvirt.virDomain', active: bool, name: Optional[str] = None, uuid: Optional[str] = None):
+        self.dom = dom
+        # Name and UUID are stored in the domain object, reading them does not require an RPC
+        self.name = name or dom.name()
+        self.uuid = uuid or dom.UUIDString()
+        # State when the domain was listed, must be updated when it is changed
+        self.active = active
+        # Maximum memory in bytes and number of vCPUs, filled by get_domain_resources
+        self.memory: Optional[int] = None
+        self.vcpus: Optional[int] = None
+
+    def __repr__(self):
+        attrs = []
+        for k in self.__slots__[1:]:
+            attrs.append(f'{k}={repr(getattr(self, k))}')
+        return f'{self.__class__.__name__}({", ".join(attrs)})'
+
+    @classmethod
+    def from_domain(cls, dom: 'libvirt.virDomain'):
+        return cls(dom, active=bool(dom.isActive()))
+
+
+def list_domains(conn: 'libvirt.virConnect', flags: int = 0) -> List[DomainRecord]:
+    """Lists all domains matching flags, with at most two listAllDomains calls
+
+    Active and inactive domains are listed separately so their state is known without querying each domain.
+    """
+    state_mask = libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE | libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE
+    ret: List[DomainRecord] = []
+    for state_flag, active in (
+        (libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE, True),
+        (libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE, False),
+    ):
+        # Skip the state if flags filter for the other one only
+        if flags & state_mask and not flags & state_flag:
+            continue
+        for dom in conn.listAllDomains((flags & ~state_mask) | state_flag):
+            ret.append(DomainRecord(dom, active=active))
+    logger.debug('Listed %d domains with flags %d', len(ret), flags)
+    return ret
+
+
+def get_domain_resources(conn: 'libvirt.virConnect', domains: List[DomainRecord]):
+    """Fills memory and vCPUs of domains using a single domainListGetStats call
+
+    Domains missing from the bulk stats are queried individually.
+    """
+    if not domains:
+        return
+    by_uuid = {d.uuid: d for d in domains}
+    stats_flags = libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU
+    for dom, stats in conn.domainListGetStats([d.dom for d in domains], stats_flags):
+        record = by_uuid.get(dom.UUIDString())
+        if record is None:
+            continue
+        if 'balloon.maximum' in stats:
+            record.memory = stats['balloon.maximum'] * 1024
+        vcpus = stats.get('vcpu.current', stats.get('vcpu.maximum'))
+        if vcpus is not None:
+            record.vcpus = vcpus
+    for record in domains:
+        if record.memory is None or record.vcpus is None:
+            # [state, max memory KiB, memory KiB, vCPUs, CPU time]
+            info = record.dom.info()
+            record.memory = info[1] * 1024
+            record.vcpus = info[3]
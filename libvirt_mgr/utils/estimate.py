@@ -0,0 +1,368 @@
+import heapq
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .base import SlotsRepr
+from .config import DEFAULT_STATE_DIR, Config
+from .lazy import libvirt
+from .monitor import format_size, format_table
+
+
+logger = logging.getLogger(__name__)
+
+# LIBVIRT_MGR_ESTIMATES overrides it
+DEFAULT_HISTORY_PATH = os.path.join(DEFAULT_STATE_DIR, 'estimates.json')
+ORDER_SHORTEST = 'shortest'
+ORDER_LONGEST = 'longest'
+ORDER_GIVEN = 'given'
+ORDER_POLICIES = (ORDER_SHORTEST, ORDER_LONGEST, ORDER_GIVEN)
+# Bytes per second assumed for a link until one is configured or observed, roughly 10 Gbit/s
+DEFAULT_BANDWIDTH = 1024 ** 3
+# Seconds QEMU pauses a domain for at most when finishing a live migration, unless adaptive downtime is configured
+DEFAULT_MAX_DOWNTIME = 0.3
+# Pre-copy iterations after which a migration is considered not to converge
+MAX_ITERATIONS = 30
+# Seconds of an offline migration without history, only the definition is transferred
+DEFAULT_OFFLINE_DURATION = 1.0
+# Seconds over which dirty rates are measured, the smallest period libvirt accepts
+DIRTY_RATE_PERIOD = 1
+# Weight of the newest observation in the moving averages of the history
+LEARNING_RATE = 0.3
+# Ratios of actual to predicted durations are clamped to this range, a single outlier should not dominate
+MIN_RATIO = 0.1
+MAX_RATIO = 10.0
+# virDomainDirtyRateStatus
+_DIRTY_RATE_MEASURED = 2
+
+
+class Estimate(SlotsRepr):
+    """Predicted duration and downtime of a single migration, in seconds"""
+    __slots__ = ('duration', 'downtime', 'model_duration', 'memory', 'dirty_rate', 'bandwidth', 'iterations',
+                 'converges')
+
+    def __init__(
+        self,
+        duration: float,
+        downtime: float,
+        model_duration: float,
+        memory: int = 0,
+        dirty_rate: float = 0.0,
+        bandwidth: float = 0.0,
+        iterations: int = 0,
+        converges: bool = True,
+    ):
+        self.duration = duration
+        self.downtime = downtime
+        # Duration predicted before the correction learned from history
+        self.model_duration = model_duration
+        # Bytes, bytes per second
+        self.memory = memory
+        self.dirty_rate = dirty_rate
+        self.bandwidth = bandwidth
+        # Pre-copy iterations, 0 for offline migrations
+        self.iterations = iterations
+        # False if pre-copy cannot get the remaining memory below max downtime
+        self.converges = converges
+
+
+def predict_precopy(
+    memory: float,
+    dirty_rate: float,
+    bandwidth: float,
+    max_downtime: float = DEFAULT_MAX_DOWNTIME,
+) -> Tuple[float, float, int, bool]:
+    """Returns duration, downtime, iterations and whether pre-copy converges
+
+    Each iteration sends what was dirtied while the previous one was sent, until it can be sent within max downtime
+    while the domain is paused.
+    """
+    remaining = float(memory)
+    duration = 0.0
+    iterations = 0
+    while remaining / bandwidth > max_downtime and iterations < MAX_ITERATIONS:
+        elapsed = remaining / bandwidth
+        duration += elapsed
+        remaining = min(float(memory), dirty_rate * elapsed)
+        iterations += 1
+    downtime = remaining / bandwidth
+    return duration + downtime, downtime, iterations, downtime <= max_downtime
+
+
+class EstimateHistory:
+    """Observed link bandwidth per host and prediction accuracy per domain, stored as JSON, thread-safe
+
+    Domains are keyed by UUID, each keeps the moving average of actual divided by predicted durations of its live
+    migrations, and of its offline migration durations.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.hosts: Dict[str, Dict[str, float]] = {}
+        self.domains: Dict[str, Dict[str, float]] = {}
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.hosts = data.get('hosts', {})
+            self.domains = data.get('domains', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning('Cannot read migration history %s, starting over: %s', self.path, e)
+
+    def save(self):
+        """Writes the history atomically, failures are logged and otherwise ignored"""
+        if self.path is None:
+            return
+        with self._lock:
+            text = json.dumps({'hosts': self.hosts, 'domains': self.domains}, sort_keys=True)
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.estimates-')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning('Cannot write migration history %s: %s', self.path, e)
+
+    def get(self, kind: str, key: str, field: str) -> Optional[float]:
+        with self._lock:
+            return getattr(self, kind).get(key, {}).get(field)
+
+    def update(self, kind: str, key: str, field: str, value: float):
+        """Moves the average of field towards value, or sets it if there is none"""
+        with self._lock:
+            entry = getattr(self, kind).setdefault(key, {})
+            old = entry.get(field)
+            entry[field] = value if old is None else old + LEARNING_RATE * (value - old)
+            entry['updated'] = time.time()
+
+
+def get_history_path(path: Optional[str] = None) -> str:
+    return path or os.getenv('LIBVIRT_MGR_ESTIMATES', DEFAULT_HISTORY_PATH)
+
+
+class MigrationEstimator:
+    """Predicts migrations from domain memory, dirty rates and link bandwidth, corrected by history"""
+
+    def __init__(self, config: Config, history: Optional[EstimateHistory] = None):
+        self.config = config
+        self.history = history or EstimateHistory()
+
+    @staticmethod
+    def get_limits(task) -> List[float]:
+        """Returns the bandwidth limits of a migration in bytes per second, from its parameters and adaptive policy"""
+        limits = []
+        bandwidth_param = getattr(libvirt, 'VIR_MIGRATE_PARAM_BANDWIDTH', 'bandwidth')
+        if task.params.get(bandwidth_param):
+            limits.append(task.params[bandwidth_param] * 1024 ** 2)
+        adaptive = task.group.adaptive
+        if adaptive is not None:
+            limits.extend(v * 1024 ** 2 for v in (adaptive.max_bandwidth, adaptive.link_bandwidth) if v)
+        return limits
+
+    def get_bandwidth(self, task) -> float:
+        """Returns the bytes per second a migration from the task's source host is expected to get
+
+        The link bandwidth of the host learned from unlimited migrations replaces the default, the migration's own
+        limits apply on top of it.
+        """
+        bandwidth = self.history.get('hosts', task.src_host.name, 'bandwidth') or DEFAULT_BANDWIDTH
+        return min([bandwidth] + self.get_limits(task))
+
+    def estimate(self, task, dirty_rate: Optional[float] = None) -> Estimate:
+        """Predicts a migration task, dirty_rate in bytes per second defaults to the one learned from history"""
+        domain = task.domain
+        memory = domain.memory or 0
+        if dirty_rate is None:
+            dirty_rate = self.history.get('domains', domain.uuid, 'dirty_rate') or 0.0
+        bandwidth = self.get_bandwidth(task)
+        if task.flags & libvirt.VIR_MIGRATE_OFFLINE:
+            duration = self.history.get('domains', domain.uuid, 'offline_duration') or DEFAULT_OFFLINE_DURATION
+            # Running domains are down from their shutdown until they are started on the destination
+            return Estimate(duration, duration if domain.active else 0.0, duration, memory, 0.0, bandwidth)
+        if not domain.active:
+            # Skipped, cannot live migrate
+            return Estimate(0.0, 0.0, 0.0, memory, 0.0, bandwidth)
+        max_downtime = DEFAULT_MAX_DOWNTIME
+        if task.group.adaptive is not None:
+            max_downtime = task.group.adaptive.max_downtime / 1000
+        duration, downtime, iterations, converges = predict_precopy(memory, dirty_rate, bandwidth, max_downtime)
+        ratio = self.history.get('domains', domain.uuid, 'ratio') or 1.0
+        return Estimate(duration * ratio, downtime, duration, memory, dirty_rate, bandwidth, iterations, converges)
+
+    def estimate_all(self, tasks: List, measure: bool = False) -> List[Estimate]:
+        """Predicts tasks, measuring dirty rates of running domains to be live migrated first if measure is set
+
+        Measuring takes DIRTY_RATE_PERIOD and a call per domain, otherwise only history is used.
+        """
+        rates = measure_dirty_rates(tasks) if measure else {}
+        return [self.estimate(t, rates.get(t.domain.uuid)) for t in tasks]
+
+    def learn(
+        self,
+        task,
+        estimate: Estimate,
+        duration: float,
+        data_processed: Optional[int] = None,
+        concurrent: int = 1,
+    ):
+        """Records the actual duration of a successful migration against its prediction
+
+        concurrent is how many migrations from the source host shared its link, the host's bandwidth is only learned
+        from migrations without bandwidth limits, scaled by it.
+        """
+        domain = task.domain
+        if task.flags & libvirt.VIR_MIGRATE_OFFLINE:
+            self.history.update('domains', domain.uuid, 'offline_duration', duration)
+            return
+        if estimate.model_duration <= 0:
+            return
+        if data_processed and duration > 0 and not self.get_limits(task):
+            self.history.update('hosts', task.src_host.name, 'bandwidth', data_processed / duration * max(1, concurrent))
+        ratio = min(MAX_RATIO, max(MIN_RATIO, duration / estimate.model_duration))
+        self.history.update('domains', domain.uuid, 'ratio', ratio)
+        if estimate.dirty_rate:
+            self.history.update('domains', domain.uuid, 'dirty_rate', estimate.dirty_rate)
+        elif data_processed and estimate.memory and duration > 0:
+            # Memory sent more than once was dirtied during the migration
+            self.history.update('domains', domain.uuid, 'dirty_rate', max(0, data_processed - estimate.memory) / duration)
+        logger.debug('"%s" was predicted to take %.1fs, took %.1fs', domain.name, estimate.duration, duration)
+
+
+def measure_dirty_rates(tasks: List, period: Optional[int] = None) -> Dict[str, float]:
+    """Returns the dirty rates of running domains to be live migrated in bytes per second by UUID
+
+    Measurements of all domains run at the same time, results are read with a single call per source host. Domains
+    whose rate cannot be measured, e.g. with libvirt older than 7.2, are left out.
+    """
+    if period is None:
+        period = DIRTY_RATE_PERIOD
+    started: Dict[str, Tuple[Any, set]] = {}
+    for task in tasks:
+        if not task.domain.active or task.flags & libvirt.VIR_MIGRATE_OFFLINE:
+            continue
+        try:
+            task.domain.dom.startDirtyRateCalc(period, 0)
+        except (libvirt.libvirtError, AttributeError) as e:
+            logger.debug('Cannot measure dirty rate of "%s": %s', task.domain.name, e)
+            continue
+        started.setdefault(task.src_host.name, (task.src_conn, set()))[1].add(task.domain.uuid)
+    if not started:
+        return {}
+    time.sleep(period)
+    rates: Dict[str, float] = {}
+    for host, (conn, uuids) in started.items():
+        try:
+            stats = conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_DIRTYRATE, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE,
+            )
+        except libvirt.libvirtError as e:
+            logger.warning('Cannot get dirty rates of domains on "%s": %s', host, e)
+            continue
+        for dom, values in stats:
+            uuid = dom.UUIDString()
+            if uuid in uuids and values.get('dirtyrate.calc_status') == _DIRTY_RATE_MEASURED:
+                rates[uuid] = values.get('dirtyrate.megabytes_per_second', 0) * 1024 ** 2
+    return rates
+
+
+def order_tasks(tasks: List, estimates: List[Estimate], policy: str = ORDER_SHORTEST) -> Tuple[List, List[Estimate]]:
+    """Returns tasks and their estimates sorted by policy, ties keep their order"""
+    if policy not in ORDER_POLICIES:
+        raise Exception(f'Migration order must be one of {", ".join(ORDER_POLICIES)}')
+    pairs = list(zip(tasks, estimates))
+    if policy == ORDER_SHORTEST:
+        pairs.sort(key=lambda p: p[1].duration)
+    elif policy == ORDER_LONGEST:
+        pairs.sort(key=lambda p: -p[1].duration)
+    return [p[0] for p in pairs], [p[1] for p in pairs]
+
+
+def simulate_schedule(
+    config: Config,
+    tasks: List,
+    estimates: List[Estimate],
+    parallel: int = 1,
+) -> List[Tuple[float, float]]:
+    """Returns the predicted start and end of each task, relative to the start of the batch
+
+    Mirrors how batches run, workers take tasks in order and wait for per host limits of their group.
+    """
+    workers = [0.0] * max(1, min(parallel, len(tasks)))
+    # Running (start, end) by host for outgoing and incoming limits
+    outgoing: Dict[str, List[Tuple[float, float]]] = {}
+    incoming: Dict[str, List[Tuple[float, float]]] = {}
+    ret = []
+    for task, estimate in zip(tasks, estimates):
+        ready = heapq.heappop(workers)
+        limits = (
+            (outgoing.setdefault(task.src_host.name, []), config.groups[task.src_host.group].max_outgoing),
+            (incoming.setdefault(task.dst_host.name, []), config.groups[task.dst_host.group].max_incoming),
+        )
+        # A slot frees up when a running migration ends
+        candidates = sorted({ready} | {end for runs, _ in limits for _, end in runs if end > ready})
+        start = candidates[-1]
+        for t in candidates:
+            if all(limit is None or sum(1 for s, e in runs if s <= t < e) < limit for runs, limit in limits):
+                start = t
+                break
+        end = start + estimate.duration
+        for runs, _ in limits:
+            runs.append((start, end))
+        heapq.heappush(workers, end)
+        ret.append((start, end))
+    return ret
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes < 60:
+        return f'{minutes}m{seconds:02d}s'
+    return f'{minutes // 60}h{minutes % 60:02d}m'
+
+
+def format_plan(config: Config, tasks: List, estimates: List[Estimate], parallel: int = 1) -> str:
+    """Returns the predicted schedule of a batch as a table, followed by its total duration"""
+    schedule = simulate_schedule(config, tasks, estimates, parallel)
+    rows = [('#', 'DOMAIN', 'FROM', 'TO', 'MEMORY', 'DIRTY', 'LINK', 'DURATION', 'DOWNTIME', 'START', 'END')]
+    for i, (task, estimate, (start, end)) in enumerate(zip(tasks, estimates, schedule), start=1):
+        offline = task.flags & libvirt.VIR_MIGRATE_OFFLINE
+        if offline:
+            downtime = format_duration(estimate.downtime) if estimate.downtime else '-'
+        elif not task.domain.active:
+            downtime = 'skipped'
+        elif not estimate.converges:
+            downtime = 'no convergence'
+        else:
+            downtime = f'{estimate.downtime * 1000:.0f}ms'
+        rows.append((
+            str(i),
+            task.domain.name,
+            task.src_host.name,
+            task.dst_host.name,
+            format_size(estimate.memory),
+            '-' if offline else f'{format_size(estimate.dirty_rate)}/s',
+            f'{format_size(estimate.bandwidth)}/s',
+            format_duration(estimate.duration),
+            downtime,
+            format_duration(start),
+            format_duration(end),
+        ))
+    total = max((end for _, end in schedule), default=0.0)
+    return f'{format_table(rows)}\nPredicted total {format_duration(total)} for {len(tasks)} migrations'
@@ -0,0 +1,64 @@
+import logging
+import threading
+from typing import Optional
+
+from .lazy import libvirt
+
+
+logger = logging.getLogger(__name__)
+
+# Re-check domain state this often while waiting, in case an event was lost (e.g. connection dropped)
+EVENT_RECHECK_INTERVAL = 30
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread: Optional[threading.Thread] = None
+
+
+def start_event_loop():
+    """Registers the default libvirt event loop implementation and runs it in a daemon thread
+
+    Connections only receive events if they are opened after this has been called, it is safe to call multiple times.
+    """
+    global _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_thread = threading.Thread(target=_run_event_loop, name='libvirt-event-loop', daemon=True)
+        _event_loop_thread.start()
+        logger.debug('Started libvirt event loop')
+
+
+def _run_event_loop():
+    while True:
+        if libvirt.virEventRunDefaultImpl() < 0:
+            logger.error('Failed to run libvirt event loop iteration')
+
+
+def wait_for_shutdown(dom: 'libvirt.virDomain', timeout: Optional[float] = None) -> bool:
+    """Waits for a domain to stop using lifecycle events, returns False if it is still running after timeout seconds"""
+    stopped = threading.Event()
+
+    def callback(_conn, _dom, event, _detail, _opaque):
+        if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            stopped.set()
+
+    conn = dom.connect()
+    callback_id = conn.domainEventRegisterAny(dom, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, callback, None)
+    try:
+        remaining = timeout
+        # Domain might have stopped before the callback was registered
+        while dom.isActive():
+            wait_time = EVENT_RECHECK_INTERVAL if remaining is None else min(remaining, EVENT_RECHECK_INTERVAL)
+            if stopped.wait(wait_time):
+                return True
+            if remaining is not None:
+                remaining -= wait_time
+                if remaining <= 0:
+                    return not dom.isActive()
+        return True
+    finally:
+        try:
+            conn.domainEventDeregisterAny(callback_id)
+        except libvirt.libvirtError as e:
+            logger.debug('Cannot deregister lifecycle event callback: %s', e)
@@ -0,0 +1,267 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .base import SlotsRepr
+from .config import DEFAULT_CONFIG_CACHE_DIR, HostConfig
+from .connection import ConnectionPool
+from .domains import DomainRecord, get_domain_resources, list_domains
+from .lazy import libvirt
+from .probe import DEFAULT_PROBE_TIMEOUT, run_on_hosts
+
+
+logger = logging.getLogger(__name__)
+
+# LIBVIRT_MGR_INVENTORY overrides it
+DEFAULT_INVENTORY_PATH = os.path.join(DEFAULT_CONFIG_CACHE_DIR, 'inventory.sqlite')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS domains (
+    uuid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    host TEXT NOT NULL,
+    active INTEGER NOT NULL,
+    memory INTEGER,
+    vcpus INTEGER,
+    updated REAL NOT NULL,
+    PRIMARY KEY (uuid, host)
+);
+CREATE INDEX IF NOT EXISTS domains_name ON domains (name);
+CREATE TABLE IF NOT EXISTS hosts (
+    name TEXT PRIMARY KEY,
+    refreshed REAL NOT NULL
+);
+"""
+
+
+class InventoryEntry(SlotsRepr):
+    """A domain as last seen on a host"""
+    __slots__ = ('name', 'uuid', 'host', 'active', 'memory', 'vcpus', 'updated')
+
+    def __init__(
+        self,
+        name: str,
+        uuid: str,
+        host: str,
+        active: bool,
+        memory: Optional[int],
+        vcpus: Optional[int],
+        updated: float,
+    ):
+        self.name = name
+        self.uuid = uuid
+        self.host = host
+        self.active = active
+        # Maximum memory in bytes, None if unknown
+        self.memory = memory
+        self.vcpus = vcpus
+        # Unix timestamp of when this entry was last updated
+        self.updated = updated
+
+
+class Inventory:
+    """SQLite index of which host every domain is on, safe to use from multiple threads"""
+
+    def __init__(self, path: str = ':memory:'):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _write(self, statements: List[Tuple[str, tuple]]):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, params in statements:
+                    self._db.execute(sql, params)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def find(self, pattern: str) -> List[InventoryEntry]:
+        """Returns domains whose name or UUID matches pattern, which can contain shell-style wildcards"""
+        op = 'GLOB' if any(c in pattern for c in '*?[') else '='
+        sql = f'SELECT * FROM domains WHERE name {op} ? OR uuid {op} ? ORDER BY name, host'
+        with self._lock:
+            rows = self._db.execute(sql, (pattern, pattern)).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def all(self) -> List[InventoryEntry]:
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM domains ORDER BY name, host').fetchall()
+        return [self._entry(row) for row in rows]
+
+    @staticmethod
+    def _entry(row: tuple) -> InventoryEntry:
+        uuid, name, host, active, memory, vcpus, updated = row
+        return InventoryEntry(name, uuid, host, bool(active), memory, vcpus, updated)
+
+    def refreshed(self) -> Dict[str, float]:
+        """Returns when each host was last fully refreshed, as Unix timestamps"""
+        with self._lock:
+            return dict(self._db.execute('SELECT name, refreshed FROM hosts').fetchall())
+
+    def replace_host(self, host: str, domains: List[DomainRecord]):
+        """Replaces everything known about host with domains"""
+        now = time.time()
+        statements = [('DELETE FROM domains WHERE host = ?', (host,))]
+        statements.extend(self._upsert(host, d, now) for d in domains)
+        statements.append(('INSERT OR REPLACE INTO hosts (name, refreshed) VALUES (?, ?)', (host, now)))
+        self._write(statements)
+
+    def update(self, host: str, domain: DomainRecord):
+        self._write([self._upsert(host, domain, time.time())])
+
+    @staticmethod
+    def _upsert(host: str, domain: DomainRecord, now: float) -> Tuple[str, tuple]:
+        return (
+            'INSERT OR REPLACE INTO domains (uuid, name, host, active, memory, vcpus, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (domain.uuid, domain.name, host, int(domain.active), domain.memory, domain.vcpus, now),
+        )
+
+    def set_active(self, host: str, uuid: str, active: bool):
+        self._write([('UPDATE domains SET active = ?, updated = ? WHERE uuid = ? AND host = ?',
+                      (int(active), time.time(), uuid, host))])
+
+    def remove(self, host: str, uuid: str):
+        self._write([('DELETE FROM domains WHERE uuid = ? AND host = ?', (uuid, host))])
+
+    def move(self, moves: List[Tuple[str, str, str]]):
+        """Records (name, src_host, dst_host) migrations"""
+        now = time.time()
+        statements = []
+        for name, src_host, dst_host in moves:
+            statements.append(('DELETE FROM domains WHERE name = ? AND host = ?', (name, dst_host)))
+            statements.append(('UPDATE domains SET host = ?, updated = ? WHERE name = ? AND host = ?',
+                               (dst_host, now, name, src_host)))
+        if statements:
+            self._write(statements)
+
+
+def get_inventory_path(path: Optional[str] = None) -> str:
+    return path or os.getenv('LIBVIRT_MGR_INVENTORY', DEFAULT_INVENTORY_PATH)
+
+
+def open_inventory(path: Optional[str] = None) -> Inventory:
+    """Opens the inventory at path, falling back to a temporary in-memory one if it cannot be opened"""
+    path = get_inventory_path(path)
+    try:
+        return Inventory(path)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning('Cannot open inventory %s, using a temporary one: %s', path, e)
+        return Inventory()
+
+
+def refresh_inventory(
+    inventory: Inventory,
+    hosts: List[HostConfig],
+    pool: ConnectionPool,
+    max_age: Optional[float] = None,
+    timeout: float = DEFAULT_PROBE_TIMEOUT,
+) -> List[str]:
+    """Lists all domains on hosts concurrently and stores them, returns the names of hosts refreshed
+
+    Hosts refreshed less than max_age seconds ago are skipped.
+    """
+    if max_age is not None:
+        refreshed = inventory.refreshed()
+        now = time.time()
+        hosts = [h for h in hosts if now - refreshed.get(h.name, 0) > max_age]
+
+    def _refresh(host: HostConfig) -> List[DomainRecord]:
+        conn = pool.get(host)
+        domains = list_domains(conn)
+        get_domain_resources(conn, domains)
+        return domains
+
+    results = run_on_hosts(hosts, _refresh, timeout)
+    for name, domains in results.items():
+        inventory.replace_host(name, domains)
+    logger.debug('Refreshed inventory of %d hosts', len(results))
+    return list(results)
+
+
+class InventoryWatcher:
+    """Keeps an inventory up to date from domain lifecycle events, for long running processes
+
+    Events arrive on the libvirt event loop thread, they are handed to a worker thread since looking up domain
+    resources requires RPCs.
+    """
+
+    def __init__(self, inventory: Inventory, pool: ConnectionPool):
+        self.inventory = inventory
+        self.pool = pool
+        self._queue: queue.Queue = queue.Queue()
+        self._callbacks: Dict[str, Tuple['libvirt.virConnect', int]] = {}
+        self._worker: Optional[threading.Thread] = None
+
+    def watch(self, host: HostConfig):
+        """Subscribes to lifecycle events of all domains on host"""
+        if host.name in self._callbacks:
+            return
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='inventory-watcher', daemon=True)
+            self._worker.start()
+        conn = self.pool.get(host)
+        callback_id = conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._callback, host.name,
+        )
+        self._callbacks[host.name] = (conn, callback_id)
+
+    def _callback(self, _conn, dom, event, _detail, host_name):
+        self._queue.put((host_name, dom, event))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            host_name, dom, event = item
+            try:
+                self._handle(host_name, dom, event)
+            except (libvirt.libvirtError, sqlite3.Error) as e:
+                logger.warning('Cannot update inventory for event on "%s": %s', host_name, e)
+
+    def _handle(self, host_name: str, dom: 'libvirt.virDomain', event: int):
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.inventory.remove(host_name, dom.UUIDString())
+        elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            self.inventory.set_active(host_name, dom.UUIDString(), False)
+        elif event in (libvirt.VIR_DOMAIN_EVENT_DEFINED, libvirt.VIR_DOMAIN_EVENT_STARTED):
+            record = DomainRecord(dom, active=event == libvirt.VIR_DOMAIN_EVENT_STARTED or bool(dom.isActive()))
+            get_domain_resources(dom.connect(), [record])
+            self.inventory.update(host_name, record)
+        else:
+            return
+        logger.debug('Updated inventory for "%s" on "%s" after event %d', dom.name(), host_name, event)
+
+    def close(self):
+        """Unsubscribes from all hosts and stops the worker once queued events are handled"""
+        for name, (conn, callback_id) in self._callbacks.items():
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError as e:
+                logger.debug('Cannot deregister lifecycle callback on "%s": %s', name, e)
+        self._callbacks.clear()
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from .base import SlotsRepr
+from .config import DEFAULT_STATE_DIR
+
+
+logger = logging.getLogger(__name__)
+
+# LIBVIRT_MGR_JOURNAL overrides it
+DEFAULT_JOURNAL_PATH = os.path.join(DEFAULT_STATE_DIR, 'journal.jsonl')
+
+PHASE_PLANNED = 'planned'
+PHASE_STOPPED = 'stopped'
+PHASE_MIGRATING = 'migrating'
+PHASE_MIGRATED = 'migrated'
+PHASE_STARTED = 'started'
+PHASE_FAILED = 'failed'
+PHASE_SKIPPED = 'skipped'
+# Nothing is left to do for domains in these phases, migrated ones may still need to be started
+FINAL_PHASES = (PHASE_STARTED, PHASE_FAILED, PHASE_SKIPPED)
+
+
+class JournalEntry(SlotsRepr):
+    """Latest known phase of a domain in a batch"""
+    __slots__ = ('uuid', 'name', 'src_host', 'dst_host', 'active', 'offline', 'phase', 'error', 'updated')
+
+    def __init__(
+        self,
+        uuid: str,
+        name: str,
+        src_host: str,
+        dst_host: str,
+        active: bool,
+        offline: bool,
+        phase: str = PHASE_PLANNED,
+        error: Optional[str] = None,
+        updated: float = 0.0,
+    ):
+        self.uuid = uuid
+        self.name = name
+        self.src_host = src_host
+        self.dst_host = dst_host
+        # Whether the domain was running when the batch was planned
+        self.active = active
+        # Whether the migration is offline, the domain is started on the destination afterwards if auto_start is set
+        self.offline = offline
+        self.phase = phase
+        self.error = error
+        # Unix timestamp of the last phase change
+        self.updated = updated
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class Journal:
+    """Write-ahead log of the phase of every domain in a batch, so an interrupted batch can be finished later
+
+    Every phase change is appended as a JSON line and synced to disk before the step it describes is taken. Only the
+    latest batch is kept, starting a new one while the previous is unfinished is refused. Without a path nothing is
+    written to disk.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.batch: Optional[Dict[str, Any]] = None
+        self.entries: Dict[str, JournalEntry] = {}
+        self._lock = threading.Lock()
+        self._file = None
+        # Whether the last line is incomplete, the next record has to start on a new line
+        self._torn = False
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                self._torn = not line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line is torn if the process was killed while writing it
+                    logger.warning('Ignoring unreadable line in journal %s', self.path)
+                    continue
+                self._apply(record)
+
+    def _apply(self, record: Dict[str, Any]):
+        if record['event'] == 'batch':
+            self.batch = record
+            self.entries = {}
+        elif record['event'] == 'plan':
+            entry = JournalEntry(**record['entry'])
+            self.entries[entry.uuid] = entry
+        elif record['event'] == 'phase':
+            entry = self.entries.get(record['uuid'])
+            if entry is not None:
+                entry.phase = record['phase']
+                entry.error = record.get('error')
+                entry.updated = record['timestamp']
+
+    def _write(self, record: Dict[str, Any]):
+        """Applies record and appends it to the journal, must be called with the lock held"""
+        self._apply(record)
+        if self.path is None:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if self._torn:
+                self._file.write('\n')
+                self._torn = False
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def is_finished(self, entry: JournalEntry) -> bool:
+        if entry.phase in FINAL_PHASES:
+            return True
+        return entry.phase == PHASE_MIGRATED and not (entry.offline and self.batch.get('auto_start'))
+
+    def unfinished(self) -> List[JournalEntry]:
+        with self._lock:
+            return [e for e in self.entries.values() if not self.is_finished(e)]
+
+    def begin(self, entries: List[JournalEntry], auto_stop: bool, auto_start: bool, command: Optional[str] = None):
+        """Starts a new batch, replacing the previous one if it was finished"""
+        unfinished = self.unfinished()
+        if unfinished:
+            raise Exception(f'Journal {self.path} has an unfinished batch with {len(unfinished)} domains left, '
+                            f'finish it with "virtmgr resume" or remove the journal')
+        now = time.time()
+        records = [{'event': 'batch', 'id': str(uuid4()), 'timestamp': now, 'command': command,
+                    'auto_stop': auto_stop, 'auto_start': auto_start}]
+        for entry in entries:
+            entry.updated = now
+            records.append({'event': 'plan', 'timestamp': now, 'entry': entry.to_dict()})
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self.path is not None:
+                # Replace the previous batch atomically, it must not be lost if we are killed while writing
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.journal-')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        for record in records:
+                            f.write(json.dumps(record, sort_keys=True) + '\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            self._torn = False
+            for record in records:
+                self._apply(record)
+
+    def record(self, uuid: str, phase: str, error: Optional[str] = None):
+        """Records that a domain has entered phase"""
+        record = {'event': 'phase', 'timestamp': time.time(), 'uuid': uuid, 'phase': phase}
+        if error is not None:
+            record['error'] = error
+        with self._lock:
+            self._write(record)
+
+
+def get_journal_path(path: Optional[str] = None) -> str:
+    return path or os.getenv('LIBVIRT_MGR_JOURNAL', DEFAULT_JOURNAL_PATH)
+
+
+def open_journal(path: Optional[str] = None) -> Journal:
+    """Opens the journal at path, falling back to one which is not written to disk if it cannot be used"""
+    path = get_journal_path(path)
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if not os.access(os.path.dirname(path) or '.', os.W_OK):
+            raise PermissionError(f'{os.path.dirname(path)} is not writable')
+        return Journal(path)
+    except OSError as e:
+        logger.warning('Cannot open journal %s, interrupted batches cannot be resumed: %s', path, e)
+        return Journal()
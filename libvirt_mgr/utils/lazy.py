@@ -0,0 +1,35 @@
+import importlib
+import threading
+from types import ModuleType
+from typing import Optional
+
+
+class LazyModule:
+    """Imports a module on first attribute access
+
+    Python 3.6 has no module level __getattr__, so modules import this proxy instead. Annotations referring to the
+    module must be strings, otherwise they import it when the function is defined.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module: Optional[ModuleType] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> ModuleType:
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+            return self._module
+
+    def __getattr__(self, item: str):
+        # Only called for attributes not found normally, i.e. everything from the real module
+        module = self._module or self._load()
+        return getattr(module, item)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<{self.__class__.__name__} {self._name} ({state})>'
+
+
+libvirt = LazyModule('libvirt')
@@ -1,6 +1,6 @@
-from typing import List
+from typing import Any, Dict, List, Tuple
 
-import libvirt
+from .lazy import libvirt
 
 
 def get_migrate_flags(flags: List[str]) -> int:
@@ -12,3 +12,75 @@ def get_migrate_flags(flags: List[str]) -> int:
             raise Exception(f'No flag "{f.upper()}" exists')
         ret |= val
     return ret
+
+
+# Names of VIR_CONNECT_LIST_DOMAINS_* filters, states within the same group are OR'd, different groups are AND'd
+DOMAIN_LIST_STATES = ('active', 'inactive', 'persistent', 'transient', 'running', 'paused', 'shutoff', 'other')
+
+
+def get_list_flags(states: List[str]) -> int:
+    """Returns listAllDomains flags OR'd together from a list of state names as strings"""
+    ret = 0
+    for s in states:
+        val = getattr(libvirt, f'VIR_CONNECT_LIST_DOMAINS_{s.upper()}', None)
+        if not val:
+            raise Exception(f'No domain state "{s.upper()}" exists')
+        ret |= val
+    return ret
+
+
+# Names of virDomainState values, indexed by value
+DOMAIN_STATE_NAMES = ('nostate', 'running', 'blocked', 'paused', 'shutdown', 'shutoff', 'crashed', 'pmsuspended')
+
+
+def get_state_name(state: int) -> str:
+    if 0 <= state < len(DOMAIN_STATE_NAMES):
+        return DOMAIN_STATE_NAMES[state]
+    return 'unknown'
+
+
+# Types of VIR_MIGRATE_PARAM_* values, parameters not listed are non-negative integers
+MIGRATE_PARAM_TYPES = {
+    'compression': list,
+    'migrate_disks': list,
+    'dest_name': str,
+    'dest_xml': str,
+    'persist_xml': str,
+    'uri': str,
+    'graphics_uri': str,
+    'listen_address': str,
+    'disks_uri': str,
+    'tls_destination': str,
+}
+# Migration flags required for parameters starting with these names to have any effect
+MIGRATE_PARAM_FLAGS = {
+    'parallel_connections': 'parallel',
+    'compression': 'compressed',
+    'auto_converge': 'auto_converge',
+}
+
+
+def get_migrate_params(params: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    """Returns migrate3 parameters and the flags they require from a dict of parameter names and values"""
+    ret = {}
+    flags = []
+    for name, value in params.items():
+        key = getattr(libvirt, f'VIR_MIGRATE_PARAM_{name.upper()}', None)
+        if not key:
+            raise Exception(f'No migration parameter "{name.upper()}" exists')
+        param_type = MIGRATE_PARAM_TYPES.get(name, int)
+        if param_type is list:
+            if isinstance(value, str):
+                value = [value]
+            if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                raise Exception(f'Migration parameter "{name}" must be a list of strings')
+        elif param_type is str:
+            if not isinstance(value, str):
+                raise Exception(f'Migration parameter "{name}" must be a string')
+        elif not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise Exception(f'Migration parameter "{name}" must be a non-negative integer')
+        ret[key] = value
+        for prefix, flag in MIGRATE_PARAM_FLAGS.items():
+            if name.startswith(prefix):
+                flags.append(flag)
+    return ret, get_migrate_flags(flags)
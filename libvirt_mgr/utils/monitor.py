@@ -0,0 +1,245 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .lazy import libvirt
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROGRESS_INTERVAL = 10
+DEFAULT_PAGE_SIZE = 4096
+# Seconds between job stats polls while observers are acting on the migration
+OBSERVER_POLL_INTERVAL = 1
+
+# Called with the domain and its latest job stats on every poll
+JobObserver = Callable[['libvirt.virDomain', Dict[str, Any]], None]
+
+
+def format_size(size: float) -> str:
+    """Returns a human readable binary size"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TiB'
+
+
+# Multipliers of size suffixes, all binary
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """Returns bytes from a size with an optional binary suffix, such as 512M, 4G or 1.5TiB"""
+    value = size.strip().upper()
+    for suffix in ('IB', 'B'):
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+            break
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise Exception(f'Invalid size "{size}"') from None
+
+
+def format_table(rows: List[Tuple[str, ...]]) -> str:
+    """Returns rows as left aligned columns, the first row being the header"""
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(f'{v:<{w}}' for v, w in zip(r, widths)).rstrip() for r in rows)
+
+
+def summarize_job_stats(stats: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the interesting values from virDomain.jobStats(), with rates converted to bytes per second"""
+    page_size = stats.get('memory_page_size', DEFAULT_PAGE_SIZE)
+    bps = stats.get('memory_bps', 0)
+    remaining = stats.get('data_remaining', 0)
+    return {
+        'elapsed': stats.get('time_elapsed', 0) / 1000,
+        'data_total': stats.get('data_total', 0),
+        'data_processed': stats.get('data_processed', 0),
+        'data_remaining': remaining,
+        'throughput': bps,
+        'dirty_rate': stats.get('memory_dirty_rate', 0) * page_size,
+        'iteration': stats.get('memory_iteration', 0),
+        # Time to send what is left at the current rate, a rough estimate of the final pause
+        'expected_downtime': remaining / bps if bps else None,
+        'downtime': stats.get('downtime', 0) / 1000 if 'downtime' in stats else None,
+    }
+
+
+def get_completed_job_stats(dom: 'libvirt.virDomain') -> Optional[Dict[str, Any]]:
+    """Returns stats of the most recently completed job of a domain, if still available"""
+    try:
+        return dom.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED) or None
+    except libvirt.libvirtError as e:
+        logger.debug('Cannot get completed job stats: %s', e)
+        return None
+
+
+class MetricsWriter:
+    """Thread-safe writer of JSON lines records"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class MigrationMonitor(threading.Thread):
+    """Polls the job stats of a migrating domain, reports progress and passes every sample to observers"""
+
+    def __init__(
+        self,
+        dom: 'libvirt.virDomain',
+        name: str,
+        interval: float,
+        metrics: Optional[MetricsWriter] = None,
+        observers: Optional[List[JobObserver]] = None,
+        log_progress: bool = True,
+        report_interval: Optional[float] = None,
+    ):
+        super().__init__(name=f'monitor-{name}', daemon=True)
+        self.dom = dom
+        self.domain_name = name
+        # Seconds between polls, observers see every sample
+        self.interval = interval
+        # Seconds between progress reports, defaults to every poll
+        self.report_interval = report_interval or interval
+        self.metrics = metrics
+        self.observers = observers or []
+        self.log_progress = log_progress
+        self.last_stats: Optional[Dict[str, Any]] = None
+        self._last_report = time.monotonic()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                stats = self.dom.jobStats()
+            except libvirt.libvirtError as e:
+                logger.debug('Cannot get job stats for "%s": %s', self.domain_name, e)
+                continue
+            # Migration job has not started yet, or has already finished
+            if not stats or stats.get('type', 0) == 0:
+                continue
+            self.last_stats = stats
+            now = time.monotonic()
+            # Polls are not perfectly periodic, allow reports to be a little early
+            if now - self._last_report >= self.report_interval - self.interval / 2:
+                self._last_report = now
+                self.report(stats)
+            for observer in self.observers:
+                try:
+                    observer(self.dom, stats)
+                except Exception as e:
+                    logger.warning('Job observer failed for "%s"', self.domain_name, exc_info=e)
+
+    def report(self, stats: Dict[str, Any]):
+        summary = summarize_job_stats(stats)
+        if self.log_progress:
+            total = summary['data_total']
+            logger.info(
+                '"%s" progress: %.1f%% of %s, %s remaining, %s/s, dirty %s/s, iteration %d, expected downtime %s',
+                self.domain_name,
+                100 * summary['data_processed'] / total if total else 0,
+                format_size(total),
+                format_size(summary['data_remaining']),
+                format_size(summary['throughput']),
+                format_size(summary['dirty_rate']),
+                summary['iteration'],
+                '-' if summary['expected_downtime'] is None else f'{summary["expected_downtime"] * 1000:.0f}ms',
+            )
+        if self.metrics:
+            self.metrics.write({'event': 'progress', 'domain': self.domain_name, 'timestamp': time.time(), **summary})
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+class ProgressReporter:
+    """Creates migration monitors and records per domain results, optionally to a JSON lines metrics file"""
+
+    def __init__(self, interval: float = DEFAULT_PROGRESS_INTERVAL, metrics_file: Optional[str] = None):
+        self.interval = interval
+        self.metrics = MetricsWriter(metrics_file) if metrics_file else None
+
+    def close(self):
+        if self.metrics:
+            self.metrics.close()
+
+    @contextmanager
+    def monitor(
+        self,
+        dom: 'libvirt.virDomain',
+        name: str,
+        observers: Optional[List[JobObserver]] = None,
+        poll_interval: Optional[float] = None,
+    ):
+        """Monitors a migration while the context is active, logging is disabled if interval is 0
+
+        Job stats are polled every poll_interval seconds if given and observers need more frequent samples than
+        progress is reported at.
+        """
+        interval = self.interval if self.interval > 0 else DEFAULT_PROGRESS_INTERVAL
+        monitor = MigrationMonitor(
+            dom,
+            name,
+            min(poll_interval, interval) if poll_interval else interval,
+            self.metrics,
+            observers,
+            log_progress=self.interval > 0,
+            report_interval=interval,
+        )
+        monitor.start()
+        try:
+            yield monitor
+        finally:
+            monitor.stop()
+
+    def report_result(
+        self,
+        name: str,
+        src_host: str,
+        dst_host: str,
+        status: str,
+        duration: float,
+        stats: Optional[Dict[str, Any]] = None,
+    ):
+        """Logs and records the final statistics of a migration"""
+        summary = summarize_job_stats(stats) if stats else {}
+        if summary:
+            logger.info(
+                '"%s" transferred %s in %.1fs, downtime %s',
+                name,
+                format_size(summary['data_processed']),
+                duration,
+                '-' if summary['downtime'] is None else f'{summary["downtime"] * 1000:.0f}ms',
+            )
+        if self.metrics:
+            self.metrics.write({
+                'event': 'result',
+                'domain': name,
+                'src_host': src_host,
+                'dst_host': dst_host,
+                'status': status,
+                'duration': duration,
+                'timestamp': time.time(),
+                'data_processed': summary.get('data_processed'),
+                'downtime': summary.get('downtime'),
+            })
@@ -0,0 +1,48 @@
+import logging
+from typing import Any, Dict, Optional
+
+from .config import PostCopyConfig
+from .lazy import libvirt
+from .monitor import format_size, summarize_job_stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class PostCopySwitch:
+    """Job observer switching a migration to post-copy once pre-copy is not converging, at most once"""
+
+    def __init__(self, policy: PostCopyConfig, name: str):
+        self.policy = policy
+        self.domain_name = name
+        # Why the switch was made, None until then
+        self.reason: Optional[str] = None
+        self.switched = False
+
+    def check(self, summary: Dict[str, Any]) -> Optional[str]:
+        """Returns why summarized job stats call for a switch, None if pre-copy should continue"""
+        policy = self.policy
+        iteration = summary['iteration']
+        if policy.max_iterations is not None and iteration >= policy.max_iterations:
+            return f'iteration {iteration} reached the limit of {policy.max_iterations}'
+        if policy.max_time is not None and summary['elapsed'] >= policy.max_time:
+            return f'pre-copy ran for {summary["elapsed"]:.1f}s, limit is {policy.max_time}s'
+        # Dirty rate is only known once the first pass over memory is done
+        if policy.dirty_ratio is not None and iteration >= 2 and summary['throughput']:
+            ratio = summary['dirty_rate'] / summary['throughput']
+            if ratio >= policy.dirty_ratio:
+                return (f'memory is dirtied at {format_size(summary["dirty_rate"])}/s, {ratio:.2f} of the '
+                        f'{format_size(summary["throughput"])}/s transfer rate')
+        return None
+
+    def __call__(self, dom: 'libvirt.virDomain', stats: Dict[str, Any]):
+        if self.switched:
+            return
+        reason = self.check(summarize_job_stats(stats))
+        if reason is None:
+            return
+        logger.warning('Switching "%s" to post-copy, %s', self.domain_name, reason)
+        # Failures are retried with the next sample
+        dom.migrateStartPostCopy(0)
+        self.reason = reason
+        self.switched = True
@@ -0,0 +1,265 @@
+import logging
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from .base import SlotsRepr
+from .cache import TTLCache
+from .lazy import libvirt
+from .monitor import format_size
+from .storage import parse_disk_paths
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds host capabilities are reused for, they only change with host upgrades or reconfiguration
+DEFAULT_CAPABILITIES_TTL = 600
+# Domains checked at once
+DEFAULT_PREFLIGHT_WORKERS = 16
+# CPU modes which require the destination host CPU to provide all features of the source host's
+HOST_CPU_MODES = ('host-passthrough', 'host-model')
+
+
+class HostCapabilities(SlotsRepr):
+    """What a host can offer to domains, None where it could not be determined"""
+    __slots__ = ('name', 'cpu', 'cpu_models', 'networks', 'active_networks', 'pools', 'active_pools', 'pool_paths')
+
+    def __init__(self, name: str):
+        self.name = name
+        # <cpu> element of the host capabilities
+        self.cpu: Optional[str] = None
+        # CPU models usable by custom mode domains
+        self.cpu_models: Optional[Set[str]] = None
+        # Names of all and of active networks and storage pools
+        self.networks: Optional[Set[str]] = None
+        self.active_networks: Optional[Set[str]] = None
+        self.pools: Optional[Set[str]] = None
+        self.active_pools: Optional[Set[str]] = None
+        # Target path of active storage pools by name
+        self.pool_paths: Dict[str, str] = {}
+
+    def find_pool(self, path: str) -> Optional[str]:
+        """Returns the name of the active pool containing path"""
+        for name, target in self.pool_paths.items():
+            if os.path.dirname(path) == target.rstrip('/'):
+                return name
+        return None
+
+
+def _try(host: str, what: str, func: Callable, *args) -> Any:
+    try:
+        return func(*args)
+    except libvirt.libvirtError as e:
+        logger.debug('Cannot get %s of "%s": %s', what, host, e)
+        return None
+
+
+def get_host_capabilities(conn: 'libvirt.virConnect', name: str) -> HostCapabilities:
+    """Gathers capabilities of a host with a few calls, independent of how many domains it has"""
+    caps = HostCapabilities(name)
+    xml = _try(name, 'capabilities', conn.getCapabilities)
+    arch = None
+    if xml:
+        cpu = ET.fromstring(xml).find('host/cpu')
+        if cpu is not None:
+            arch = cpu.findtext('arch')
+            caps.cpu = ET.tostring(cpu, encoding='unicode')
+    xml = _try(name, 'domain capabilities', conn.getDomainCapabilities, None, arch, None, None, 0)
+    if xml:
+        models = ET.fromstring(xml).findall("cpu/mode[@name='custom']/model")
+        if models:
+            caps.cpu_models = {m.text for m in models if m.get('usable', 'yes') != 'no' and m.text}
+    active = _try(name, 'networks', conn.listNetworks)
+    defined = _try(name, 'networks', conn.listDefinedNetworks)
+    if active is not None and defined is not None:
+        caps.active_networks = set(active)
+        caps.networks = set(active) | set(defined)
+    active = _try(name, 'storage pools', conn.listStoragePools)
+    defined = _try(name, 'storage pools', conn.listDefinedStoragePools)
+    if active is not None and defined is not None:
+        caps.active_pools = set(active)
+        caps.pools = set(active) | set(defined)
+        for pool_name in active:
+            pool = _try(name, f'storage pool "{pool_name}"', conn.storagePoolLookupByName, pool_name)
+            pool_xml = pool and _try(name, f'storage pool "{pool_name}"', pool.XMLDesc, 0)
+            target = pool_xml and ET.fromstring(pool_xml).findtext('target/path')
+            if target:
+                caps.pool_paths[pool_name] = target
+    return caps
+
+
+class CapabilityCache:
+    """Thread-safe cache of host capabilities and CPU compatibility between hosts, entries expire after ttl seconds
+
+    Concurrent lookups of the same entry wait for the first one instead of repeating its calls.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_CAPABILITIES_TTL):
+        self._cache = TTLCache(ttl)
+
+    def get(self, conn: 'libvirt.virConnect', host: str) -> HostCapabilities:
+        return self._cache.load(('caps', host), lambda: get_host_capabilities(conn, host))
+
+    def cpu_compatible(self, src: HostCapabilities, dst_conn: 'libvirt.virConnect', dst: str) -> Optional[bool]:
+        """Returns whether the destination CPU provides all features of the source host's, None if unknown"""
+        if src.cpu is None:
+            return None
+
+        def _compare():
+            result = _try(dst, 'CPU comparison', dst_conn.compareCPU, src.cpu, 0)
+            if result is None or result == libvirt.VIR_CPU_COMPARE_ERROR:
+                return None
+            return result in (libvirt.VIR_CPU_COMPARE_IDENTICAL, libvirt.VIR_CPU_COMPARE_SUPERSET)
+
+        return self._cache.load(('cpu', src.name, dst), _compare)
+
+    def clear(self):
+        self._cache.clear()
+
+
+_default_cache = CapabilityCache()
+
+
+class DomainRequirements:
+    """What a domain needs from the host it runs on, parsed from its XML"""
+    __slots__ = ('cpu_mode', 'cpu_model', 'networks', 'pools', 'disk_paths')
+
+    def __init__(self, xml: str):
+        root = ET.fromstring(xml)
+        cpu = root.find('cpu')
+        self.cpu_mode: Optional[str] = None
+        self.cpu_model: Optional[str] = None
+        if cpu is not None:
+            self.cpu_mode = cpu.get('mode', 'custom')
+            self.cpu_model = cpu.findtext('model')
+        self.networks = {s.get('network') for s in root.findall("devices/interface[@type='network']/source")}
+        self.networks.discard(None)
+        self.pools = {s.get('pool') for s in root.findall("devices/disk[@type='volume']/source")}
+        self.pools.discard(None)
+        self.disk_paths = parse_disk_paths(xml)
+
+
+def check_hosts(src: HostCapabilities, dst: HostCapabilities, live: bool, cpu_compatible: Optional[bool]) -> List[str]:
+    """Returns what the destination lacks compared to the source, nothing means any domain of the source can move"""
+    problems = []
+    for what, have, need in (
+        ('networks', dst.active_networks, src.networks),
+        ('storage pools', dst.active_pools, src.pools),
+        ('CPU models', dst.cpu_models, src.cpu_models),
+    ):
+        if have is None:
+            continue
+        if need is None:
+            problems.append(f'{what} unknown')
+        elif need - have:
+            problems.append(f'{what} {", ".join(sorted(need - have))}')
+    if live and cpu_compatible is False:
+        problems.append('host CPU')
+    return problems
+
+
+def check_domain(
+    req: DomainRequirements,
+    src: HostCapabilities,
+    dst: HostCapabilities,
+    runs: bool,
+    live: bool,
+    cpu_compatible: Optional[bool],
+    copy_disks: bool = False,
+) -> List[str]:
+    """Returns why a domain cannot be migrated to the destination, empty if it can as far as is known
+
+    CPU, networks and volumes are only checked if the domain will be running on the destination, pools of its disks
+    only if they are copied.
+    """
+    problems = []
+    pools = set()
+    if runs:
+        if (req.cpu_mode == 'custom' and req.cpu_model and dst.cpu_models is not None
+                and req.cpu_model not in dst.cpu_models):
+            problems.append(f'CPU model "{req.cpu_model}" is not usable on "{dst.name}"')
+        if live and req.cpu_mode in HOST_CPU_MODES and cpu_compatible is False:
+            problems.append(f'CPU of "{dst.name}" lacks features of "{src.name}" required by {req.cpu_mode}')
+        if dst.active_networks is not None:
+            for network in sorted(req.networks - dst.active_networks):
+                problems.append(f'network "{network}" is not active on "{dst.name}"')
+        pools.update(req.pools)
+    if copy_disks:
+        pools.update(p for p in (src.find_pool(path) for path in req.disk_paths) if p is not None)
+    if dst.active_pools is not None:
+        for pool in sorted(pools - dst.active_pools):
+            problems.append(f'storage pool "{pool}" is not active on "{dst.name}"')
+    return problems
+
+
+def needs_memory(task, auto_start: bool = True) -> bool:
+    """Whether the domain of a task will be running on its destination"""
+    if not task.domain.active:
+        return False
+    return bool(task.flags & libvirt.VIR_MIGRATE_LIVE) or auto_start
+
+
+def preflight_tasks(
+    tasks: List,
+    auto_start: bool = True,
+    cache: Optional[CapabilityCache] = None,
+    workers: int = DEFAULT_PREFLIGHT_WORKERS,
+) -> List[List[str]]:
+    """Checks whether each task's domain can run on its destination, returns the problems found for each task
+
+    Tasks are checked concurrently. Domain XML is only fetched when the destination lacks something the source host
+    has, so batches between similar hosts cost a few calls per host. Memory of all domains which will be running on
+    a destination has to fit in its free memory, in task order, plus the memory of running domains leaving it.
+    """
+    if not tasks:
+        return []
+    if cache is None:
+        cache = _default_cache
+
+    def _check(task) -> List[str]:
+        runs = needs_memory(task, auto_start)
+        copy_disks = (bool(task.flags & libvirt.VIR_MIGRATE_OFFLINE) and task.group.copy_disks
+                      and task.src_host.group != task.dst_host.group)
+        if not runs and not copy_disks:
+            return []
+        src = cache.get(task.src_conn, task.src_host.name)
+        dst = cache.get(task.dst_conn, task.dst_host.name)
+        live = bool(task.flags & libvirt.VIR_MIGRATE_LIVE) and task.domain.active
+        cpu_compatible = cache.cpu_compatible(src, task.dst_conn, task.dst_host.name) if live else None
+        lacking = check_hosts(src, dst, live, cpu_compatible)
+        if not lacking:
+            return []
+        logger.debug('"%s" lacks %s of "%s", checking "%s"', dst.name, ', '.join(lacking), src.name, task.domain.name)
+        try:
+            req = DomainRequirements(task.domain.dom.XMLDesc(0))
+        except libvirt.libvirtError as e:
+            return [f'cannot get definition: {e}']
+        return check_domain(req, src, dst, runs, live, cpu_compatible, copy_disks)
+
+    def _free_memory(task) -> Optional[int]:
+        return _try(task.dst_host.name, 'free memory', task.dst_conn.getFreeMemory)
+
+    destinations = {t.dst_host.name: t for t in tasks if needs_memory(t, auto_start)}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tasks)))) as executor:
+        free_futures = {name: executor.submit(_free_memory, t) for name, t in destinations.items()}
+        problems = list(executor.map(_check, tasks))
+        free_memory = {name: f.result() for name, f in free_futures.items()}
+    used: Dict[str, int] = {}
+    # Running domains migrated away from a destination in the same batch free their memory
+    for task, task_problems in zip(tasks, problems):
+        name = task.src_host.name
+        if name in free_memory and free_memory[name] is not None and task.domain.active and not task_problems:
+            free_memory[name] += task.domain.memory or 0
+    for task, task_problems in zip(tasks, problems):
+        name = task.dst_host.name
+        if task_problems or not needs_memory(task, auto_start) or not task.domain.memory or free_memory[name] is None:
+            continue
+        if used.get(name, 0) + task.domain.memory > free_memory[name]:
+            task_problems.append(
+                f'needs {format_size(task.domain.memory)} of memory, '
+                f'{format_size(max(0, free_memory[name] - used.get(name, 0)))} left on "{name}"'
+            )
+            continue
+        used[name] = used.get(name, 0) + task.domain.memory
+    return problems
@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, TypeVar
+
+from .base import SlotsRepr
+from .cache import TTLCache
+from .config import HostConfig
+from .connection import ConnectionPool
+from .domains import DomainRecord, get_domain_resources, list_domains
+from .lazy import libvirt
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Seconds before probed host stats are considered stale
+DEFAULT_PROBE_TTL = 30
+# Seconds to wait for all hosts to respond
+DEFAULT_PROBE_TIMEOUT = 10
+# Seconds between the two CPU samples used to calculate current CPU usage
+CPU_SAMPLE_INTERVAL = 0.2
+
+# Relative weight of each metric when scoring hosts, must add up to 1
+SCORE_WEIGHT_MEMORY = 0.5
+SCORE_WEIGHT_CPU = 0.3
+SCORE_WEIGHT_DOMAINS = 0.2
+
+
+class HostStats(SlotsRepr):
+    """Resource usage snapshot of a hypervisor"""
+    __slots__ = ('name', 'cpus', 'memory_total', 'memory_free', 'cpu_usage', 'domains', 'timestamp')
+
+    def __init__(
+        self,
+        name: str,
+        cpus: int,
+        memory_total: int,
+        memory_free: int,
+        cpu_usage: float,
+        domains: int,
+        timestamp: Optional[float] = None,
+    ):
+        self.name = name
+        self.cpus = cpus
+        # Memory in bytes
+        self.memory_total = memory_total
+        self.memory_free = memory_free
+        # Fraction of CPU time spent not idle, between 0 and 1
+        self.cpu_usage = cpu_usage
+        self.domains = domains
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+
+    @property
+    def score(self) -> float:
+        """Returns how suitable this host is as a migration target, higher is better"""
+        free_memory = self.memory_free / self.memory_total if self.memory_total else 0
+        density = self.domains / self.cpus if self.cpus else self.domains
+        return (
+            SCORE_WEIGHT_MEMORY * free_memory
+            + SCORE_WEIGHT_CPU * (1 - self.cpu_usage)
+            + SCORE_WEIGHT_DOMAINS / (1 + density)
+        )
+
+    def reserve(self, memory: int):
+        """Accounts for a domain about to be migrated to this host"""
+        self.memory_free = max(self.memory_free - memory, 0)
+        self.domains += 1
+
+
+class HostStatsCache:
+    """Thread-safe cache of host stats and of hosts which could not be probed, entries expire after ttl seconds"""
+
+    def __init__(self, ttl: float = DEFAULT_PROBE_TTL):
+        self._stats = TTLCache(ttl)
+        self._failed = TTLCache(ttl)
+
+    def get(self, name: str) -> Optional[HostStats]:
+        return self._stats.get(name)
+
+    def set(self, stats: HostStats):
+        self._stats.set(stats.name, stats, stats.timestamp)
+        self._failed.pop(stats.name)
+
+    def failed(self, name: str) -> bool:
+        """Whether probing the host failed or timed out within ttl seconds"""
+        return self._failed.get(name) is not None
+
+    def set_failed(self, name: str):
+        self._failed.set(name, True)
+
+    def clear(self):
+        self._stats.clear()
+        self._failed.clear()
+
+
+_default_cache = HostStatsCache()
+
+
+def _cpu_times(conn: 'libvirt.virConnect'):
+    stats = conn.getCPUStats(libvirt.VIR_NODE_CPU_STATS_ALL_CPUS)
+    return sum(stats.values()), stats.get('idle', 0) + stats.get('iowait', 0)
+
+
+def probe_host(conn: 'libvirt.virConnect', name: str) -> HostStats:
+    """Queries the resources in use on a hypervisor"""
+    # [model, memory MiB, cpus, mhz, nodes, sockets, cores, threads]
+    info = conn.getInfo()
+    total_before, idle_before = _cpu_times(conn)
+    time.sleep(CPU_SAMPLE_INTERVAL)
+    total_after, idle_after = _cpu_times(conn)
+    total = total_after - total_before
+    cpu_usage = 1 - (idle_after - idle_before) / total if total > 0 else 0.0
+    return HostStats(
+        name=name,
+        cpus=info[2],
+        memory_total=info[1] * 1024 * 1024,
+        memory_free=conn.getFreeMemory(),
+        cpu_usage=min(max(cpu_usage, 0.0), 1.0),
+        domains=conn.numOfDomains(),
+    )
+
+
+def probe_hosts(
+    hosts: List[HostConfig],
+    pool: ConnectionPool,
+    timeout: float = DEFAULT_PROBE_TIMEOUT,
+    cache: Optional[HostStatsCache] = None,
+) -> Dict[str, HostStats]:
+    """Probes hosts concurrently, returns stats for all hosts which responded within timeout
+
+    Cached stats are returned without contacting the host again, hosts which recently failed are left out.
+    """
+    if cache is None:
+        cache = _default_cache
+    ret: Dict[str, HostStats] = {}
+    to_probe: List[HostConfig] = []
+    for host in hosts:
+        stats = cache.get(host.name)
+        if stats is not None:
+            ret[host.name] = stats
+        elif not cache.failed(host.name):
+            to_probe.append(host)
+    if not to_probe:
+        return ret
+
+    def _probe(host: HostConfig) -> HostStats:
+        return probe_host(pool.get(host), host.name)
+
+    results = run_on_hosts(to_probe, _probe, timeout)
+    for host in to_probe:
+        stats = results.get(host.name)
+        if stats is None:
+            cache.set_failed(host.name)
+            continue
+        logger.debug('Probed %s', stats)
+        cache.set(stats)
+        ret[host.name] = stats
+    return ret
+
+
+def run_on_hosts(hosts: List[HostConfig], func: Callable[[HostConfig], T], timeout: float) -> Dict[str, T]:
+    """Calls func for every host concurrently, returns results of hosts which succeeded within timeout
+
+    Each host gets a daemon thread, so a hung host neither delays the caller past timeout nor keeps the process from
+    exiting. Its result is discarded if it ever returns.
+    """
+    lock = threading.Lock()
+    ret: Dict[str, T] = {}
+    finished = False
+
+    def _run(host: HostConfig):
+        try:
+            result = func(host)
+        except Exception as e:
+            logger.warning('Cannot query host "%s": %s', host.name, e)
+            return
+        with lock:
+            if not finished:
+                ret[host.name] = result
+
+    threads = [threading.Thread(target=_run, args=(h,), name=f'probe-{h.name}', daemon=True) for h in hosts]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for host, thread in zip(hosts, threads):
+        thread.join(max(deadline - time.monotonic(), 0))
+        if thread.is_alive():
+            logger.warning('Host "%s" did not respond within %ss', host.name, timeout)
+    with lock:
+        finished = True
+        return dict(ret)
+
+
+class HostSnapshot:
+    """Stats of a host together with its active domains and their resources"""
+    __slots__ = ('stats', 'domains')
+
+    def __init__(self, stats: HostStats, domains: List[DomainRecord]):
+        self.stats = stats
+        self.domains = domains
+
+
+def snapshot_hosts(
+    hosts: List[HostConfig],
+    pool: ConnectionPool,
+    timeout: float = DEFAULT_PROBE_TIMEOUT,
+) -> Dict[str, HostSnapshot]:
+    """Takes a fresh snapshot of every host concurrently, hosts which do not respond within timeout are left out"""
+
+    def _snapshot(host: HostConfig) -> HostSnapshot:
+        conn = pool.get(host)
+        domains = list_domains(conn, libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        get_domain_resources(conn, domains)
+        return HostSnapshot(probe_host(conn, host.name), domains)
+
+    return run_on_hosts(hosts, _snapshot, timeout)
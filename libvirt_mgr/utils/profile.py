@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .lazy import libvirt
+from .monitor import format_table
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of latency histogram buckets in seconds, migrations and shutdowns can take minutes
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, float('inf'))
+PROFILE_FORMATS = ('table', 'json', 'prometheus')
+PROMETHEUS_METRIC = 'libvirt_mgr_rpc_duration_seconds'
+
+# Profiler used by connection pools and spans, None when profiling is disabled
+_profiler: Optional['RpcProfiler'] = None
+
+
+class CallStats:
+    """Count, cumulative time and latency histogram of calls to one method on one host"""
+    __slots__ = ('count', 'errors', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Calls per bucket in LATENCY_BUCKETS, not cumulative
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, elapsed: float, error: bool = False):
+        self.count += 1
+        self.errors += int(error)
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self) -> Dict[str, Any]:
+        cumulative = 0
+        buckets = {}
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            cumulative += n
+            buckets[_format_bound(bound)] = cumulative
+        return {'count': self.count, 'errors': self.errors, 'total': self.total, 'max': self.max, 'buckets': buckets}
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class ProfiledObject:
+    """Proxy recording the time of every method call on a libvirt object, objects returned are profiled as well"""
+    __slots__ = ('_target', '_host', '_profiler')
+
+    def __init__(self, target: Any, host: str, profiler: 'RpcProfiler'):
+        self._target = target
+        self._host = host
+        self._profiler = profiler
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        profiler, host = self._profiler, self._host
+
+        def _call(*args, **kwargs):
+            # Domains returned by migrations are on the destination
+            dst_host = next((a._host for a in args if isinstance(a, ProfiledObject)), host)
+            result = profiler.call(host, name, attr, *(_unwrap(a) for a in args), **kwargs)
+            return profiler.wrap_result(result, dst_host)
+
+        return _call
+
+    def __eq__(self, other):
+        return self._target == _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({repr(self._target)}, host={repr(self._host)})'
+
+
+def _unwrap(obj: Any) -> Any:
+    if isinstance(obj, ProfiledObject):
+        return obj._target
+    if isinstance(obj, list):
+        return [o._target if isinstance(o, ProfiledObject) else o for o in obj]
+    return obj
+
+
+class RpcProfiler:
+    """Collects call statistics per host and method, thread-safe
+
+    Objects of wrap_types returned by profiled calls are profiled too, by default libvirt domains and connections.
+    """
+
+    def __init__(self, wrap_types: Optional[Tuple[type, ...]] = None):
+        self.stats: Dict[Tuple[str, str], CallStats] = {}
+        self._wrap_types = wrap_types
+        self._lock = threading.Lock()
+
+    @property
+    def wrap_types(self) -> Tuple[type, ...]:
+        if self._wrap_types is None:
+            self._wrap_types = (libvirt.virDomain, libvirt.virConnect)
+        return self._wrap_types
+
+    def record(self, host: str, method: str, elapsed: float, error: bool = False):
+        with self._lock:
+            stats = self.stats.get((host, method))
+            if stats is None:
+                stats = self.stats[(host, method)] = CallStats()
+            stats.add(elapsed, error)
+
+    def call(self, host: str, method: str, func: Callable, *args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            ret = func(*args, **kwargs)
+            error = False
+            return ret
+        finally:
+            self.record(host, method, time.perf_counter() - start, error)
+
+    def wrap(self, obj: Any, host: str) -> ProfiledObject:
+        return ProfiledObject(obj, host, self)
+
+    def wrap_result(self, result: Any, host: str) -> Any:
+        """Profiles domains and connections in result, including lists of them and of (domain, stats) tuples"""
+        if isinstance(result, self.wrap_types):
+            return ProfiledObject(result, host, self)
+        if isinstance(result, list) and result:
+            first = result[0][0] if isinstance(result[0], tuple) and result[0] else result[0]
+            if not isinstance(first, self.wrap_types):
+                return result
+            if isinstance(result[0], tuple):
+                return [(ProfiledObject(r[0], host, self),) + tuple(r[1:]) for r in result]
+            return [ProfiledObject(r, host, self) for r in result]
+        return result
+
+    def rows(self) -> List[Tuple[str, str, CallStats]]:
+        """Returns (host, method, stats) sorted by host and descending cumulative time"""
+        with self._lock:
+            items = [(host, method, stats) for (host, method), stats in self.stats.items()]
+        return sorted(items, key=lambda i: (i[0], -i[2].total, i[1]))
+
+    def format_table(self) -> str:
+        rows = [('HOST', 'METHOD', 'CALLS', 'ERRORS', 'TOTAL', 'MEAN', 'MAX')]
+        for host, method, stats in self.rows():
+            rows.append((
+                host,
+                method,
+                str(stats.count),
+                str(stats.errors),
+                f'{stats.total:.3f}s',
+                f'{stats.total / stats.count * 1000:.1f}ms',
+                f'{stats.max * 1000:.1f}ms',
+            ))
+        return format_table(rows)
+
+    def format_json(self) -> str:
+        calls = [{'host': host, 'method': method, **stats.to_dict()} for host, method, stats in self.rows()]
+        return json.dumps({'calls': calls}, indent=2)
+
+    def format_prometheus(self) -> str:
+        lines = [
+            f'# HELP {PROMETHEUS_METRIC} Time spent in libvirt calls and waits by host and method',
+            f'# TYPE {PROMETHEUS_METRIC} histogram',
+        ]
+        errors = []
+        for host, method, stats in self.rows():
+            labels = f'host="{escape_label(host)}",method="{escape_label(method)}"'
+            for bound, n in stats.to_dict()['buckets'].items():
+                lines.append(f'{PROMETHEUS_METRIC}_bucket{{{labels},le="{bound}"}} {n}')
+            lines.append(f'{PROMETHEUS_METRIC}_sum{{{labels}}} {stats.total}')
+            lines.append(f'{PROMETHEUS_METRIC}_count{{{labels}}} {stats.count}')
+            errors.append(f'libvirt_mgr_rpc_errors_total{{{labels}}} {stats.errors}')
+        lines.append('# HELP libvirt_mgr_rpc_errors_total Failed libvirt calls by host and method')
+        lines.append('# TYPE libvirt_mgr_rpc_errors_total counter')
+        lines.extend(errors)
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fmt: str, path: Optional[str] = None):
+        """Writes statistics in fmt to path, atomically so textfile collectors never see a partial file, or stderr"""
+        if fmt not in PROFILE_FORMATS:
+            raise Exception(f'Profile format must be one of {", ".join(PROFILE_FORMATS)}')
+        text = getattr(self, f'format_{fmt}')()
+        if not text.endswith('\n'):
+            text += '\n'
+        if path is None:
+            sys.stderr.write(text)
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.profile-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        logger.debug('Wrote profile to %s', path)
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def enable_profiling(profiler: Optional[RpcProfiler] = None) -> RpcProfiler:
+    """Profiles connections opened by connection pools from now on"""
+    global _profiler
+    _profiler = profiler or RpcProfiler()
+    return _profiler
+
+
+def disable_profiling():
+    global _profiler
+    _profiler = None
+
+
+def get_profiler() -> Optional[RpcProfiler]:
+    return _profiler
+
+
+@contextmanager
+def profile_span(host: str, name: str):
+    """Records the time spent in the context as a call to name on host, if profiling is enabled"""
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+    start = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        profiler.record(host, name, time.perf_counter() - start, error)
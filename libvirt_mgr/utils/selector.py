@@ -0,0 +1,170 @@
+import fnmatch
+import logging
+import re
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Pattern, Set
+
+from .base import SlotsRepr
+from .cache import TTLCache
+from .domains import DomainRecord
+from .lazy import libvirt
+from .libvirt import get_list_flags, get_state_name
+
+
+logger = logging.getLogger(__name__)
+
+# Namespace of the libvirt-mgr element in domain <metadata>, holding <tag name="key">value</tag> children
+METADATA_NAMESPACE = 'https://github.com/cosandr/libvirt-mgr'
+DEFAULT_METADATA_TTL = 300
+# Name patterns starting with this are regular expressions
+REGEX_PREFIX = 're:'
+
+
+def parse_tags(xml: str) -> Dict[str, str]:
+    """Returns the tags in the libvirt-mgr metadata element of domain XML, tags without a value map to empty strings"""
+    root = ET.fromstring(xml)
+    tags: Dict[str, str] = {}
+    for element in root.iterfind(f'metadata/{{{METADATA_NAMESPACE}}}*'):
+        for tag in element:
+            # Children may or may not be namespaced
+            if tag.tag.rsplit('}', 1)[-1] == 'tag' and tag.get('name'):
+                tags[tag.get('name')] = (tag.text or '').strip()
+    return tags
+
+
+class DomainMetadataCache(TTLCache):
+    """Thread-safe cache of tags parsed from domain XML by UUID, entries expire after ttl seconds"""
+
+    def __init__(self, ttl: float = DEFAULT_METADATA_TTL):
+        super().__init__(ttl)
+
+
+_default_cache = DomainMetadataCache()
+
+
+class DomainSelector(SlotsRepr):
+    """Picks domains of a host by name, state, resources and tags
+
+    Name patterns are exact names, shell-style wildcards or regular expressions prefixed with "re:", a domain has to
+    match any of them, or there are none. All other filters have to match. Tags are given as key or key=value, the
+    former matching any value.
+    """
+    __slots__ = ('names', 'patterns', 'states', 'min_memory', 'max_memory', 'min_vcpus', 'max_vcpus', 'tags', 'found')
+
+    def __init__(
+        self,
+        patterns: Optional[List[str]] = None,
+        states: Optional[List[str]] = None,
+        min_memory: Optional[int] = None,
+        max_memory: Optional[int] = None,
+        min_vcpus: Optional[int] = None,
+        max_vcpus: Optional[int] = None,
+        tags: Optional[List[str]] = None,
+    ):
+        # Exact names, kept apart to report those not found
+        self.names: List[str] = []
+        self.patterns: List[Pattern] = []
+        for p in patterns or []:
+            if p.startswith(REGEX_PREFIX):
+                try:
+                    self.patterns.append(re.compile(p[len(REGEX_PREFIX):]))
+                except re.error as e:
+                    raise Exception(f'Invalid regular expression "{p}": {e}') from None
+            elif any(c in p for c in '*?['):
+                self.patterns.append(re.compile(fnmatch.translate(p)))
+            else:
+                self.names.append(p)
+        self.states = states
+        # Bytes
+        self.min_memory = min_memory
+        self.max_memory = max_memory
+        self.min_vcpus = min_vcpus
+        self.max_vcpus = max_vcpus
+        # Required value by key, None for any value
+        self.tags: Dict[str, Optional[str]] = {}
+        for tag in tags or []:
+            key, sep, value = tag.partition('=')
+            self.tags[key] = value if sep else None
+        # Names of domains matching the name patterns in the last select, including those removed by other filters
+        self.found: Set[str] = set()
+
+    @classmethod
+    def from_string(cls, names: Optional[str], **kwargs):
+        """Creates a selector from a comma separated list of name patterns"""
+        patterns = [n.strip() for n in names.split(',') if n.strip()] if names else None
+        return cls(patterns, **kwargs)
+
+    @property
+    def exact(self) -> bool:
+        """Whether only exact names are selected, without any other filter"""
+        return bool(self.names) and not (self.patterns or self.states or self.tags or self.has_resource_filter)
+
+    @property
+    def has_resource_filter(self) -> bool:
+        return any(v is not None for v in (self.min_memory, self.max_memory, self.min_vcpus, self.max_vcpus))
+
+    def match_name(self, name: str) -> bool:
+        if not self.names and not self.patterns:
+            return True
+        return name in self.names or any(p.fullmatch(name) for p in self.patterns)
+
+    def match_resources(self, domain: DomainRecord) -> bool:
+        for value, low, high in (
+            (domain.memory, self.min_memory, self.max_memory),
+            (domain.vcpus, self.min_vcpus, self.max_vcpus),
+        ):
+            if low is not None and (value is None or value < low):
+                return False
+            if high is not None and (value is None or value > high):
+                return False
+        return True
+
+    def match_tags(self, tags: Dict[str, str]) -> bool:
+        return all(k in tags and (v is None or tags[k] == v) for k, v in self.tags.items())
+
+    def select(self, conn: 'libvirt.virConnect', cache: Optional[DomainMetadataCache] = None) -> List[DomainRecord]:
+        """Returns matching domains with their memory and vCPUs filled
+
+        Names, states and resources are matched against a single getAllDomainStats call. Domain XML is only fetched
+        with tag filters, one call for each remaining domain whose tags are not cached.
+        """
+        if cache is None:
+            cache = _default_cache
+        stats_flags = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU
+        # getAllDomainStats accepts the same state filters as listAllDomains
+        list_flags = get_list_flags(self.states) if self.states else 0
+        ret: List[DomainRecord] = []
+        self.found = set()
+        for dom, stats in conn.getAllDomainStats(stats_flags, list_flags):
+            name = dom.name()
+            if not self.match_name(name):
+                continue
+            self.found.add(name)
+            state = get_state_name(stats.get('state.state', 0))
+            record = DomainRecord(dom, active=state not in ('nostate', 'shutoff', 'crashed'), name=name)
+            if 'balloon.maximum' in stats:
+                record.memory = stats['balloon.maximum'] * 1024
+            record.vcpus = stats.get('vcpu.current', stats.get('vcpu.maximum'))
+            if record.memory is None or record.vcpus is None:
+                # [state, max memory KiB, memory KiB, vCPUs, CPU time]
+                info = dom.info()
+                record.memory = info[1] * 1024
+                record.vcpus = info[3]
+            if self.match_resources(record):
+                ret.append(record)
+        if self.tags:
+            ret = [r for r in ret if self.match_tags(self._get_tags(r, cache))]
+        logger.debug('Selected %d domains with %s', len(ret), self)
+        return ret
+
+    @staticmethod
+    def _get_tags(domain: DomainRecord, cache: DomainMetadataCache) -> Dict[str, str]:
+        tags = cache.get(domain.uuid)
+        if tags is None:
+            tags = parse_tags(domain.dom.XMLDesc(0))
+            cache.set(domain.uuid, tags)
+        return tags
+
+    def missing(self) -> List[str]:
+        """Returns exact names which were not found by the last select, filtered out domains were found"""
+        return [n for n in self.names if n not in self.found]
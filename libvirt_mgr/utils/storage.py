@@ -0,0 +1,245 @@
+import hashlib
+import logging
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from .lazy import libvirt
+from .monitor import format_size
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes requested per stream read, libvirt splits larger messages anyway
+DISK_COPY_CHUNK_SIZE = 1024 ** 2
+# Volumes of a single domain copied at once
+DEFAULT_DISK_COPY_PARALLEL = 4
+# Seconds between progress reports of each volume
+DEFAULT_DISK_PROGRESS_INTERVAL = 10
+
+# Holes are hashed as zeros from this buffer, shared by all copies since it is read-only
+_ZERO_CHUNK = memoryview(bytes(DISK_COPY_CHUNK_SIZE))
+
+
+def get_domain_disk_paths(dom: 'libvirt.virDomain') -> List[str]:
+    """Returns the source paths of all file and block backed disks of a domain, CD-ROMs and network disks are skipped"""
+    return parse_disk_paths(dom.XMLDesc(0))
+
+
+def parse_disk_paths(xml: str) -> List[str]:
+    """Returns the source paths of file and block backed disks in domain XML"""
+    root = ET.fromstring(xml)
+    paths = []
+    for disk in root.findall('./devices/disk'):
+        if disk.get('device', 'disk') != 'disk':
+            continue
+        source = disk.find('source')
+        if source is None:
+            continue
+        path = source.get('file') or source.get('dev')
+        if path:
+            paths.append(path)
+    return paths
+
+
+class TransferProgress:
+    """Thread-safe byte counter of a single volume transfer, logs progress at most every interval seconds"""
+
+    def __init__(self, name: str, total: int, interval: float = DEFAULT_DISK_PROGRESS_INTERVAL):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.data = 0
+        self.holes = 0
+        self.start = time.monotonic()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def add(self, data: int = 0, hole: int = 0):
+        with self._lock:
+            self.data += data
+            self.holes += hole
+            now = time.monotonic()
+            if not self.interval or now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        done = self.data + self.holes
+        logger.info(
+            'Copying "%s": %s of %s (%.0f%%), %s/s, %s skipped as holes',
+            self.name, format_size(done), format_size(self.total), 100 * done / self.total if self.total else 100,
+            format_size(self.data / (now - self.start)), format_size(self.holes),
+        )
+
+
+def _hash_hole(digest, length: int):
+    while length > 0:
+        n = min(length, DISK_COPY_CHUNK_SIZE)
+        digest.update(_ZERO_CHUNK[:n])
+        length -= n
+
+
+def _send(stream: 'libvirt.virStream', data: bytes):
+    while data:
+        sent = stream.send(data)
+        if sent < 0:
+            raise libvirt.libvirtError('Cannot write to a non-blocking stream')
+        data = data[sent:]
+
+
+def stream_volume(
+    src_conn: 'libvirt.virConnect',
+    src_vol: 'libvirt.virStorageVol',
+    dst_conn: Optional['libvirt.virConnect'] = None,
+    dst_vol: Optional['libvirt.virStorageVol'] = None,
+    progress: Optional[TransferProgress] = None,
+    checksum: bool = True,
+) -> Optional[str]:
+    """Streams src_vol into dst_vol without transferring holes, returns the SHA-256 of the volume contents
+
+    If dst_vol is not given the volume is only read. Holes are hashed as zeros, so checksums do not depend on how
+    sparse either copy is.
+    """
+    digest = hashlib.sha256() if checksum else None
+    src_stream = src_conn.newStream(0)
+    src_vol.download(src_stream, 0, 0, libvirt.VIR_STORAGE_VOL_DOWNLOAD_SPARSE_STREAM)
+    dst_stream = None
+    if dst_vol is not None:
+        dst_stream = dst_conn.newStream(0)
+        dst_vol.upload(dst_stream, 0, 0, libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+    try:
+        while True:
+            data = src_stream.recvFlags(DISK_COPY_CHUNK_SIZE, libvirt.VIR_STREAM_RECV_STOP_AT_HOLE)
+            if data == -2:
+                raise libvirt.libvirtError('Cannot read from a non-blocking stream')
+            if data == -3:
+                length = src_stream.recvHole(0)
+                if digest is not None:
+                    _hash_hole(digest, length)
+                if dst_stream is not None:
+                    dst_stream.sendHole(length, 0)
+                if progress is not None:
+                    progress.add(hole=length)
+                continue
+            if not data:
+                break
+            if digest is not None:
+                digest.update(data)
+            if dst_stream is not None:
+                _send(dst_stream, data)
+            if progress is not None:
+                progress.add(data=len(data))
+        src_stream.finish()
+        if dst_stream is not None:
+            dst_stream.finish()
+    except BaseException:
+        for stream in (src_stream, dst_stream):
+            if stream is None:
+                continue
+            try:
+                stream.abort()
+            except libvirt.libvirtError as e:
+                logger.debug('Cannot abort stream: %s', e)
+        raise
+    return digest.hexdigest() if digest is not None else None
+
+
+def _volume_xml(src_vol: 'libvirt.virStorageVol') -> str:
+    """Returns the XML of an empty volume with the same name, capacity and format as src_vol"""
+    src = ET.fromstring(src_vol.XMLDesc(0))
+    vol = ET.Element('volume')
+    ET.SubElement(vol, 'name').text = src_vol.name()
+    ET.SubElement(vol, 'capacity', unit='bytes').text = str(src_vol.info()[1])
+    ET.SubElement(vol, 'allocation', unit='bytes').text = '0'
+    fmt = src.find('./target/format')
+    if fmt is not None:
+        ET.SubElement(ET.SubElement(vol, 'target'), 'format', type=fmt.get('type'))
+    return ET.tostring(vol, encoding='unicode')
+
+
+def copy_volume(
+    src_conn: 'libvirt.virConnect',
+    dst_conn: 'libvirt.virConnect',
+    path: str,
+    verify: bool = True,
+    progress_interval: float = DEFAULT_DISK_PROGRESS_INTERVAL,
+) -> 'libvirt.virStorageVol':
+    """Copies the volume at path to the storage pool with the same name on the destination
+
+    The volume must not exist on the destination and has to end up at the same path, since the domain definition is
+    migrated as is. The created volume is deleted if the copy fails.
+    """
+    src_vol = src_conn.storageVolLookupByPath(path)
+    pool_name = src_vol.storagePoolLookupByVolume().name()
+    try:
+        dst_pool = dst_conn.storagePoolLookupByName(pool_name)
+    except libvirt.libvirtError:
+        raise Exception(f'Storage pool "{pool_name}" of "{path}" does not exist on the destination')
+    try:
+        dst_pool.storageVolLookupByName(src_vol.name())
+    except libvirt.libvirtError:
+        pass
+    else:
+        raise Exception(f'Volume "{src_vol.name()}" already exists in pool "{pool_name}" on the destination')
+
+    dst_vol = dst_pool.createXML(_volume_xml(src_vol), 0)
+    try:
+        if dst_vol.path() != path:
+            raise Exception(f'Volume "{src_vol.name()}" would be created at "{dst_vol.path()}" instead of "{path}"')
+        capacity = src_vol.info()[1]
+        progress = TransferProgress(src_vol.name(), capacity, progress_interval)
+        src_digest = stream_volume(src_conn, src_vol, dst_conn, dst_vol, progress, checksum=verify)
+        elapsed = time.monotonic() - progress.start
+        logger.info(
+            'Copied "%s" in %.1fs, %s sent, %s skipped as holes',
+            path, elapsed, format_size(progress.data), format_size(progress.holes),
+        )
+        if verify:
+            dst_digest = stream_volume(dst_conn, dst_vol)
+            if dst_digest != src_digest:
+                raise Exception(f'Checksum of "{path}" does not match after copy')
+            logger.debug('Verified "%s", SHA-256 %s', path, dst_digest)
+    except BaseException:
+        logger.warning('Deleting incomplete copy of "%s" on the destination', path)
+        try:
+            dst_vol.delete(0)
+        except libvirt.libvirtError as e:
+            logger.error('Cannot delete incomplete copy of "%s": %s', path, e)
+        raise
+    return dst_vol
+
+
+def copy_domain_disks(
+    dom: 'libvirt.virDomain',
+    src_conn: 'libvirt.virConnect',
+    dst_conn: 'libvirt.virConnect',
+    parallel: int = DEFAULT_DISK_COPY_PARALLEL,
+    verify: bool = True,
+    progress_interval: float = DEFAULT_DISK_PROGRESS_INTERVAL,
+) -> List['libvirt.virStorageVol']:
+    """Copies all disks of a stopped domain to the destination, up to parallel at a time
+
+    If any copy fails, volumes already copied are deleted from the destination before the error is raised.
+    """
+    paths = get_domain_disk_paths(dom)
+    if not paths:
+        return []
+    logger.info('Copying %d disks of "%s"', len(paths), dom.name())
+    copied: List['libvirt.virStorageVol'] = []
+    with ThreadPoolExecutor(max_workers=max(1, min(parallel, len(paths)))) as executor:
+        futures = [executor.submit(copy_volume, src_conn, dst_conn, p, verify, progress_interval) for p in paths]
+        error: Optional[BaseException] = None
+        for fut in futures:
+            try:
+                copied.append(fut.result())
+            except BaseException as e:
+                error = error or e
+    if error is not None:
+        for vol in copied:
+            try:
+                vol.delete(0)
+            except libvirt.libvirtError as e:
+                logger.error('Cannot delete copied volume "%s": %s', vol.name(), e)
+        raise error
+    return copied
@@ -4,8 +4,20 @@ import argparse
 import logging
 import os
 
-from .migrate import launch_migrate
+from .evacuate import DEFAULT_MAX_UTILIZATION, launch_evacuate
+from .find import launch_find
+from .migrate import DEFAULT_LOOKAHEAD, launch_migrate
+from .rebalance import DEFAULT_TOLERANCE, launch_rebalance
+from .resume import launch_resume
+from .rolling import DEFAULT_HOOK_TIMEOUT, DEFAULT_RECONNECT_TIMEOUT, launch_rolling
+from .serve import DEFAULT_METRICS_ADDRESS, DEFAULT_SWEEP_INTERVAL, launch_remote, launch_serve
+from .status import launch_list
 from .utils import Config
+from .utils.estimate import ORDER_POLICIES, ORDER_SHORTEST
+from .utils.libvirt import DOMAIN_LIST_STATES
+from .utils.monitor import parse_size
+from .utils.probe import DEFAULT_PROBE_TIMEOUT
+from .utils.profile import PROFILE_FORMATS, enable_profiling
 
 logger = logging.getLogger('libvirt_mgr')
 
@@ -18,25 +30,146 @@ grp_general.add_argument('--log-level', type=str.upper, choices=['CRITICAL', 'ER
                          default=os.getenv('LOG_LEVEL', 'INFO'), help='Logging level, env LOG_LEVEL')
 grp_general.add_argument('--log-timestamp', action='store_true', help='Log timestamps to console')
 grp_general.add_argument('--log-file', help='Path to log file, disables console logging')
+grp_general.add_argument('--inventory', help='Path to the domain inventory database, env LIBVIRT_MGR_INVENTORY')
+grp_general.add_argument('--journal', help='Path to the journal of batch migrations, env LIBVIRT_MGR_JOURNAL')
+grp_general.add_argument('--estimates', help='Path to the history of migration durations used for predictions, env LIBVIRT_MGR_ESTIMATES')
+grp_general.add_argument('--profile', choices=PROFILE_FORMATS,
+                         help='Time libvirt calls by host and method, print the results in this format at exit')
+grp_general.add_argument('--profile-file', help='Write --profile results to this file instead of stderr, e.g. a Prometheus textfile')
+grp_general.add_argument('--server', nargs='?', const='', metavar='SOCKET',
+                         help='Run migrate and list through a running "virtmgr serve", at SOCKET or env LIBVIRT_MGR_SOCKET')
+grp_general.add_argument('--no-config-cache', action='store_true', help='Always parse the config file instead of using the compiled cache')
 
 subparsers = parser.add_subparsers(title='Commands', dest='command')
 # 3.6 does not have the required argument
 subparsers.required = True
 
+
+def add_migration_arguments(subparser: argparse.ArgumentParser, domain_states: bool = True, start_stop: bool = True):
+    """Adds options shared by all commands which migrate domains"""
+    if start_stop:
+        subparser.add_argument('--no-start', action='store_true', help='Do not automatically start domain after offline migrations')
+        subparser.add_argument('--no-stop', action='store_true', help='Do not automatically shutdown running domains for offline migrations')
+    subparser.add_argument('-p', '--parallel', type=int, default=1,
+                           help='Maximum number of concurrent migrations, further limited by group configuration')
+    subparser.add_argument('--lookahead', type=int, default=DEFAULT_LOOKAHEAD,
+                           help='Running domains to shutdown ahead of their turn in batches of offline migrations, 0 shuts each down right before it is migrated')
+    subparser.add_argument('--order', choices=ORDER_POLICIES, default=ORDER_SHORTEST,
+                           help='Order to migrate domains in by predicted duration, given keeps the order they were selected in')
+    subparser.add_argument('--measure-dirty-rates', action='store_true',
+                           help='Measure how fast running domains dirty memory for --order, takes a second, otherwise past migrations are used')
+    subparser.add_argument('--no-preflight', action='store_true',
+                           help='Do not check destinations for CPU, networks, storage pools and memory before migrating')
+    subparser.add_argument('--progress-interval', type=float, default=10,
+                           help='Seconds between live migration progress reports, 0 disables them')
+    subparser.add_argument('--metrics-file', help='Append migration progress and results to this file as JSON lines')
+    if domain_states:
+        subparser.add_argument('--state', action='append', choices=DOMAIN_LIST_STATES,
+                               help='Only migrate domains in this state, can be repeated, defaults to active with --all')
+
+
+def size_arg(value: str) -> int:
+    try:
+        return parse_size(value)
+    except Exception as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_selector_arguments(subparser: argparse.ArgumentParser):
+    """Adds filters of domains selected by name or all domains of a host"""
+    subparser.add_argument('--min-memory', type=size_arg, help='Only migrate domains with at least this much memory, e.g. 4G')
+    subparser.add_argument('--max-memory', type=size_arg, help='Only migrate domains with at most this much memory, e.g. 32G')
+    subparser.add_argument('--min-vcpus', type=int, help='Only migrate domains with at least this many vCPUs')
+    subparser.add_argument('--max-vcpus', type=int, help='Only migrate domains with at most this many vCPUs')
+    subparser.add_argument('--tag', action='append', metavar='KEY[=VALUE]',
+                           help='Only migrate domains with this tag in their libvirt-mgr metadata, can be repeated')
+
+
 parser_migrate = subparsers.add_parser('migrate', help='Migrate VMs')
 parser_migrate.set_defaults(func=launch_migrate)
-parser_migrate.add_argument('-s', '--src-host', default='localhost', help='Host to migrate from')
-parser_migrate.add_argument('--no-start', action='store_true', help='Do not automatically start domain after offline migrations')
-parser_migrate.add_argument('--no-stop', action='store_true', help='Do not automatically shutdown running domains for offline migrations')
+parser_migrate.add_argument('-s', '--src-host',
+                            help='Host to migrate from, found in the inventory when selecting by exact names and localhost otherwise')
+parser_migrate.add_argument('--plan', action='store_true', help='Print the predicted schedule without migrating')
+add_migration_arguments(parser_migrate)
+add_selector_arguments(parser_migrate)
 
 migrate_names_grp = parser_migrate.add_mutually_exclusive_group(required=True)
-migrate_names_grp.add_argument('-n', '--name', help='Comma separated list of VMs to migrate')
+migrate_names_grp.add_argument('-n', '--name',
+                               help='Comma separated list of VMs to migrate, shell-style wildcards or re:REGEX')
 migrate_names_grp.add_argument('-a', '--all', action='store_true', help='Migrate all VMs on source host')
 
 migrate_target_grp = parser_migrate.add_mutually_exclusive_group(required=True)
 migrate_target_grp.add_argument('-t', '--dst-host', help='Host to migrate to')
 migrate_target_grp.add_argument('-g', '--dst-group', help='Group to migrate to, automatically picks a host')
 
+parser_evacuate = subparsers.add_parser('evacuate', help='Migrate all VMs off a host, spreading them across a group')
+parser_evacuate.set_defaults(func=launch_evacuate)
+parser_evacuate.add_argument('host', help='Host to evacuate')
+parser_evacuate.add_argument('-g', '--group', help='Group to migrate to, defaults to the group of the host')
+parser_evacuate.add_argument('--max-utilization', type=float, default=DEFAULT_MAX_UTILIZATION,
+                             help='Maximum fraction of memory to use on destination hosts')
+parser_evacuate.add_argument('--dry-run', action='store_true', help='Print the placement plan without migrating')
+parser_evacuate.add_argument('--plan', action='store_true', help='Print the predicted schedule without migrating')
+add_migration_arguments(parser_evacuate)
+
+parser_rebalance = subparsers.add_parser('rebalance', help='Even out memory utilization within a group with as few migrations as possible')
+parser_rebalance.set_defaults(func=launch_rebalance)
+parser_rebalance.add_argument('-g', '--group', required=True, help='Group to rebalance')
+parser_rebalance.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                              help='Acceptable difference in memory utilization between hosts, as a fraction')
+parser_rebalance.add_argument('--max-moves', type=int, help='Maximum number of migrations to perform')
+parser_rebalance.add_argument('--max-utilization', type=float, default=DEFAULT_MAX_UTILIZATION,
+                              help='Maximum fraction of memory to use on destination hosts')
+parser_rebalance.add_argument('--dry-run', action='store_true', help='Print the migration plan without migrating')
+parser_rebalance.add_argument('--plan', action='store_true', help='Print the predicted schedule without migrating')
+add_migration_arguments(parser_rebalance, domain_states=False)
+
+parser_rolling = subparsers.add_parser('rolling', help='Drain, service and bring back every host of a group, a few at a time')
+parser_rolling.set_defaults(func=launch_rolling)
+parser_rolling.add_argument('-g', '--group', required=True, help='Group to service')
+parser_rolling.add_argument('-k', '--max-hosts-down', type=int, default=1,
+                            help='Hosts to drain and service at the same time, their VMs go to the rest of the group')
+parser_rolling.add_argument('--hook', required=True,
+                            help='Shell command to run for each drained host, e.g. a reboot, gets env VIRTMGR_HOST and VIRTMGR_URI')
+parser_rolling.add_argument('--hook-timeout', type=float, default=DEFAULT_HOOK_TIMEOUT, help='Seconds to wait for the hook')
+parser_rolling.add_argument('--reconnect-delay', type=float, default=0,
+                            help='Seconds to wait after the hook before reconnecting, if it returns before the host goes down')
+parser_rolling.add_argument('--reconnect-timeout', type=float, default=DEFAULT_RECONNECT_TIMEOUT,
+                            help='Seconds to wait for a host to accept connections again after its hook')
+parser_rolling.add_argument('--move-back', action='store_true', help='Migrate VMs back to their host once it is back')
+parser_rolling.add_argument('--max-utilization', type=float, default=DEFAULT_MAX_UTILIZATION,
+                            help='Maximum fraction of memory to use on hosts receiving VMs')
+parser_rolling.add_argument('--dry-run', action='store_true', help='Print the waves of hosts without doing anything')
+add_migration_arguments(parser_rolling, domain_states=False)
+
+parser_resume = subparsers.add_parser('resume', help='Finish the last batch of migrations if it was interrupted')
+parser_resume.set_defaults(func=launch_resume)
+add_migration_arguments(parser_resume, domain_states=False, start_stop=False)
+
+parser_find = subparsers.add_parser('find', help='Find which host a VM is on using the inventory')
+parser_find.set_defaults(func=launch_find)
+parser_find.add_argument('pattern', nargs='?', default='*', help='VM name or UUID, can contain shell-style wildcards')
+parser_find.add_argument('--refresh', action='store_true', help='Scan all hosts before searching')
+parser_find.add_argument('--max-age', type=float, help='Scan hosts not scanned within this many seconds before searching')
+
+parser_list = subparsers.add_parser('list', aliases=['status'], help='Show VMs on all hosts')
+parser_list.set_defaults(func=launch_list)
+parser_list.add_argument('-g', '--group', help='Only show hosts in this group')
+parser_list.add_argument('-H', '--host', action='append', help='Only show this host, can be repeated')
+parser_list.add_argument('--json', action='store_true', help='Print JSON instead of a table')
+parser_list.add_argument('--timeout', type=float, default=DEFAULT_PROBE_TIMEOUT,
+                         help='Seconds to wait for each host before reporting it as unreachable')
+
+parser_serve = subparsers.add_parser('serve', help='Keep connections to all hosts, serve metrics and run commands for clients')
+parser_serve.set_defaults(func=launch_serve)
+parser_serve.add_argument('--listen', default=DEFAULT_METRICS_ADDRESS,
+                          help='Address to serve Prometheus metrics on at /metrics, empty to disable')
+parser_serve.add_argument('--socket', help='Unix socket to accept commands on, env LIBVIRT_MGR_SOCKET')
+parser_serve.add_argument('--interval', type=float, default=DEFAULT_SWEEP_INTERVAL,
+                          help='Seconds between full refreshes of all hosts, events keep domains up to date in between')
+parser_serve.add_argument('--timeout', type=float, default=DEFAULT_PROBE_TIMEOUT,
+                          help='Seconds to wait for each host before reporting it as down')
+
 
 def setup_logger(args: argparse.Namespace):
     root_logger = logging.getLogger()
@@ -61,11 +194,19 @@ def main():
     setup_logger(args)
     logger.debug('Reading config file: %s', args.config)
     try:
-        config = Config.from_file(args.config)
+        config = Config.from_file(args.config, use_cache=not args.no_config_cache)
     except Exception as e:
         logger.exception(e)
         raise SystemExit(1)
-    args.func(args, config)
+    profiler = enable_profiling() if args.profile else None
+    try:
+        if args.server is not None:
+            launch_remote(args, config)
+        else:
+            args.func(args, config)
+    finally:
+        if profiler is not None:
+            profiler.dump(args.profile, args.profile_file)
 
 
 if __name__ == '__main__':
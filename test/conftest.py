@@ -0,0 +1,73 @@
+import time
+import tracemalloc
+from typing import Callable, List
+
+import pytest
+
+from libvirt_mgr.utils.preflight import CapabilityCache
+from libvirt_mgr.utils.probe import HostStatsCache
+
+
+class BenchmarkResult:
+    __slots__ = ('name', 'wall_time', 'rpc_count', 'peak_memory')
+
+    def __init__(self, name: str, wall_time: float, rpc_count: int, peak_memory: int):
+        self.name = name
+        self.wall_time = wall_time
+        self.rpc_count = rpc_count
+        self.peak_memory = peak_memory
+
+
+_results: List[BenchmarkResult] = []
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: measures orchestration overhead against a fake hypervisor')
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keeps compiled configs, the inventory, the journal and migration history out of the user's cache directories"""
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv('LIBVIRT_MGR_CACHE_DIR', str(cache_dir))
+    monkeypatch.setenv('LIBVIRT_MGR_INVENTORY', str(cache_dir / 'inventory.sqlite'))
+    monkeypatch.setenv('LIBVIRT_MGR_JOURNAL', str(cache_dir / 'journal.jsonl'))
+    monkeypatch.setenv('LIBVIRT_MGR_ESTIMATES', str(cache_dir / 'estimates.json'))
+    # The fake hypervisor measures dirty rates instantly
+    monkeypatch.setattr('libvirt_mgr.utils.estimate.DIRTY_RATE_PERIOD', 0)
+    # Host names are reused by tests with different fake hypervisors
+    monkeypatch.setattr('libvirt_mgr.utils.preflight._default_cache', CapabilityCache())
+    monkeypatch.setattr('libvirt_mgr.utils.probe._default_cache', HostStatsCache())
+    return cache_dir
+
+
+@pytest.fixture
+def bench(request):
+    """Returns a function which runs func once, records wall time, RPC count and peak memory, and returns func's result"""
+
+    def _bench(func: Callable, rpc_counter: Callable[[], int], name: str = request.node.name):
+        rpc_before = rpc_counter()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            ret = func()
+            wall_time = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        _results.append(BenchmarkResult(name, wall_time, rpc_counter() - rpc_before, peak))
+        return ret
+
+    return _bench
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    terminalreporter.section('benchmarks')
+    width = max(len(r.name) for r in _results)
+    terminalreporter.write_line(f'{"name":<{width}}  {"wall time":>10}  {"RPCs":>8}  {"peak memory":>12}')
+    for r in _results:
+        terminalreporter.write_line(
+            f'{r.name:<{width}}  {r.wall_time * 1000:>8.1f}ms  {r.rpc_count:>8}  {r.peak_memory / 1024:>9.1f}KiB'
+        )
@@ -0,0 +1,593 @@
+import collections
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import libvirt
+
+
+class FakeCluster:
+    """In-process hypervisors reachable by URI, counting every RPC made against them
+
+    rpc_latency is added to every remote call, migration_duration to every migration and start_duration to every
+    domain start, shutdown_duration is how long guests take to stop after being asked to shutdown. Failures can be injected for migrations and starts of specific
+    domains and for connections to specific URIs.
+    """
+
+    def __init__(
+        self,
+        rpc_latency: float = 0.0,
+        migration_duration: float = 0.0,
+        shutdown_duration: float = 0.0,
+        start_duration: float = 0.0,
+    ):
+        self.rpc_latency = rpc_latency
+        self.migration_duration = migration_duration
+        self.shutdown_duration = shutdown_duration
+        self.start_duration = start_duration
+        self.hypervisors: Dict[str, FakeHypervisor] = {}
+        self.fail_migration: Set[str] = set()
+        self.fail_start: Set[str] = set()
+        self.fail_shutdown: Set[str] = set()
+        self.fail_connect: Set[str] = set()
+        # Volume paths whose uploads fail while streaming
+        self.fail_upload: Set[str] = set()
+        self.rpc_calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add_hypervisor(self, uri: str, memory: int = 256 * 1024 ** 3, cpus: int = 64) -> 'FakeHypervisor':
+        hv = FakeHypervisor(self, uri, memory, cpus)
+        self.hypervisors[uri] = hv
+        return hv
+
+    def rpc(self, method: str):
+        with self._lock:
+            self.rpc_calls[method] += 1
+        if self.rpc_latency:
+            time.sleep(self.rpc_latency)
+
+    @property
+    def rpc_count(self) -> int:
+        return sum(self.rpc_calls.values())
+
+    def open(self, uri: str) -> 'FakeConnection':
+        """Drop-in replacement for libvirt.open"""
+        self.rpc('open')
+        if uri in self.fail_connect or uri not in self.hypervisors:
+            raise libvirt.libvirtError(f'Failed to connect to {uri}')
+        return FakeConnection(self.hypervisors[uri])
+
+
+class FakeHypervisor:
+    def __init__(self, cluster: FakeCluster, uri: str, memory: int, cpus: int):
+        self.cluster = cluster
+        self.uri = uri
+        self.memory = memory
+        self.cpus = cpus
+        self.domains: Dict[str, FakeDomainState] = {}
+        # Callbacks registered for events of all domains
+        self.callbacks: List = []
+        self.pools: Dict[str, FakePool] = {}
+        # Volumes of all pools by path
+        self.volumes: Dict[str, FakeVolumeState] = {}
+        # Host CPU model, CPUs with a model listed in cpu_models are compatible with it
+        self.cpu_model = 'Skylake-Server'
+        self.cpu_models = ['Skylake-Server', 'Broadwell', 'Haswell']
+        # Active state by network name
+        self.networks: Dict[str, bool] = {'default': True}
+        self.lock = threading.Lock()
+
+    def add_domain(
+        self,
+        name: str,
+        memory: int = 1024 ** 3,
+        vcpus: int = 1,
+        active: bool = True,
+        disks: Optional[List[str]] = None,
+    ) -> 'FakeDomainState':
+        state = FakeDomainState(name, memory, vcpus, active)
+        state.disks = disks or []
+        self.domains[name] = state
+        return state
+
+    def add_pool(self, name: str, path: str) -> 'FakePool':
+        pool = FakePool(self, name, path)
+        self.pools[name] = pool
+        return pool
+
+    def add_volume(self, pool: str, name: str, extents: List[Tuple[str, Union[bytes, int]]]) -> 'FakeVolumeState':
+        """Adds a volume made of ('data', bytes) and ('hole', length) extents"""
+        state = FakeVolumeState(self.pools[pool], name, extents)
+        self.volumes[state.path] = state
+        return state
+
+    @property
+    def memory_used(self) -> int:
+        return sum(d.memory for d in self.domains.values() if d.active)
+
+
+class FakeDomainState:
+    """Domain as seen by the hypervisor, shared by all FakeDomain handles"""
+
+    def __init__(self, name: str, memory: int, vcpus: int, active: bool, dom_uuid: Optional[str] = None):
+        self.name = name
+        self.uuid = dom_uuid or str(uuid.uuid4())
+        self.memory = memory
+        self.vcpus = vcpus
+        self.active = active
+        self.callbacks: List = []
+        # Paths of disks
+        self.disks: List[str] = []
+        # Returned by jobStats in order while migrating, the last one repeats
+        self.job_stats: List[Dict] = []
+        self.migrating = False
+        self.postcopy = False
+        # Last values set while migrating, milliseconds and MiB/s
+        self.max_downtime: Optional[int] = None
+        self.max_speed: Optional[int] = None
+        # Contents of <metadata>
+        self.metadata = ''
+        # <cpu> mode and model, no <cpu> element if None
+        self.cpu_mode: Optional[str] = None
+        self.cpu_model: Optional[str] = None
+        # Networks of interfaces
+        self.networks: List[str] = []
+        # MiB/s of memory dirtied, and as of the last measurement, None until one is started
+        self.dirty_rate = 0
+        self.dirty_rate_measured: Optional[int] = None
+
+
+class FakeConnection:
+    """Implements the subset of virConnect used by libvirt_mgr"""
+
+    def __init__(self, hv: FakeHypervisor):
+        self.hv = hv
+        self.alive = True
+        self._callback_id = 0
+
+    def _rpc(self, method: str):
+        if not self.alive:
+            raise libvirt.libvirtError('Connection is closed')
+        self.hv.cluster.rpc(method)
+
+    def getURI(self):
+        self._rpc('getURI')
+        return self.hv.uri
+
+    def isAlive(self):
+        return self.alive
+
+    def setKeepAlive(self, interval, count):
+        self._rpc('setKeepAlive')
+
+    def close(self):
+        self.alive = False
+        return 0
+
+    def listAllDomains(self, flags=0):
+        self._rpc('listAllDomains')
+        ret = []
+        for state in list(self.hv.domains.values()):
+            if flags & libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE and not state.active:
+                continue
+            if flags & libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE and state.active:
+                continue
+            ret.append(FakeDomain(self, state))
+        return ret
+
+    def listDomainsID(self):
+        self._rpc('listDomainsID')
+        return [i for i, d in enumerate(self.hv.domains.values(), start=1) if d.active]
+
+    def lookupByID(self, dom_id):
+        self._rpc('lookupByID')
+        active = [d for d in self.hv.domains.values() if d.active]
+        if not 0 < dom_id <= len(active):
+            raise libvirt.libvirtError(f'Domain not found: no domain with matching id {dom_id}')
+        return FakeDomain(self, active[dom_id - 1])
+
+    def lookupByName(self, name):
+        self._rpc('lookupByName')
+        if name not in self.hv.domains:
+            raise libvirt.libvirtError(f"Domain not found: no domain with matching name '{name}'")
+        return FakeDomain(self, self.hv.domains[name])
+
+    def lookupByUUIDString(self, dom_uuid):
+        self._rpc('lookupByUUIDString')
+        for state in self.hv.domains.values():
+            if state.uuid == dom_uuid:
+                return FakeDomain(self, state)
+        raise libvirt.libvirtError(f"Domain not found: no domain with matching uuid '{dom_uuid}'")
+
+    def domainListGetStats(self, doms, stats=0, flags=0):
+        self._rpc('domainListGetStats')
+        return [(d, d._stats()) for d in doms if d.state.name in self.hv.domains]
+
+    def getAllDomainStats(self, stats=0, flags=0):
+        self._rpc('getAllDomainStats')
+        doms = [FakeDomain(self, s) for s in self.hv.domains.values()
+                if not flags & libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE or s.active]
+        doms = [d for d in doms if not flags & libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE or not d.state.active]
+        if stats == libvirt.VIR_DOMAIN_STATS_DIRTYRATE:
+            return [(d, d._dirty_rate_stats()) for d in doms]
+        return [(d, d._stats()) for d in doms]
+
+    def getCapabilities(self):
+        self._rpc('getCapabilities')
+        return (f"<capabilities><host><cpu><arch>x86_64</arch><model>{self.hv.cpu_model}</model></cpu></host>"
+                f"</capabilities>")
+
+    def getDomainCapabilities(self, emulatorbin=None, arch=None, machine=None, virttype=None, flags=0):
+        self._rpc('getDomainCapabilities')
+        models = ''.join(f"<model usable='yes'>{m}</model>" for m in self.hv.cpu_models)
+        return f"<domainCapabilities><cpu><mode name='custom' supported='yes'>{models}</mode></cpu></domainCapabilities>"
+
+    def compareCPU(self, xml, flags=0):
+        self._rpc('compareCPU')
+        model = ET.fromstring(xml).findtext('model')
+        if model == self.hv.cpu_model:
+            return libvirt.VIR_CPU_COMPARE_IDENTICAL
+        if model in self.hv.cpu_models:
+            return libvirt.VIR_CPU_COMPARE_SUPERSET
+        return libvirt.VIR_CPU_COMPARE_INCOMPATIBLE
+
+    def listNetworks(self):
+        self._rpc('listNetworks')
+        return [n for n, active in self.hv.networks.items() if active]
+
+    def listDefinedNetworks(self):
+        self._rpc('listDefinedNetworks')
+        return [n for n, active in self.hv.networks.items() if not active]
+
+    def listStoragePools(self):
+        self._rpc('listStoragePools')
+        return list(self.hv.pools)
+
+    def listDefinedStoragePools(self):
+        self._rpc('listDefinedStoragePools')
+        return []
+
+    def getInfo(self):
+        self._rpc('getInfo')
+        return ['x86_64', self.hv.memory // 1024 ** 2, self.hv.cpus, 2000, 1, 1, self.hv.cpus, 1]
+
+    def getFreeMemory(self):
+        self._rpc('getFreeMemory')
+        return self.hv.memory - self.hv.memory_used
+
+    def getCPUStats(self, cpu, flags=0):
+        self._rpc('getCPUStats')
+        return {'kernel': 0, 'user': 0, 'idle': 0, 'iowait': 0}
+
+    def numOfDomains(self):
+        self._rpc('numOfDomains')
+        return len([d for d in self.hv.domains.values() if d.active])
+
+    def storageVolLookupByPath(self, path):
+        self._rpc('storageVolLookupByPath')
+        if path not in self.hv.volumes:
+            raise libvirt.libvirtError(f"Storage volume not found: no storage vol with matching path '{path}'")
+        return FakeVolume(self, self.hv.volumes[path])
+
+    def storagePoolLookupByName(self, name):
+        self._rpc('storagePoolLookupByName')
+        if name not in self.hv.pools:
+            raise libvirt.libvirtError(f"Storage pool not found: no storage pool with matching name '{name}'")
+        return FakePoolHandle(self, self.hv.pools[name])
+
+    def newStream(self, flags=0):
+        return FakeStream(self)
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        self._rpc('domainEventRegisterAny')
+        self._callback_id += 1
+        if dom is not None:
+            dom.state.callbacks.append((self._callback_id, event_id, callback, opaque))
+        else:
+            self.hv.callbacks.append((self._callback_id, event_id, callback, opaque))
+        return self._callback_id
+
+    def domainEventDeregisterAny(self, callback_id):
+        self._rpc('domainEventDeregisterAny')
+        for state in self.hv.domains.values():
+            state.callbacks = [c for c in state.callbacks if c[0] != callback_id]
+        self.hv.callbacks = [c for c in self.hv.callbacks if c[0] != callback_id]
+
+
+class FakeDomain:
+    """Implements the subset of virDomain used by libvirt_mgr"""
+
+    def __init__(self, conn: FakeConnection, state: FakeDomainState):
+        self._conn = conn
+        self.state = state
+
+    def _rpc(self, method: str):
+        self._conn._rpc(method)
+
+    def _stats(self):
+        return {
+            'state.state': libvirt.VIR_DOMAIN_RUNNING if self.state.active else libvirt.VIR_DOMAIN_SHUTOFF,
+            'balloon.maximum': self.state.memory // 1024,
+            'balloon.current': self.state.memory // 1024,
+            'vcpu.current': self.state.vcpus,
+            'vcpu.maximum': self.state.vcpus,
+        }
+
+    def _dirty_rate_stats(self):
+        if self.state.dirty_rate_measured is None:
+            return {'dirtyrate.calc_status': 0}
+        return {'dirtyrate.calc_status': 2, 'dirtyrate.megabytes_per_second': self.state.dirty_rate_measured}
+
+    def _emit(self, event: int):
+        for _, event_id, callback, opaque in list(self.state.callbacks) + list(self._conn.hv.callbacks):
+            if event_id == libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE:
+                callback(self._conn, self, event, 0, opaque)
+
+    def _emit_job_completed(self, params: Dict):
+        for _, event_id, callback, opaque in list(self.state.callbacks) + list(self._conn.hv.callbacks):
+            if event_id == libvirt.VIR_DOMAIN_EVENT_ID_JOB_COMPLETED:
+                callback(self._conn, self, params, opaque)
+
+    def connect(self):
+        return self._conn
+
+    def name(self):
+        return self.state.name
+
+    def UUIDString(self):
+        return self.state.uuid
+
+    def isActive(self):
+        self._rpc('isActive')
+        return int(self.state.active)
+
+    def XMLDesc(self, flags=0):
+        self._rpc('XMLDesc')
+        disks = ''.join(f"<disk type='file' device='disk'><source file='{d}'/></disk>" for d in self.state.disks)
+        interfaces = ''.join(f"<interface type='network'><source network='{n}'/></interface>" for n in self.state.networks)
+        cpu = ''
+        if self.state.cpu_mode is not None:
+            model = f'<model>{self.state.cpu_model}</model>' if self.state.cpu_model else ''
+            cpu = f"<cpu mode='{self.state.cpu_mode}'>{model}</cpu>"
+        return (f"<domain type='kvm'><name>{self.state.name}</name><uuid>{self.state.uuid}</uuid>"
+                f"<metadata>{self.state.metadata}</metadata>{cpu}<devices><disk type='file' device='cdrom'><source file='/iso/install.iso'/></disk>{disks}{interfaces}</devices>"
+                f"</domain>")
+
+    def info(self):
+        self._rpc('info')
+        state = libvirt.VIR_DOMAIN_RUNNING if self.state.active else libvirt.VIR_DOMAIN_SHUTOFF
+        return [state, self.state.memory // 1024, self.state.memory // 1024, self.state.vcpus, 0]
+
+    def maxMemory(self):
+        self._rpc('maxMemory')
+        return self.state.memory // 1024
+
+    def jobStats(self, flags=0):
+        self._rpc('jobStats')
+        if not self.state.migrating or not self.state.job_stats:
+            return {'type': 0}
+        if len(self.state.job_stats) > 1:
+            return self.state.job_stats.pop(0)
+        return self.state.job_stats[0]
+
+    def startDirtyRateCalc(self, seconds, flags=0):
+        self._rpc('startDirtyRateCalc')
+        if not self.state.active:
+            raise libvirt.libvirtError('Requested operation is not valid: domain is not running')
+        self.state.dirty_rate_measured = self.state.dirty_rate
+
+    def migrateSetMaxDowntime(self, downtime, flags=0):
+        self._rpc('migrateSetMaxDowntime')
+        self.state.max_downtime = downtime
+
+    def migrateSetMaxSpeed(self, bandwidth, flags=0):
+        self._rpc('migrateSetMaxSpeed')
+        self.state.max_speed = bandwidth
+
+    def migrateStartPostCopy(self, flags=0):
+        self._rpc('migrateStartPostCopy')
+        if not self.state.migrating:
+            raise libvirt.libvirtError('Requested operation is not valid: no migration in progress')
+        self.state.postcopy = True
+
+    def shutdown(self):
+        self._rpc('shutdown')
+        cluster = self._conn.hv.cluster
+        if self.state.name in cluster.fail_shutdown:
+            raise libvirt.libvirtError(f'Cannot shutdown {self.state.name}')
+
+        def _stop():
+            self.state.active = False
+            self._emit(libvirt.VIR_DOMAIN_EVENT_STOPPED)
+
+        if cluster.shutdown_duration:
+            threading.Timer(cluster.shutdown_duration, _stop).start()
+        else:
+            _stop()
+
+    def destroy(self):
+        self._rpc('destroy')
+        self.state.active = False
+        self._emit(libvirt.VIR_DOMAIN_EVENT_STOPPED)
+
+    def create(self):
+        self._rpc('create')
+        if self.state.name in self._conn.hv.cluster.fail_start:
+            raise libvirt.libvirtError(f'Cannot start {self.state.name}')
+        if self._conn.hv.cluster.start_duration:
+            time.sleep(self._conn.hv.cluster.start_duration)
+        self.state.active = True
+        self._emit(libvirt.VIR_DOMAIN_EVENT_STARTED)
+
+    def migrate3(self, dconn: FakeConnection, params, flags):
+        self._rpc('migrate3')
+        cluster = self._conn.hv.cluster
+        self.state.migrating = True
+        try:
+            if cluster.migration_duration:
+                time.sleep(cluster.migration_duration)
+        finally:
+            self.state.migrating = False
+        if self.state.name in cluster.fail_migration:
+            raise libvirt.libvirtError(f'Injected migration failure for {self.state.name}')
+        src, dst = self._conn.hv, dconn.hv
+        with dst.lock:
+            new_state = FakeDomainState(
+                self.state.name, self.state.memory, self.state.vcpus,
+                active=self.state.active and not flags & libvirt.VIR_MIGRATE_OFFLINE,
+                dom_uuid=self.state.uuid,
+            )
+            new_state.disks = list(self.state.disks)
+            dst.domains[new_state.name] = new_state
+        with src.lock:
+            if flags & libvirt.VIR_MIGRATE_UNDEFINE_SOURCE:
+                src.domains.pop(self.state.name, None)
+            else:
+                self.state.active = False
+        self._emit_job_completed({
+            'time_elapsed': int(cluster.migration_duration * 1000),
+            'data_processed': self.state.memory if new_state.active else 0,
+        })
+        return FakeDomain(dconn, new_state)
+
+
+class FakePool:
+    def __init__(self, hv: FakeHypervisor, name: str, path: str):
+        self.hv = hv
+        self.name = name
+        self.path = path
+
+
+class FakeVolumeState:
+    def __init__(self, pool: FakePool, name: str, extents: List[Tuple[str, Union[bytes, int]]]):
+        self.pool = pool
+        self.name = name
+        self.extents = extents
+
+    @property
+    def path(self) -> str:
+        return f'{self.pool.path}/{self.name}'
+
+    @property
+    def capacity(self) -> int:
+        return sum(len(v) if kind == 'data' else v for kind, v in self.extents)
+
+    def read(self) -> bytes:
+        """Returns the full contents with holes as zeros"""
+        return b''.join(v if kind == 'data' else bytes(v) for kind, v in self.extents)
+
+
+class FakePoolHandle:
+    def __init__(self, conn: FakeConnection, pool: FakePool):
+        self._conn = conn
+        self.pool = pool
+
+    def name(self):
+        return self.pool.name
+
+    def XMLDesc(self, flags=0):
+        self._conn._rpc('storagePoolGetXMLDesc')
+        return f"<pool type='dir'><name>{self.pool.name}</name><target><path>{self.pool.path}</path></target></pool>"
+
+    def storageVolLookupByName(self, name):
+        self._conn._rpc('storageVolLookupByName')
+        path = f'{self.pool.path}/{name}'
+        if path not in self.pool.hv.volumes:
+            raise libvirt.libvirtError(f"Storage volume not found: no storage vol with matching name '{name}'")
+        return FakeVolume(self._conn, self.pool.hv.volumes[path])
+
+    def createXML(self, xml, flags=0):
+        self._conn._rpc('storageVolCreateXML')
+        root = ET.fromstring(xml)
+        state = FakeVolumeState(self.pool, root.findtext('name'), [('hole', int(root.findtext('capacity')))])
+        self.pool.hv.volumes[state.path] = state
+        return FakeVolume(self._conn, state)
+
+
+class FakeVolume:
+    def __init__(self, conn: FakeConnection, state: FakeVolumeState):
+        self._conn = conn
+        self.state = state
+
+    def name(self):
+        return self.state.name
+
+    def path(self):
+        return self.state.path
+
+    def info(self):
+        self._conn._rpc('storageVolGetInfo')
+        allocation = sum(len(v) for kind, v in self.state.extents if kind == 'data')
+        return [0, self.state.capacity, allocation]
+
+    def XMLDesc(self, flags=0):
+        self._conn._rpc('storageVolGetXMLDesc')
+        return (f"<volume><name>{self.state.name}</name><capacity unit='bytes'>{self.state.capacity}</capacity>"
+                f"<target><path>{self.state.path}</path><format type='qcow2'/></target></volume>")
+
+    def storagePoolLookupByVolume(self):
+        self._conn._rpc('storagePoolLookupByVolume')
+        return FakePoolHandle(self._conn, self.state.pool)
+
+    def download(self, stream, offset, length, flags=0):
+        self._conn._rpc('storageVolDownload')
+        stream.extents = list(self.state.extents)
+
+    def upload(self, stream, offset, length, flags=0):
+        self._conn._rpc('storageVolUpload')
+        stream.target = self.state
+        stream.extents = []
+
+    def delete(self, flags=0):
+        self._conn._rpc('storageVolDelete')
+        self.state.pool.hv.volumes.pop(self.state.path, None)
+
+
+class FakeStream:
+    """Sparse stream, reads from or writes to a list of extents"""
+
+    def __init__(self, conn: FakeConnection):
+        self._conn = conn
+        self.extents: List[Tuple[str, Union[bytes, int]]] = []
+        self.target: Optional[FakeVolumeState] = None
+
+    def recvFlags(self, nbytes, flags=0):
+        if not self.extents:
+            return b''
+        kind, value = self.extents[0]
+        if kind == 'hole':
+            return -3
+        self._conn._rpc('streamRecv')
+        data, rest = value[:nbytes], value[nbytes:]
+        if rest:
+            self.extents[0] = ('data', rest)
+        else:
+            self.extents.pop(0)
+        return data
+
+    def recvHole(self, flags=0):
+        _, length = self.extents.pop(0)
+        return length
+
+    def _check_upload(self):
+        if self.target is not None and self.target.path in self._conn.hv.cluster.fail_upload:
+            raise libvirt.libvirtError(f'Cannot write to {self.target.path}')
+
+    def send(self, data):
+        self._conn._rpc('streamSend')
+        self._check_upload()
+        self.extents.append(('data', bytes(data)))
+        return len(data)
+
+    def sendHole(self, length, flags=0):
+        self._check_upload()
+        self.extents.append(('hole', length))
+
+    def finish(self):
+        if self.target is not None:
+            self.target.extents = self.extents
+
+    def abort(self):
+        self.extents = []
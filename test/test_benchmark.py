@@ -0,0 +1,182 @@
+import argparse
+
+import libvirt
+import pytest
+
+from libvirt_mgr import migrate
+from libvirt_mgr.utils import ConnectionPool
+from libvirt_mgr.utils.config import Config, HostConfig
+from libvirt_mgr.utils.domains import list_domains
+
+from .fakevirt import FakeCluster
+
+pytestmark = pytest.mark.benchmark
+
+DOMAIN_COUNTS = [10, 100, 1000]
+PREFLIGHT_METHODS = ('getCapabilities', 'getDomainCapabilities', 'compareCPU', 'listNetworks', 'listDefinedNetworks',
+                     'listStoragePools', 'listDefinedStoragePools', 'storagePoolGetXMLDesc', 'getFreeMemory')
+
+
+def make_cluster(hosts: int, domains: int, **kwargs):
+    cluster = FakeCluster(**kwargs)
+    host_configs = {}
+    for i in range(hosts):
+        name = f'host{i:02d}'
+        uri = f'fake:///{name}'
+        cluster.add_hypervisor(uri)
+        host_configs[name] = HostConfig(name=name, uri=uri)
+    src = cluster.hypervisors['fake:///host00']
+    for i in range(domains):
+        src.add_domain(f'vm{i:04d}', memory=64 * 1024 ** 2)
+    return cluster, Config(groups={}, hosts=host_configs)
+
+
+def make_args(**kwargs):
+    args = {
+        'src_host': 'host00',
+        'name': None,
+        'all': True,
+        'dst_host': 'host01',
+        'dst_group': None,
+        'no_stop': False,
+        'no_start': False,
+        'parallel': 1,
+        'progress_interval': 0,
+        'metrics_file': None,
+        'state': None,
+    }
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+@pytest.mark.parametrize('domains', DOMAIN_COUNTS)
+def test_benchmark_launch_migrate(bench, domains):
+    cluster, config = make_cluster(hosts=2, domains=domains)
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = bench(lambda: migrate.launch_migrate(make_args(), config, pool), lambda: cluster.rpc_count)
+    assert len(results) == domains
+    assert all(r.status == migrate.STATUS_MIGRATED for r in results)
+    assert len(cluster.hypervisors['fake:///host01'].domains) == domains
+    # Enumeration must not depend on the number of domains
+    assert cluster.rpc_calls['listAllDomains'] <= 2
+    assert cluster.rpc_calls['isActive'] == 0
+    # Preflight checks cost a few calls per host, domain definitions are not needed between identical hosts
+    preflight_rpcs = sum(cluster.rpc_calls[m] for m in PREFLIGHT_METHODS)
+    assert cluster.rpc_calls['XMLDesc'] == 0
+    assert preflight_rpcs <= 8 * len(cluster.hypervisors)
+    assert cluster.rpc_count - preflight_rpcs <= 2 * domains + 10
+
+
+@pytest.mark.parametrize('domains', DOMAIN_COUNTS)
+def test_benchmark_launch_migrate_group(bench, domains):
+    cluster, config = make_cluster(hosts=4, domains=domains)
+    args = make_args(dst_host=None, dst_group='live', parallel=4)
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = bench(lambda: migrate.launch_migrate(args, config, pool), lambda: cluster.rpc_count)
+    assert all(r.status == migrate.STATUS_MIGRATED for r in results)
+    # Domains are spread across all destinations
+    assert all(len(cluster.hypervisors[f'fake:///host{i:02d}'].domains) > 0 for i in range(1, 4))
+    # Hosts are probed once, not once per domain
+    assert cluster.rpc_calls['getInfo'] == 3
+
+
+@pytest.mark.parametrize('domains', DOMAIN_COUNTS)
+def test_benchmark_migrate_domains(bench, domains):
+    cluster, config = make_cluster(hosts=2, domains=domains)
+    src_host, dst_host = config.hosts['host00'], config.hosts['host01']
+    with ConnectionPool(opener=cluster.open) as pool:
+        src_conn = pool.get(src_host)
+        flags = config.groups['live'].same_group_flags
+        tasks = [
+            migrate.MigrationTask(d, src_host, dst_host, src_conn, pool.get(dst_host), flags, {}, config.groups['live'])
+            for d in list_domains(src_conn)
+        ]
+        rpc_count = cluster.rpc_count
+        results = bench(lambda: migrate.migrate_domains(tasks, parallel=4), lambda: cluster.rpc_count)
+    assert len(results) == domains
+    assert all(r.status == migrate.STATUS_MIGRATED for r in results)
+    assert len(cluster.hypervisors['fake:///host01'].domains) == domains
+    # Orchestration costs a bounded number of calls per domain
+    assert cluster.rpc_count - rpc_count <= 3 * domains
+
+
+@pytest.mark.parametrize('parallel', [1, 8])
+def test_benchmark_migrate_domains_offline(bench, parallel):
+    cluster, config = make_cluster(hosts=2, domains=40, rpc_latency=0.0005, migration_duration=0.01)
+    src_host, dst_host = config.hosts['host00'], config.hosts['host01']
+    with ConnectionPool(opener=cluster.open) as pool:
+        src_conn = pool.get(src_host)
+        domains = list_domains(src_conn)
+        flags = config.groups['live'].different_group_flags
+        tasks = [
+            migrate.MigrationTask(d, src_host, dst_host, src_conn, pool.get(dst_host), flags, {}, config.groups['live'])
+            for d in domains
+        ]
+        results = bench(lambda: migrate.migrate_domains(tasks, parallel=parallel), lambda: cluster.rpc_count)
+    assert all(r.status == migrate.STATUS_MIGRATED for r in results)
+    # Started again on the destination
+    assert all(d.active for d in cluster.hypervisors['fake:///host01'].domains.values())
+
+
+@pytest.mark.parametrize('lookahead', [0, 1, 4])
+def test_benchmark_migrate_domains_pipeline(bench, lookahead):
+    """Slow guest shutdowns and starts overlap with transfers of other domains"""
+    cluster, config = make_cluster(hosts=2, domains=8, migration_duration=0.02, shutdown_duration=0.05,
+                                   start_duration=0.05)
+    src_host, dst_host = config.hosts['host00'], config.hosts['host01']
+    with ConnectionPool(opener=cluster.open) as pool:
+        src_conn = pool.get(src_host)
+        flags = config.groups['live'].different_group_flags
+        tasks = [
+            migrate.MigrationTask(d, src_host, dst_host, src_conn, pool.get(dst_host), flags, {}, config.groups['live'])
+            for d in list_domains(src_conn)
+        ]
+        results = bench(lambda: migrate.migrate_domains(tasks, lookahead=lookahead), lambda: cluster.rpc_count)
+    assert all(r.status == migrate.STATUS_MIGRATED for r in results)
+    assert all(d.active for d in cluster.hypervisors['fake:///host01'].domains.values())
+
+
+def test_benchmark_migrate_domains_failures(bench):
+    cluster, config = make_cluster(hosts=2, domains=10)
+    cluster.fail_migration.update({'vm0003', 'vm0007'})
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = bench(lambda: migrate.launch_migrate(make_args(parallel=4), config, pool), lambda: cluster.rpc_count)
+    failed = sorted(r.name for r in results if r.status == migrate.STATUS_FAILED)
+    assert failed == ['vm0003', 'vm0007']
+    assert set(cluster.hypervisors['fake:///host00'].domains) == {'vm0003', 'vm0007'}
+
+
+@pytest.mark.parametrize('domains', [10, 100])
+def test_benchmark_test_driver_enumeration(bench, domains):
+    """Compares bulk enumeration with per-ID lookups on libvirt's test driver"""
+    try:
+        conn = libvirt.open('test:///default')
+    except libvirt.libvirtError as e:
+        pytest.skip(f'libvirt test driver not available: {e}')
+    try:
+        for i in range(domains):
+            dom = conn.defineXML(
+                f"<domain type='test'><name>bench{i:04d}</name><memory>65536</memory><vcpu>1</vcpu>"
+                f"<os><type>hvm</type></os></domain>"
+            )
+            dom.create()
+        calls = {'count': 0}
+
+        def per_id():
+            ret = []
+            for dom_id in conn.listDomainsID():
+                dom = conn.lookupByID(dom_id)
+                ret.append((dom.name(), dom.isActive()))
+            calls['count'] += 1 + 2 * len(ret)
+            return ret
+
+        def bulk():
+            ret = list_domains(conn, libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+            calls['count'] += 1
+            return ret
+
+        expected = bench(per_id, lambda: calls['count'], name=f'{domains}-per-id')
+        actual = bench(bulk, lambda: calls['count'], name=f'{domains}-bulk')
+        assert sorted(d.name for d in actual) == sorted(name for name, _ in expected)
+    finally:
+        conn.close()
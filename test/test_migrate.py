@@ -1,10 +1,20 @@
 import argparse
+import json
+import threading
+import time
 
 import libvirt
 import pytest
 
 from libvirt_mgr import migrate
-from libvirt_mgr.utils.config import Config, HostConfig
+from libvirt_mgr.utils import ConnectionPool, probe, profile
+from libvirt_mgr.utils.config import Config, GroupConfig, HostConfig
+from libvirt_mgr.utils.domains import DomainRecord, list_domains
+from libvirt_mgr.utils.inventory import open_inventory
+from libvirt_mgr.utils.journal import PHASE_FAILED, open_journal
+from libvirt_mgr.utils.preflight import preflight_tasks
+
+from .fakevirt import FakeCluster, FakeConnection, FakeDomain
 
 
 def test_launch_migrate():
@@ -52,6 +62,17 @@ def test_launch_migrate():
         migrate.launch_migrate(args, config)
     assert str(e.value) == 'Source and destination host cannot be the same'
 
+    args = argparse.Namespace(
+        src_host='host01',
+        name=None,
+        all=False,
+        dst_host=None,
+        dst_group='idontexist',
+    )
+    with pytest.raises(Exception) as e:
+        migrate.launch_migrate(args, config)
+    assert str(e.value) == 'Destination group "idontexist" not found in configuration'
+
     # Assert failure to connect
     args = argparse.Namespace(
         src_host='host01',
@@ -61,4 +82,612 @@ def test_launch_migrate():
         dst_group=None,
     )
     with pytest.raises(libvirt.libvirtError) as e:
-        migrate.launch_migrate(args, config)
+        migrate.launch_migrate(args, config, ConnectionPool(opener=FakeCluster().open))
+
+
+def test_migration_limits():
+    config = Config(
+        groups={"limited": GroupConfig(name="limited", max_outgoing=2, max_incoming=1)},
+        hosts={
+            "host01": HostConfig(name="host01", group="limited"),
+            "host02": HostConfig(name="host02", group="limited"),
+            "host03": HostConfig(name="host03", group="limited"),
+        },
+    )
+    limits = migrate.MigrationLimits(config)
+    lock = threading.Lock()
+    active = {"host02": 0, "host03": 0, "max": 0}
+
+    def worker(dst: str):
+        with limits.acquire(config.hosts["host01"], config.hosts[dst]):
+            with lock:
+                active[dst] += 1
+                active["max"] = max(active["max"], active["host02"] + active["host03"])
+                assert active[dst] <= 1
+            time.sleep(0.05)
+            with lock:
+                active[dst] -= 1
+
+    threads = [threading.Thread(target=worker, args=(dst,)) for dst in ("host02", "host03") * 3]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert active["max"] == 2
+
+
+def test_get_host_from_group():
+    gib = 1024 ** 3
+    config = Config(
+        groups={},
+        hosts={
+            "host01": HostConfig(name="host01"),
+            "host02": HostConfig(name="host02"),
+            "host03": HostConfig(name="host03"),
+        },
+    )
+    probe._default_cache.clear()
+    probe._default_cache.set(probe.HostStats("host01", cpus=16, memory_total=64 * gib, memory_free=60 * gib,
+                                             cpu_usage=0.1, domains=1))
+    probe._default_cache.set(probe.HostStats("host02", cpus=16, memory_total=64 * gib, memory_free=40 * gib,
+                                             cpu_usage=0.1, domains=4))
+    probe._default_cache.set(probe.HostStats("host03", cpus=16, memory_total=64 * gib, memory_free=8 * gib,
+                                             cpu_usage=0.9, domains=10))
+    assert migrate.get_host_from_group(config, 'live', ['host01'], memory=4 * gib).name == 'host02'
+    # Selected host's stats are updated, host01 is picked until it is more loaded than host02
+    for _ in range(6):
+        assert migrate.get_host_from_group(config, 'live', memory=4 * gib).name == 'host01'
+    assert migrate.get_host_from_group(config, 'live', memory=4 * gib).name == 'host02'
+
+    with pytest.raises(Exception) as e:
+        migrate.get_host_from_group(config, 'live', memory=100 * gib)
+    assert str(e.value) == 'No reachable host in group "live" can fit the domain'
+
+    with pytest.raises(Exception) as e:
+        migrate.get_host_from_group(config, 'idontexist')
+    assert str(e.value) == 'Group "idontexist" not found in configuration'
+    probe._default_cache.clear()
+
+
+def test_migrate_locates_source_host():
+    cluster = FakeCluster()
+    config = Config(groups={}, hosts={})
+    for name in ("host01", "host02", "host03"):
+        cluster.add_hypervisor(f"fake:///{name}")
+        config.hosts[name] = HostConfig(name=name, uri=f"fake:///{name}")
+    cluster.hypervisors["fake:///host02"].add_domain("vm01")
+    cluster.hypervisors["fake:///host03"].add_domain("vm01", active=False)
+    args = argparse.Namespace(
+        src_host=None,
+        name='vm01',
+        all=False,
+        dst_host='host01',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+    )
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+        assert args.src_host == 'host02'
+        assert [(r.src_host, r.status) for r in results] == [('host02', migrate.STATUS_MIGRATED)]
+
+        # Migration was recorded, the next lookup does not scan all hosts
+        list_calls = cluster.rpc_calls['listAllDomains']
+        with open_inventory() as inventory:
+            assert migrate.locate_domain(config, 'vm01', pool, inventory).name == 'host01'
+        assert cluster.rpc_calls['listAllDomains'] == list_calls
+
+        args.src_host = None
+        args.name = 'idontexist'
+        with pytest.raises(Exception) as e:
+            migrate.launch_migrate(args, config, pool)
+        assert str(e.value) == 'Domain "idontexist" not found on any host'
+
+
+def test_migrate_copies_disks():
+    cluster = FakeCluster()
+    config = Config(
+        groups={
+            "local": GroupConfig(name="local", same_group_flags=["persist_dest", "offline"], copy_disks=True),
+            "remote": GroupConfig(name="remote"),
+        },
+        hosts={
+            "host01": HostConfig(name="host01", group="local", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", group="remote", uri="fake:///host02"),
+            "host03": HostConfig(name="host03", group="local", uri="fake:///host03"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    shared = cluster.add_hypervisor("fake:///host03")
+    for hv in (src, dst, shared):
+        hv.add_pool("default", "/var/lib/libvirt/images")
+    vol = src.add_volume("default", "vm01.qcow2", [("data", b"data"), ("hole", 4096)])
+    src.add_domain("vm01", disks=[vol.path])
+    src.add_domain("vm02", disks=[vol.path])
+    args = argparse.Namespace(
+        src_host='host01',
+        name='vm01',
+        all=False,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+    )
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+    assert [r.status for r in results] == [migrate.STATUS_MIGRATED]
+    assert dst.volumes[vol.path].read() == vol.read()
+    assert dst.domains["vm01"].active
+
+    # Hosts of the same group share storage
+    args.name = 'vm02'
+    args.dst_host = 'host03'
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+    assert [r.status for r in results] == [migrate.STATUS_MIGRATED]
+    assert not shared.volumes
+    assert shared.domains["vm02"].active
+
+
+def test_migrate_switches_to_postcopy(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(migrate, "OBSERVER_POLL_INTERVAL", 0.01)
+    cluster = FakeCluster(migration_duration=0.3)
+    config = Config(
+        groups={"live": GroupConfig(name="live", same_group_flags=["live"], postcopy={"max_iterations": 3})},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    cluster.add_hypervisor("fake:///host02")
+    for name in ("vm01", "vm02"):
+        state = src.add_domain(name)
+        state.job_stats = [{'type': 2, 'memory_iteration': i, 'memory_bps': 1024 ** 3} for i in range(1, 4)]
+    cluster.fail_migration.add("vm02")
+    args = argparse.Namespace(
+        src_host='host01',
+        name=None,
+        all=True,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+    )
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+    results = {r.name: r for r in results}
+    assert results["vm01"].status == migrate.STATUS_MIGRATED
+    assert results["vm02"].status == migrate.STATUS_FAILED
+    assert results["vm02"].error.startswith('failed during post-copy, manual recovery required')
+    assert cluster.rpc_calls['migrateStartPostCopy'] == 2
+    # Source must not be restarted once memory is split between hosts
+    assert cluster.rpc_calls['create'] == 0
+
+
+def test_migrate_adaptive_shares_link(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(migrate, "OBSERVER_POLL_INTERVAL", 0.01)
+    cluster = FakeCluster(migration_duration=0.3)
+    config = Config(
+        groups={"live": GroupConfig(name="live", same_group_flags=["live"], adaptive={"link_bandwidth": 1000})},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    cluster.add_hypervisor("fake:///host02")
+    states = [src.add_domain(name) for name in ("vm01", "vm02")]
+    for state in states:
+        state.job_stats = [{'type': 2, 'memory_iteration': 1, 'data_remaining': 1024 ** 3, 'memory_bps': 1024 ** 3}]
+    args = argparse.Namespace(
+        src_host='host01',
+        name=None,
+        all=True,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+        parallel=2,
+    )
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+    assert [r.status for r in results] == [migrate.STATUS_MIGRATED] * 2
+    assert [(s.max_downtime, s.max_speed) for s in states] == [(300, 500)] * 2
+
+
+def test_migrate_pipelines_offline_batches():
+    cluster = FakeCluster(migration_duration=0.1, shutdown_duration=0.2, start_duration=0.2)
+    config = Config(
+        groups={"live": GroupConfig(name="live", same_group_flags=["persist_dest", "undefine_source", "offline"])},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    for i in range(4):
+        src.add_domain(f"vm{i:02d}")
+    args = argparse.Namespace(
+        src_host='host01',
+        name=None,
+        all=True,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+        lookahead=2,
+    )
+    start = time.monotonic()
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+    # 2s if every shutdown, migration and start ran one after the other
+    assert time.monotonic() - start < 1.5
+    assert [r.status for r in results] == [migrate.STATUS_MIGRATED] * 4
+    assert all(d.active for d in dst.domains.values())
+    assert not src.domains
+
+
+def test_migrate_start_failure_keeps_move():
+    cluster = FakeCluster()
+    config = Config(
+        groups={"live": GroupConfig(name="live", same_group_flags=["persist_dest", "undefine_source", "offline"])},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    for i in range(2):
+        src.add_domain(f"vm{i:02d}")
+    cluster.fail_start.add("vm01")
+    args = argparse.Namespace(src_host='host01', name=None, all=True, dst_host='host02', dst_group=None,
+                              no_stop=False, no_start=False, progress_interval=0)
+    with ConnectionPool(opener=cluster.open) as pool:
+        with open_inventory() as inventory:
+            inventory.replace_host("host01", list_domains(pool.get(config.hosts["host01"])))
+        results = migrate.launch_migrate(args, config, pool)
+    assert [(r.name, r.status, r.start_error) for r in results] == [
+        ("vm00", migrate.STATUS_MIGRATED, None), ("vm01", migrate.STATUS_MIGRATED, "Cannot start vm01"),
+    ]
+    assert not dst.domains["vm01"].active
+    with open_inventory() as inventory:
+        assert [(e.name, e.host) for e in inventory.all()] == [("vm00", "host02"), ("vm01", "host02")]
+    with open_journal() as journal:
+        assert journal.entries[dst.domains["vm01"].uuid].phase == PHASE_FAILED
+
+
+
+def test_migrate_reports_skipped(tmp_path):
+    cluster = FakeCluster()
+    config = Config(
+        groups={},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    cluster.add_hypervisor("fake:///host02")
+    src.add_domain("vm00", active=False)
+    metrics_file = tmp_path / "metrics.jsonl"
+    args = argparse.Namespace(src_host='host01', name='vm00', all=False, dst_host='host02', dst_group=None,
+                              no_stop=False, no_start=False, progress_interval=0, metrics_file=str(metrics_file))
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+    assert [(r.status, r.error) for r in results] == [(migrate.STATUS_SKIPPED, 'offline, cannot live migrate')]
+    records = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+    assert [(r['domain'], r['status']) for r in records if r['event'] == 'result'] == [("vm00", migrate.STATUS_SKIPPED)]
+
+
+@pytest.mark.parametrize("lookahead", [0, 2])
+def test_migrate_shutdown_failure(lookahead):
+    cluster = FakeCluster()
+    config = Config(
+        groups={"live": GroupConfig(name="live", same_group_flags=["persist_dest", "undefine_source", "offline"])},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    for i in range(3):
+        src.add_domain(f"vm{i:02d}")
+    cluster.fail_shutdown.add("vm01")
+    args = argparse.Namespace(src_host='host01', name=None, all=True, dst_host='host02', dst_group=None,
+                              no_stop=False, no_start=False, progress_interval=0, lookahead=lookahead)
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = migrate.launch_migrate(args, config, pool)
+    # One domain refusing to shutdown does not abort the others
+    assert [(r.name, r.status, r.error) for r in results] == [
+        ("vm00", migrate.STATUS_MIGRATED, None),
+        ("vm01", migrate.STATUS_FAILED, "cannot shutdown: Cannot shutdown vm01"),
+        ("vm02", migrate.STATUS_MIGRATED, None),
+    ]
+    assert sorted(dst.domains) == ["vm00", "vm02"]
+    assert src.domains["vm01"].active
+    with open_journal() as journal:
+        assert journal.entries[src.domains["vm01"].uuid].phase == PHASE_FAILED
+
+
+def test_migrate_failure_restarts_only_stopped():
+    cluster = FakeCluster()
+    config = Config(groups={}, hosts={n: HostConfig(name=n, uri=f"fake:///{n}") for n in ("host01", "host02")})
+    src = cluster.add_hypervisor("fake:///host01")
+    cluster.add_hypervisor("fake:///host02")
+    src.add_domain("vm00")
+    src.add_domain("vm01", active=False)
+    cluster.fail_migration.update({"vm00", "vm01"})
+    group = config.groups["live"]
+    with ConnectionPool(opener=cluster.open) as pool:
+        src_conn, dst_conn = pool.get(config.hosts["host01"]), pool.get(config.hosts["host02"])
+        tasks = [
+            migrate.MigrationTask(d, config.hosts["host01"], config.hosts["host02"], src_conn, dst_conn,
+                                  group.different_group_flags, {}, group)
+            for d in list_domains(src_conn)
+        ]
+        results = [migrate.migrate_domain(t) for t in tasks]
+    assert [r.status for r in results] == [migrate.STATUS_FAILED, migrate.STATUS_FAILED]
+    # Shutdown for the migration and started again, the shut off domain stays off
+    assert src.domains["vm00"].active
+    assert not src.domains["vm01"].active
+    assert cluster.rpc_calls["create"] == 1
+
+def test_offline_pipeline_restarts_unmigrated():
+    cluster = FakeCluster()
+    config = Config(groups={}, hosts={"host01": HostConfig(name="host01", uri="fake:///host01")})
+    src = cluster.add_hypervisor("fake:///host01")
+    for i in range(3):
+        src.add_domain(f"vm{i:02d}")
+    group = config.groups["live"]
+    with ConnectionPool(opener=cluster.open) as pool:
+        conn = pool.get(config.hosts["host01"])
+        flags = group.different_group_flags
+        tasks = [
+            migrate.MigrationTask(d, config.hosts["host01"], config.hosts["host01"], conn, conn, flags, {}, group)
+            for d in list_domains(conn)
+        ]
+        pipeline = migrate.OfflinePipeline(tasks, lookahead=1)
+        pipeline.begin(tasks[0])
+        assert pipeline.stop(tasks[0])
+        pipeline.close()
+    # Shutdown ahead of time for the second task, started again since the batch ended before it
+    assert cluster.rpc_calls['shutdown'] == 2
+    assert [d.active for d in src.domains.values()] == [False, True, True]
+
+
+def test_migrate_profiles_rpcs(tmp_path):
+    cluster = FakeCluster()
+    config = Config(
+        groups={"offline": GroupConfig(name="offline", same_group_flags=["persist_dest", "undefine_source", "offline"])},
+        hosts={
+            "host01": HostConfig(name="host01", group="offline", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", group="offline", uri="fake:///host02"),
+        },
+    )
+    cluster.add_hypervisor("fake:///host01").add_domain("vm01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    args = argparse.Namespace(
+        src_host='host01',
+        name='vm01',
+        all=False,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+    )
+    profiler = profile.enable_profiling(profile.RpcProfiler(wrap_types=(FakeConnection, FakeDomain)))
+    try:
+        with ConnectionPool(opener=cluster.open) as pool:
+            results = migrate.launch_migrate(args, config, pool)
+    finally:
+        profile.disable_profiling()
+    assert [r.status for r in results] == [migrate.STATUS_MIGRATED]
+    assert dst.domains["vm01"].active
+
+    counts = {key: stats.count for key, stats in profiler.stats.items()}
+    assert counts[('host01', 'open')] == 1
+    assert counts[('host02', 'open')] == 1
+    assert counts[('host01', 'getAllDomainStats')] == 1
+    assert counts[('host01', 'shutdown_domain')] == 1
+    assert counts[('host01', 'migrate3')] == 1
+    # Domain returned by the migration is profiled on the destination
+    assert counts[('host02', 'create')] == 1
+    assert all(stats.errors == 0 for stats in profiler.stats.values())
+    assert 'migrate3' in profiler.format_table()
+
+    path = tmp_path / 'libvirt_mgr.prom'
+    profiler.dump('prometheus', str(path))
+    text = path.read_text()
+    assert 'libvirt_mgr_rpc_duration_seconds_count{host="host01",method="migrate3"} 1' in text
+    assert 'libvirt_mgr_rpc_duration_seconds_bucket{host="host02",method="open",le="+Inf"} 1' in text
+    assert not list(tmp_path.glob('.profile-*'))
+
+
+def test_migrate_selects_domains():
+    cluster = FakeCluster()
+    config = Config(
+        groups={},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    for i in range(6):
+        src.add_domain(f"vm{i:02d}", vcpus=i + 1)
+    src.add_domain("other")
+    args = argparse.Namespace(
+        src_host=None,
+        name='vm0[0-3],other',
+        all=False,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+        min_vcpus=2,
+    )
+    with ConnectionPool(opener=cluster.open) as pool:
+        # Patterns are not looked up in the inventory, localhost is the default source
+        with pytest.raises(Exception) as e:
+            migrate.launch_migrate(args, config, pool)
+        assert str(e.value) == 'Source host "localhost" not found in configuration'
+
+        args.src_host = 'host01'
+        results = migrate.launch_migrate(args, config, pool)
+        assert sorted(r.name for r in results) == ["vm01", "vm02", "vm03"]
+        assert sorted(dst.domains) == ["vm01", "vm02", "vm03"]
+
+        # Exact names are located in the inventory, all of them have to be found
+        args.src_host = None
+        args.name = 'vm04,vm05'
+        args.min_vcpus = None
+        results = migrate.launch_migrate(args, config, pool)
+        assert sorted((r.src_host, r.name) for r in results) == [("host01", "vm04"), ("host01", "vm05")]
+
+        args.src_host = 'host01'
+        args.name = 'vm00,idontexist'
+        with pytest.raises(SystemExit):
+            migrate.launch_migrate(args, config, pool)
+        assert "vm00" in src.domains
+
+
+def test_migrate_orders_by_estimate(capsys):
+    cluster = FakeCluster()
+    config = Config(
+        groups={},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    src.add_domain("big", memory=64 * 1024 ** 3)
+    src.add_domain("busy", memory=4 * 1024 ** 3).dirty_rate = 512
+    src.add_domain("small", memory=2 * 1024 ** 3)
+    args = argparse.Namespace(
+        src_host='host01',
+        name=None,
+        all=True,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+        plan=True,
+    )
+    with ConnectionPool(opener=cluster.open) as pool:
+        # The plan measures dirty rates and does not migrate anything
+        assert migrate.launch_migrate(args, config, pool) == []
+        assert not dst.domains
+        assert cluster.rpc_calls['startDirtyRateCalc'] == 3
+        lines = capsys.readouterr().out.splitlines()
+        assert [line.split()[1] for line in lines[1:4]] == ["small", "busy", "big"]
+        assert lines[2].split()[6:8] == ["512.0", "MiB/s"]
+        assert lines[-1].startswith('Predicted total ')
+
+        # Without measurements the busy domain looks short
+        args.plan = False
+        args.order = 'longest'
+        results = migrate.launch_migrate(args, config, pool)
+        assert [r.name for r in results] == ["big", "busy", "small"]
+        assert cluster.rpc_calls['startDirtyRateCalc'] == 3
+
+
+
+def test_preflight_credits_leaving_domains():
+    cluster = FakeCluster()
+    hosts = {n: HostConfig(name=n, uri=f"fake:///{n}") for n in ("host01", "host02")}
+    config = Config(hosts=hosts, groups={})
+    cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02", memory=8 * 1024 ** 3)
+    dst.add_domain("vm-out", memory=4 * 1024 ** 3)
+    conns = {n: cluster.open(f"fake:///{n}") for n in hosts}
+
+    def _task(name, memory, src, dst):
+        domain = DomainRecord(None, active=True, name=name, uuid=name)
+        domain.memory = memory
+        return migrate.MigrationTask(
+            domain, hosts[src], hosts[dst], conns[src], conns[dst], libvirt.VIR_MIGRATE_LIVE, {}, config.groups["live"],
+        )
+
+    vm_in = _task("vm-in", 6 * 1024 ** 3, "host01", "host02")
+    assert preflight_tasks([vm_in]) == [['needs 6.0 GiB of memory, 4.0 GiB left on "host02"']]
+    # Swapping with a domain leaving the destination fits
+    assert preflight_tasks([vm_in, _task("vm-out", 4 * 1024 ** 3, "host02", "host01")]) == [[], []]
+
+
+def test_migrate_preflight():
+    cluster = FakeCluster()
+    config = Config(
+        groups={"offline": GroupConfig(name="offline")},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+            "host03": HostConfig(name="host03", group="offline", uri="fake:///host03"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    src.networks["internal"] = True
+    dst = cluster.add_hypervisor("fake:///host02", memory=8 * 1024 ** 3)
+    dst.cpu_model, dst.cpu_models = "Haswell", ["Haswell"]
+    offline = cluster.add_hypervisor("fake:///host03")
+    src.add_domain("vm-ok")
+    src.add_domain("vm-net").networks = ["default", "internal"]
+    src.add_domain("vm-cpu").cpu_mode = "host-passthrough"
+    vm_model = src.add_domain("vm-model")
+    vm_model.cpu_mode, vm_model.cpu_model = "custom", "Broadwell"
+    src.add_domain("vm-big", memory=16 * 1024 ** 3)
+    args = argparse.Namespace(
+        src_host='host01',
+        name=None,
+        all=True,
+        dst_host='host02',
+        dst_group=None,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+        parallel=4,
+    )
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = {r.name: r for r in migrate.launch_migrate(args, config, pool)}
+        assert results["vm-ok"].status == migrate.STATUS_MIGRATED
+        assert {n: r.error for n, r in results.items() if r.status == migrate.STATUS_FAILED} == {
+            "vm-net": 'preflight: network "internal" is not active on "host02"',
+            "vm-cpu": 'preflight: CPU of "host02" lacks features of "host01" required by host-passthrough',
+            "vm-model": 'preflight: CPU model "Broadwell" is not usable on "host02"',
+            "vm-big": 'preflight: needs 16.0 GiB of memory, 7.0 GiB left on "host02"',
+        }
+        # Nothing was touched and capabilities were fetched once per host
+        assert cluster.rpc_calls['migrate3'] == 1
+        assert all(d.active for d in src.domains.values())
+        assert cluster.rpc_calls['getCapabilities'] == 2
+        assert cluster.rpc_calls['compareCPU'] == 1
+
+        # Running domains are not shutdown for offline migrations which cannot succeed
+        args.name, args.all, args.dst_host = 'vm-net,vm-cpu', False, 'host03'
+        results = {r.name: r for r in migrate.launch_migrate(args, config, pool)}
+        assert results["vm-net"].error == 'preflight: network "internal" is not active on "host03"'
+        assert results["vm-cpu"].status == migrate.STATUS_MIGRATED
+        assert src.domains["vm-net"].active
+        assert cluster.rpc_calls['shutdown'] == 1
+        assert cluster.rpc_calls['getCapabilities'] == 3
+        assert offline.domains["vm-cpu"].active
+
+        args.no_preflight = True
+        args.name = 'vm-net'
+        results = migrate.launch_migrate(args, config, pool)
+        assert results[0].status == migrate.STATUS_MIGRATED
@@ -0,0 +1,117 @@
+import argparse
+
+import pytest
+
+from libvirt_mgr import rebalance
+from libvirt_mgr.placement import (DomainFootprint, HostCapacity, PlacementError, apply_moves, format_plan,
+                                   plan_evacuation, plan_rebalance)
+from libvirt_mgr.utils.config import Config, HostConfig
+
+GIB = 1024 ** 3
+
+
+def test_plan_evacuation():
+    hosts = [
+        HostCapacity("host01", memory_total=64 * GIB, memory_used=32 * GIB, cpus=16),
+        HostCapacity("host02", memory_total=64 * GIB, memory_used=8 * GIB, cpus=16),
+        HostCapacity("host03", memory_total=128 * GIB, memory_used=64 * GIB, cpus=32),
+    ]
+    domains = [
+        DomainFootprint("vm01", 16 * GIB, 4),
+        DomainFootprint("vm02", 16 * GIB, 4),
+        DomainFootprint("vm03", 8 * GIB, 2),
+        DomainFootprint("vm04", 4 * GIB, 1),
+    ]
+    actual = plan_evacuation(domains, hosts)
+    assert actual == {
+        "vm01": "host02",
+        "vm02": "host03",
+        "vm03": "host02",
+        "vm04": "host01",
+    }
+    # Hosts are not modified
+    assert hosts[1].memory_used == 8 * GIB
+
+    planned = apply_moves(hosts, [(d, "host00", actual[d.name]) for d in domains])
+    assert max(h.utilization for h in planned.values()) == 0.625
+    assert planned["host01"].memory_used == 36 * GIB
+    assert planned["host02"].vcpus_used == 6
+
+
+def test_plan_evacuation_does_not_fit():
+    hosts = [HostCapacity("host01", memory_total=64 * GIB, memory_used=48 * GIB)]
+    with pytest.raises(PlacementError) as e:
+        plan_evacuation([DomainFootprint("vm01", 16 * GIB)], hosts, max_utilization=0.9)
+    assert str(e.value) == 'Domain "vm01" does not fit on any host'
+    assert plan_evacuation([DomainFootprint("vm01", 16 * GIB)], hosts) == {"vm01": "host01"}
+
+
+def test_format_plan():
+    hosts = [
+        HostCapacity("host01", memory_total=64 * GIB, memory_used=32 * GIB),
+        HostCapacity("host02", memory_total=64 * GIB, memory_used=0),
+    ]
+    moves = [(DomainFootprint("vm01", 16 * GIB, 4), "host01", "host02")]
+    actual = format_plan(moves, hosts, apply_moves(hosts, moves))
+    assert actual == '\n'.join([
+        'Domain migrations:',
+        '  vm01    host01 -> host02  (16.0 GiB, 4 vCPUs)',
+        'Host memory utilization:',
+        '  host01   50.0% ->  25.0%',
+        '  host02    0.0% ->  25.0%',
+    ])
+
+
+def test_plan_rebalance():
+    hosts = [
+        HostCapacity("host01", memory_total=100 * GIB, memory_used=90 * GIB),
+        HostCapacity("host02", memory_total=100 * GIB, memory_used=30 * GIB),
+        HostCapacity("host03", memory_total=100 * GIB, memory_used=30 * GIB),
+    ]
+    domains = {
+        "host01": [DomainFootprint(f"vm{i:02d}", 10 * GIB) for i in range(8)] + [DomainFootprint("big", 20 * GIB)],
+        "host02": [DomainFootprint("vm20", 30 * GIB)],
+        "host03": [DomainFootprint("vm30", 30 * GIB)],
+    }
+    moves = plan_rebalance(hosts, domains, tolerance=0.1)
+    # Largest domain first, then the smaller ones
+    assert [(d.name, src, dst) for d, src, dst in moves] == [
+        ("big", "host01", "host02"),
+        ("vm07", "host01", "host03"),
+        ("vm00", "host01", "host03"),
+    ]
+    planned = apply_moves(hosts, moves)
+    utilization = [h.utilization for h in planned.values()]
+    assert max(utilization) - min(utilization) <= 0.1
+
+    # Already balanced
+    assert plan_rebalance(list(planned.values()), domains, tolerance=0.1) == []
+    # Limited number of moves
+    assert len(plan_rebalance(hosts, domains, tolerance=0.1, max_moves=1)) == 1
+    # Destinations cannot take anything
+    assert plan_rebalance(hosts, domains, tolerance=0.1, max_utilization=0.35) == []
+
+
+
+def test_launch_rebalance_max_moves():
+    config = Config(groups={}, hosts={"host01": HostConfig(name="host01")})
+    args = argparse.Namespace(group="live", tolerance=0.1, max_moves=0)
+    with pytest.raises(Exception) as e:
+        rebalance.launch_rebalance(args, config)
+    assert str(e.value) == 'Maximum number of migrations must be at least 1'
+
+def test_plan_rebalance_scales():
+    hosts = [HostCapacity(f"host{i:02d}", memory_total=1024 * GIB, memory_used=0) for i in range(20)]
+    domains = {h.name: [] for h in hosts}
+    # Everything on the first 5 hosts
+    for i in range(2000):
+        host = hosts[i % 5]
+        domain = DomainFootprint(f"vm{i:04d}", (1 + i % 8) * GIB)
+        host.add(domain)
+        domains[host.name].append(domain)
+    moves = plan_rebalance(hosts, domains, tolerance=0.05)
+    planned = apply_moves(hosts, moves)
+    utilization = [h.utilization for h in planned.values()]
+    assert max(utilization) - min(utilization) <= 0.05
+    # Each domain moves at most once
+    assert len({id(d) for d, _, _ in moves}) == len(moves)
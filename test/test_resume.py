@@ -0,0 +1,99 @@
+import argparse
+
+from libvirt_mgr import migrate, resume
+from libvirt_mgr.utils import ConnectionPool
+from libvirt_mgr.utils.config import Config, GroupConfig, HostConfig
+from libvirt_mgr.utils.domains import list_domains
+from libvirt_mgr.utils.journal import (PHASE_FAILED, PHASE_MIGRATED, PHASE_MIGRATING, PHASE_STARTED, PHASE_STOPPED,
+                                       open_journal)
+
+from .fakevirt import FakeCluster
+
+
+def test_resume_offline_batch():
+    cluster = FakeCluster()
+    config = Config(
+        groups={"live": GroupConfig(name="live", same_group_flags=["persist_dest", "undefine_source", "offline"])},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    for i in range(4):
+        src.add_domain(f"vm{i:02d}")
+    args = argparse.Namespace(parallel=1, progress_interval=0, command='resume')
+
+    with ConnectionPool(opener=cluster.open) as pool:
+        src_conn, dst_conn = pool.get(config.hosts["host01"]), pool.get(config.hosts["host02"])
+        tasks = migrate.build_tasks(
+            config, pool, config.hosts["host01"], [(d, config.hosts["host02"]) for d in list_domains(src_conn)],
+        )
+        by_name = {t.domain.name: t for t in tasks}
+        # Interrupted after migrating vm00 and vm01, starting vm01 and shutting down vm02, vm03 was not touched
+        with open_journal() as journal:
+            journal.begin([migrate.journal_entry(t) for t in tasks], True, True, 'migrate')
+            for name in ("vm00", "vm01", "vm02"):
+                by_name[name].domain.dom.shutdown()
+                journal.record(by_name[name].domain.uuid, PHASE_STOPPED)
+            for name in ("vm00", "vm01"):
+                by_name[name].domain.dom.migrate3(dst_conn, {}, by_name[name].flags)
+                journal.record(by_name[name].domain.uuid, PHASE_MIGRATED)
+            dst_conn.lookupByName("vm01").create()
+            journal.record(by_name["vm01"].domain.uuid, PHASE_STARTED)
+
+        results = resume.launch_resume(args, config, pool)
+        assert sorted((r.name, r.status) for r in results) == [
+            ("vm00", migrate.STATUS_MIGRATED), ("vm02", migrate.STATUS_MIGRATED), ("vm03", migrate.STATUS_MIGRATED),
+        ]
+        assert not src.domains
+        assert all(d.active for d in dst.domains.values())
+        # vm01 was not migrated or started again
+        assert cluster.rpc_calls['migrate3'] == 4
+        assert cluster.rpc_calls['shutdown'] == 4
+        with open_journal() as journal:
+            assert not journal.unfinished()
+        assert resume.launch_resume(args, config, pool) == []
+
+
+def test_resume_failed_entries():
+    cluster = FakeCluster()
+    config = Config(
+        groups={"live": GroupConfig(name="live", same_group_flags=["persist_dest", "undefine_source", "offline"])},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    for i in range(2):
+        src.add_domain(f"vm{i:02d}")
+    args = argparse.Namespace(parallel=1, progress_interval=0, command='resume')
+
+    with ConnectionPool(opener=cluster.open) as pool:
+        src_conn, dst_conn = pool.get(config.hosts["host01"]), pool.get(config.hosts["host02"])
+        tasks = migrate.build_tasks(
+            config, pool, config.hosts["host01"], [(d, config.hosts["host02"]) for d in list_domains(src_conn)],
+        )
+        by_name = {t.domain.name: t for t in tasks}
+        # Every entry is final: vm00 failed to migrate and vm01 failed to start, both were left stopped
+        with open_journal() as journal:
+            journal.begin([migrate.journal_entry(t) for t in tasks], True, True, 'migrate')
+            for name in ("vm00", "vm01"):
+                by_name[name].domain.dom.shutdown()
+                journal.record(by_name[name].domain.uuid, PHASE_STOPPED)
+                journal.record(by_name[name].domain.uuid, PHASE_MIGRATING)
+            journal.record(by_name["vm00"].domain.uuid, PHASE_FAILED, 'migration failed')
+            by_name["vm01"].domain.dom.migrate3(dst_conn, {}, by_name["vm01"].flags)
+            journal.record(by_name["vm01"].domain.uuid, PHASE_FAILED, 'cannot start on destination')
+            assert not journal.unfinished()
+
+        results = resume.launch_resume(args, config, pool)
+        assert [(r.name, r.status) for r in results] == [("vm01", migrate.STATUS_MIGRATED)]
+        assert src.domains["vm00"].active
+        assert dst.domains["vm01"].active
+        assert cluster.rpc_calls['migrate3'] == 1
+        with open_journal() as journal:
+            assert journal.entries[by_name["vm01"].domain.uuid].phase == PHASE_STARTED
@@ -0,0 +1,105 @@
+import argparse
+
+import pytest
+
+from libvirt_mgr import migrate, rolling
+from libvirt_mgr.placement import HostCapacity, PlacementError
+from libvirt_mgr.utils import ConnectionPool
+from libvirt_mgr.utils.config import Config, GroupConfig, HostConfig
+from libvirt_mgr.utils.domains import DomainRecord
+
+from .fakevirt import FakeCluster
+
+
+def rolling_args(**kwargs) -> argparse.Namespace:
+    args = argparse.Namespace(
+        group='compute',
+        max_hosts_down=1,
+        hook='true',
+        hook_timeout=10,
+        reconnect_delay=0,
+        reconnect_timeout=10,
+        move_back=False,
+        max_utilization=0.9,
+        dry_run=False,
+        parallel=4,
+        no_stop=False,
+        no_start=False,
+        progress_interval=0,
+        command='rolling',
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def make_cluster(hosts: int = 3):
+    cluster = FakeCluster()
+    config = Config(groups={"compute": GroupConfig(name="compute")}, hosts={})
+    for i in range(1, hosts + 1):
+        name = f"host{i:02d}"
+        hv = cluster.add_hypervisor(f"fake:///{name}", memory=16 * 1024 ** 3)
+        config.hosts[name] = HostConfig(name=name, group="compute", uri=f"fake:///{name}")
+        for j in range(2):
+            hv.add_domain(f"{name}-vm{j}", memory=2 * 1024 ** 3)
+    return cluster, config
+
+
+def test_rolling_drains_each_host(tmp_path):
+    cluster, config = make_cluster()
+    log = tmp_path / 'hook.log'
+    hook = f'echo $VIRTMGR_HOST >> {log}'
+    args = rolling_args(hook=hook, move_back=True)
+
+    with ConnectionPool(opener=cluster.open) as pool:
+        results = rolling.launch_rolling(args, config, pool)
+    assert log.read_text().split() == ["host01", "host02", "host03"]
+    assert all(r.status == migrate.STATUS_MIGRATED for r in results)
+    # 6 domains drained and moved back
+    assert len(results) == 12
+    for uri, hv in cluster.hypervisors.items():
+        assert sorted(hv.domains) == sorted(f"{uri[8:]}-vm{j}" for j in range(2))
+
+
+def test_rolling_stops_on_failure(tmp_path):
+    cluster, config = make_cluster()
+    log = tmp_path / 'hook.log'
+    args = rolling_args(hook=f'echo $VIRTMGR_HOST >> {log}; test $VIRTMGR_HOST != host02', max_hosts_down=2)
+    with ConnectionPool(opener=cluster.open) as pool:
+        with pytest.raises(Exception) as e:
+            rolling.launch_rolling(args, config, pool)
+    assert str(e.value) == 'Rolling maintenance of group "compute" stopped after wave 1, check host02'
+    assert sorted(log.read_text().split()) == ["host01", "host02"]
+    # Drained hosts are left empty, everything runs on the remaining host
+    assert len(cluster.hypervisors["fake:///host03"].domains) == 6
+
+    args = rolling_args(max_hosts_down=3)
+    with pytest.raises(Exception) as e:
+        rolling.launch_rolling(args, config)
+    assert str(e.value) == 'Group "compute" has 3 hosts, at least one has to stay up'
+
+
+def test_plan_waves():
+    hosts = [HostConfig(name=f"host{i}", uri=f"fake:///host{i}") for i in range(5)]
+    assert [[h.name for h in w] for w in rolling.plan_waves(hosts, 2)] == [
+        ["host0", "host1"], ["host2", "host3"], ["host4"],
+    ]
+
+
+def test_plan_drain_moves():
+    gib = 1024 ** 3
+    domains = []
+    for name, memory in (("vm01", 6), ("vm02", 4), ("vm03", 2)):
+        domain = DomainRecord(None, active=True, name=name, uuid=name)
+        domain.memory, domain.vcpus = memory * gib, 1
+        domains.append(domain)
+    serviced = [HostCapacity("host01", 16 * gib, 6 * gib, 8)]
+    pending = [HostCapacity("host03", 16 * gib, 0, 8)]
+    # The empty pending host is only used for what does not fit on the serviced one
+    moves = rolling.plan_drain_moves(domains, serviced, pending, max_utilization=0.9)
+    assert [(d.name, c.name) for d, c in moves] == [("vm01", "host01"), ("vm02", "host03"), ("vm03", "host01")]
+    assert serviced[0].memory_used == 6 * gib
+
+    assert [c.name for _, c in rolling.plan_drain_moves(domains, [], pending)] == ["host03"] * 3
+    with pytest.raises(PlacementError):
+        rolling.plan_drain_moves(domains, serviced, [], max_utilization=0.9)
@@ -0,0 +1,149 @@
+import argparse
+import os
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from libvirt_mgr import migrate, serve
+from libvirt_mgr.utils import ConnectionPool
+from libvirt_mgr.utils.config import Config, HostConfig
+
+from .fakevirt import FakeCluster
+
+
+def wait_until(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_server_caches_domains(tmp_path, capsys):
+    cluster = FakeCluster()
+    config = Config(
+        groups={},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+            "host03": HostConfig(name="host03", uri="fake:///host03"),
+        },
+    )
+    src = cluster.add_hypervisor("fake:///host01")
+    dst = cluster.add_hypervisor("fake:///host02")
+    cluster.fail_connect.add("fake:///host03")
+    src.add_domain("vm01")
+    src.add_domain("vm02", active=False)
+    socket_path = str(tmp_path / 'virtmgr.sock')
+
+    with ConnectionPool(opener=cluster.open) as pool:
+        server = serve.Server(config, pool)
+        server.start('127.0.0.1:0', socket_path)
+        try:
+            assert [(s.host, s.name, s.state) for s in server.cache.statuses()] == [
+                ('host01', 'vm01', 'running'), ('host01', 'vm02', 'shutoff'),
+            ]
+            assert server.cache.unreachable() == ['host03']
+
+            # Scrapes are answered from the cache
+            rpc_count = cluster.rpc_count
+            port = server._servers[0].server_address[1]
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as resp:
+                text = resp.read().decode()
+            assert cluster.rpc_count == rpc_count
+            assert 'libvirt_mgr_host_up{host="host01"} 1' in text
+            assert 'libvirt_mgr_host_up{host="host03"} 0' in text
+            assert f'libvirt_mgr_domain_active{{host="host01",domain="vm01",uuid="{src.domains["vm01"].uuid}"}} 1' in text
+            assert text.count('# TYPE libvirt_mgr_domain_active gauge') == 1
+
+            # Lifecycle events refresh a single domain, unexpected errors do not stop event handling
+            server._queue.put(('host01', object(), None, {}))
+            dom = pool.get(config.hosts["host01"]).lookupByName("vm01")
+            dom.destroy()
+            wait_until(lambda: server.cache.statuses(["host01"])[0].state == 'shutoff')
+            dom.create()
+            wait_until(lambda: server.cache.statuses(["host01"])[0].state == 'running')
+
+            assert os.stat(socket_path).st_mode & 0o777 == 0o660
+            reply = serve.request_server(socket_path, {'command': 'list', 'args': {'group': None, 'host': ['host01']}})
+            assert [d['name'] for d in reply['domains']] == ['vm01', 'vm02']
+
+            # Clients cannot choose files the server writes
+            request = {'command': 'migrate', 'args': {'name': 'vm01', 'journal': str(tmp_path / 'journal')}}
+            with pytest.raises(Exception) as e:
+                serve.request_server(socket_path, request)
+            assert str(e.value) == 'Server error: Command "migrate" does not accept journal'
+
+            # Migrations run on the server's connections
+            args = argparse.Namespace(
+                command='migrate',
+                server=socket_path,
+                func=None,
+                src_host='host01',
+                name='vm01',
+                all=False,
+                dst_host='host02',
+                dst_group=None,
+                no_stop=False,
+                no_start=False,
+                progress_interval=0,
+            )
+            opens = cluster.rpc_calls['open']
+            results = serve.launch_remote(args, config)
+            assert [(r.name, r.status) for r in results] == [('vm01', migrate.STATUS_MIGRATED)]
+            assert cluster.rpc_calls['open'] == opens
+            assert dst.domains["vm01"].active
+            wait_until(lambda: dst.domains["vm01"].uuid in server.cache.jobs)
+
+            args.name = 'idontexist'
+            with pytest.raises(Exception) as e:
+                serve.launch_remote(args, config)
+            assert str(e.value) == 'Server error: Command exited with status 1, see the server log'
+
+            args.command = 'evacuate'
+            with pytest.raises(Exception) as e:
+                serve.launch_remote(args, config)
+            assert str(e.value) == 'Command "evacuate" cannot be run by a server'
+        finally:
+            server.close()
+    assert not (tmp_path / 'virtmgr.sock').exists()
+    assert not cluster.hypervisors["fake:///host01"].callbacks
+
+
+def test_server_skips_hung_hosts(monkeypatch):
+    cluster = FakeCluster()
+    config = Config(
+        groups={},
+        hosts={
+            "host01": HostConfig(name="host01", uri="fake:///host01"),
+            "host02": HostConfig(name="host02", uri="fake:///host02"),
+        },
+    )
+    cluster.add_hypervisor("fake:///host01").add_domain("vm01")
+    cluster.add_hypervisor("fake:///host02")
+    hang = threading.Event()
+    sweeps = []
+    get_host_status = serve.get_host_status
+
+    def _get_host_status(conn, name):
+        sweeps.append(name)
+        if name == 'host02':
+            hang.wait()
+        return get_host_status(conn, name)
+
+    monkeypatch.setattr(serve, 'get_host_status', _get_host_status)
+    with ConnectionPool(opener=cluster.open) as pool:
+        server = serve.Server(config, pool, timeout=0.1)
+        try:
+            assert server.sweep() == ['host02']
+            assert server.sweep() == ['host02']
+            # The hung sweep is not repeated, so threads do not pile up
+            assert sweeps.count('host01') == 2
+            assert sweeps.count('host02') == 1
+            hang.set()
+            wait_until(lambda: not server._sweeping)
+            assert server.sweep() == []
+        finally:
+            hang.set()
+            server.close()
@@ -0,0 +1,77 @@
+import argparse
+import json
+
+import libvirt
+import pytest
+
+from libvirt_mgr import status
+from libvirt_mgr.utils import ConnectionPool
+from libvirt_mgr.utils.config import Config, GroupConfig, HostConfig
+from libvirt_mgr.utils.inventory import open_inventory
+
+from .fakevirt import FakeCluster
+
+
+def test_domain_status_from_stats():
+    stats = {
+        'state.state': libvirt.VIR_DOMAIN_PAUSED,
+        'vcpu.current': 2,
+        'vcpu.maximum': 4,
+        'balloon.maximum': 4 * 1024 ** 2,
+        'balloon.current': 2 * 1024 ** 2,
+        'block.count': 2,
+        'block.0.rd.bytes': 100,
+        'block.0.wr.bytes': 10,
+        'block.0.capacity': 1000,
+        'block.0.allocation': 500,
+        'block.1.rd.bytes': 1,
+        'block.1.capacity': 2000,
+    }
+
+    class Dom:
+        def name(self):
+            return 'vm01'
+
+        def UUIDString(self):
+            return 'uuid01'
+
+    actual = status.DomainStatus.from_stats('host01', Dom(), stats)
+    assert actual.state == 'paused'
+    assert actual.active
+    assert actual.vcpus == 2
+    assert actual.memory == 4 * 1024 ** 3
+    assert actual.balloon == 2 * 1024 ** 3
+    assert (actual.block_read, actual.block_write) == (101, 10)
+    assert (actual.disk_capacity, actual.disk_allocation) == (3000, 500)
+
+
+def test_launch_list(capsys):
+    cluster = FakeCluster()
+    config = Config(groups={"other": GroupConfig(name="other")}, hosts={})
+    for name, group in (("host01", "live"), ("host02", "live"), ("host03", "other"), ("down", "live")):
+        config.hosts[name] = HostConfig(name=name, group=group, uri=f"fake:///{name}")
+        if name != "down":
+            cluster.add_hypervisor(f"fake:///{name}")
+    cluster.hypervisors["fake:///host01"].add_domain("vm02")
+    cluster.hypervisors["fake:///host01"].add_domain("vm01", active=False)
+    cluster.hypervisors["fake:///host03"].add_domain("vm03")
+    args = argparse.Namespace(group='live', host=None, json=True, timeout=5)
+    with ConnectionPool(opener=cluster.open) as pool:
+        statuses, unreachable = status.launch_list(args, config, pool)
+    assert [(s.host, s.name, s.state) for s in statuses] == [
+        ("host01", "vm01", "shutoff"), ("host01", "vm02", "running"),
+    ]
+    assert unreachable == ["down"]
+    # One bulk call per host, no per-domain RPCs
+    assert cluster.rpc_calls['getAllDomainStats'] == 2
+    assert cluster.rpc_calls['listAllDomains'] == 0
+    output = json.loads(capsys.readouterr().out)
+    assert [d['name'] for d in output['domains']] == ["vm01", "vm02"]
+    assert output['unreachable'] == ["down"]
+    with open_inventory() as inventory:
+        assert inventory.find("vm02")[0].host == "host01"
+
+    args = argparse.Namespace(group=None, host=['idontexist'], json=False, timeout=5)
+    with pytest.raises(Exception) as e:
+        status.launch_list(args, config)
+    assert str(e.value) == 'Host "idontexist" not found in configuration'
@@ -1,10 +1,31 @@
+import json
+import os
 import pathlib
+import subprocess
+import sys
+import threading
+import time
 
 import libvirt
 import pytest
 
-from libvirt_mgr.utils.config import Config, HostConfig, DEFAULT_SAME_GROUP_FLAGS, DEFAULT_DIFFERENT_GROUP_FLAGS
-from libvirt_mgr.utils.libvirt import get_migrate_flags
+from libvirt_mgr import migrate
+from libvirt_mgr.utils import estimate, probe, storage
+from libvirt_mgr.utils.adaptive import AdaptiveController, LinkBudget
+from libvirt_mgr.utils.cache import TTLCache
+from libvirt_mgr.utils.config import (Config, ConfigCache, HostConfig, DEFAULT_SAME_GROUP_FLAGS,
+                                      DEFAULT_DIFFERENT_GROUP_FLAGS, get_config_cache_version)
+from libvirt_mgr.utils.connection import ConnectionPool
+from libvirt_mgr.utils.domains import DomainRecord, get_domain_resources, list_domains
+from libvirt_mgr.utils.inventory import Inventory, InventoryWatcher, open_inventory, refresh_inventory
+from libvirt_mgr.utils.journal import (PHASE_FAILED, PHASE_MIGRATED, PHASE_STARTED, PHASE_STOPPED, Journal,
+                                       JournalEntry)
+from libvirt_mgr.utils.libvirt import get_list_flags, get_migrate_flags, get_migrate_params
+from libvirt_mgr.utils.monitor import ProgressReporter, format_size, summarize_job_stats
+from libvirt_mgr.utils.postcopy import PostCopySwitch
+from libvirt_mgr.utils.selector import METADATA_NAMESPACE, DomainMetadataCache, DomainSelector, parse_tags
+
+from .fakevirt import FakeCluster
 
 
 def test_missing_hosts():
@@ -124,8 +145,8 @@ def test_groups_config():
     actual = Config.from_dict(data)
     assert len(actual.groups) == 1
     assert 'live' in actual.groups
-    assert actual.groups['live'].same_group_flags == DEFAULT_SAME_GROUP_FLAGS
-    assert actual.groups['live'].different_group_flags == DEFAULT_DIFFERENT_GROUP_FLAGS
+    assert actual.groups['live'].same_group_flags == get_migrate_flags(DEFAULT_SAME_GROUP_FLAGS)
+    assert actual.groups['live'].different_group_flags == get_migrate_flags(DEFAULT_DIFFERENT_GROUP_FLAGS)
 
     # Check that we can add a group
     data = {
@@ -154,7 +175,7 @@ def test_groups_config():
     assert 'live' in actual.groups
     assert 'offline' in actual.groups
     assert actual.groups['live'].same_group_flags == libvirt.VIR_MIGRATE_LIVE
-    assert actual.groups['live'].different_group_flags == DEFAULT_DIFFERENT_GROUP_FLAGS
+    assert actual.groups['live'].different_group_flags == get_migrate_flags(DEFAULT_DIFFERENT_GROUP_FLAGS)
 
 
 def test_host_groups():
@@ -242,3 +263,685 @@ uri = "test+tcp://localhost:5000/default"
     assert actual.hosts["host04"].uri == 'qemu+ssh://libvirt@10.0.10.4:2200/notsys?command=/opt/openssh/bin/ssh&no_verify=1&no_tty=0'
     assert "host05" in actual.hosts
     assert actual.hosts["host05"].uri == 'test+tcp://localhost:5000/default'
+
+
+def test_config_cache(tmp_path: pathlib.Path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    p = tmp_path / "config.toml"
+    p.write_text('[hosts.host01]\n')
+    actual = Config.from_file(str(p), cache_dir=str(cache_dir))
+    assert list(cache_dir.iterdir())
+    assert ConfigCache(str(cache_dir)).load(str(p)).hosts["host01"] == actual.hosts["host01"]
+
+    # Cache hits do not parse the file
+    monkeypatch.setattr(Config, "from_dict", lambda data: pytest.fail("config was parsed"))
+    cached = Config.from_file(str(p), cache_dir=str(cache_dir))
+    assert cached.hosts["host01"].uri == actual.hosts["host01"].uri
+    assert cached.groups["live"].same_group_flags == actual.groups["live"].same_group_flags
+    monkeypatch.undo()
+
+    # Changing the file invalidates the cache
+    p.write_text('[hosts.host01]\n[hosts.host02]\n')
+    os.utime(str(p), ns=(0, 0))
+    assert ConfigCache(str(cache_dir)).load(str(p)) is None
+    assert "host02" in Config.from_file(str(p), cache_dir=str(cache_dir)).hosts
+
+    # So does upgrading the package
+    monkeypatch.setattr("libvirt_mgr.utils.config.__version__", "999")
+    get_config_cache_version.cache_clear()
+    try:
+        assert ConfigCache(str(cache_dir)).load(str(p)) is None
+    finally:
+        monkeypatch.undo()
+        get_config_cache_version.cache_clear()
+
+    # And changing how configs are parsed
+    monkeypatch.setattr("libvirt_mgr.utils.config.inspect.getsource", lambda module: "changed")
+    get_config_cache_version.cache_clear()
+    try:
+        assert ConfigCache(str(cache_dir)).load(str(p)) is None
+    finally:
+        monkeypatch.undo()
+        get_config_cache_version.cache_clear()
+
+
+def test_cli_does_not_import_libvirt():
+    code = "import sys, libvirt_mgr.virtmgr; assert 'libvirt' not in sys.modules, 'libvirt was imported'"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_groups_concurrency_limits():
+    data = {
+        "hosts": {"host01": {}},
+        "groups": {
+            "live": {
+                "max_outgoing": 4,
+                "max_incoming": 0,
+            },
+        },
+    }
+    actual = Config.from_dict(data)
+    assert actual.groups['live'].max_outgoing == 4
+    assert actual.groups['live'].max_incoming is None
+
+    data['groups']['live']['max_outgoing'] = -1
+    with pytest.raises(Exception) as e:
+        Config.from_dict(data)
+    assert str(e.value) == 'Group "live" max_outgoing must be a positive integer'
+
+
+def test_groups_shutdown_timeout():
+    data = {
+        "hosts": {"host01": {}},
+        "groups": {
+            "live": {},
+            "offline": {
+                "shutdown_timeout": 0,
+                "shutdown_timeout_action": "destroy",
+            },
+        },
+    }
+    actual = Config.from_dict(data)
+    assert actual.groups['live'].shutdown_timeout == 300
+    assert actual.groups['live'].shutdown_timeout_action == 'abort'
+    assert actual.groups['offline'].shutdown_timeout is None
+    assert actual.groups['offline'].shutdown_timeout_action == 'destroy'
+
+    data['groups']['offline']['shutdown_timeout_action'] = 'reboot'
+    with pytest.raises(Exception) as e:
+        Config.from_dict(data)
+    assert str(e.value) == 'Group "offline" shutdown_timeout_action must be one of abort, destroy'
+
+
+def test_connection_pool(monkeypatch: pytest.MonkeyPatch):
+    class FakeConnection:
+        def __init__(self, uri):
+            self.uri = uri
+            self.alive = True
+            self.keepalive = None
+
+        def isAlive(self):
+            return self.alive
+
+        def setKeepAlive(self, interval, count):
+            self.keepalive = (interval, count)
+
+        def close(self):
+            self.alive = False
+
+    opened = []
+
+    def fake_open(uri):
+        conn = FakeConnection(uri)
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(libvirt, 'open', fake_open)
+    host01 = HostConfig(name="host01")
+    host02 = HostConfig(name="host02")
+    with ConnectionPool(keepalive_interval=10, keepalive_count=2) as pool:
+        conn = pool.get(host01)
+        assert conn.keepalive == (10, 2)
+        assert pool.get(host01) is conn
+        assert len(opened) == 1
+        # Dead connections are replaced
+        conn.alive = False
+        assert pool.get(host01) is not conn
+        pool.get(host02)
+        assert len(opened) == 3
+    assert not any(c.alive for c in opened)
+
+
+def test_read_list_flags():
+    assert get_list_flags(['active']) == libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE
+    assert get_list_flags(['active', 'persistent']) == (libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE |
+                                                        libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT)
+    with pytest.raises(Exception) as e:
+        get_list_flags(['notastate'])
+    assert str(e.value) == 'No domain state "NOTASTATE" exists'
+
+
+def test_list_domains():
+    class FakeDomain:
+        def __init__(self, name):
+            self._name = name
+
+        def name(self):
+            return self._name
+
+        def UUIDString(self):
+            return f'uuid-{self._name}'
+
+    class FakeConnection:
+        def __init__(self):
+            self.calls = []
+
+        def listAllDomains(self, flags):
+            self.calls.append(flags)
+            if flags & libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE:
+                return [FakeDomain('vm01'), FakeDomain('vm02')]
+            return [FakeDomain('vm03')]
+
+    conn = FakeConnection()
+    actual = list_domains(conn)
+    assert [(d.name, d.uuid, d.active) for d in actual] == [
+        ('vm01', 'uuid-vm01', True),
+        ('vm02', 'uuid-vm02', True),
+        ('vm03', 'uuid-vm03', False),
+    ]
+    assert len(conn.calls) == 2
+
+    conn = FakeConnection()
+    flags = libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE | libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT
+    actual = list_domains(conn, flags)
+    assert [d.name for d in actual] == ['vm01', 'vm02']
+    assert conn.calls == [flags]
+
+
+def test_read_migrate_params():
+    params, flags = get_migrate_params({
+        "bandwidth": 1000,
+        "parallel_connections": 4,
+        "compression": "zstd",
+    })
+    assert params == {
+        libvirt.VIR_MIGRATE_PARAM_BANDWIDTH: 1000,
+        libvirt.VIR_MIGRATE_PARAM_PARALLEL_CONNECTIONS: 4,
+        libvirt.VIR_MIGRATE_PARAM_COMPRESSION: ["zstd"],
+    }
+    assert flags == libvirt.VIR_MIGRATE_PARALLEL | libvirt.VIR_MIGRATE_COMPRESSED
+
+    with pytest.raises(Exception) as e:
+        get_migrate_params({"notaparam": 1})
+    assert str(e.value) == 'No migration parameter "NOTAPARAM" exists'
+
+    with pytest.raises(Exception) as e:
+        get_migrate_params({"bandwidth": "fast"})
+    assert str(e.value) == 'Migration parameter "bandwidth" must be a non-negative integer'
+
+    with pytest.raises(Exception) as e:
+        get_migrate_params({"compression": ["zstd", 1]})
+    assert str(e.value) == 'Migration parameter "compression" must be a list of strings'
+
+
+def test_groups_migrate_params():
+    data = {
+        "hosts": {"host01": {}},
+        "groups": {
+            "live": {
+                "same_group_flags": ["live"],
+                "same_group_params": {
+                    "auto_converge_increment": 10,
+                },
+            },
+        },
+    }
+    actual = Config.from_dict(data)
+    assert actual.groups['live'].same_group_flags == libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_AUTO_CONVERGE
+    assert actual.groups['live'].same_group_params == {libvirt.VIR_MIGRATE_PARAM_AUTO_CONVERGE_INCREMENT: 10}
+    assert actual.groups['live'].different_group_flags == get_migrate_flags(DEFAULT_DIFFERENT_GROUP_FLAGS)
+    assert actual.groups['live'].different_group_params == {}
+
+
+def test_groups_postcopy():
+    data = {
+        "hosts": {"host01": {}},
+        "groups": {
+            "live": {
+                "same_group_flags": ["live", "peer2peer"],
+                "postcopy": {"max_time": 60, "dirty_ratio": 0},
+            },
+        },
+    }
+    actual = Config.from_dict(data)
+    group = actual.groups['live']
+    assert group.same_group_flags == libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_PEER2PEER | libvirt.VIR_MIGRATE_POSTCOPY
+    assert group.different_group_flags == get_migrate_flags(DEFAULT_DIFFERENT_GROUP_FLAGS)
+    assert (group.postcopy.max_iterations, group.postcopy.max_time, group.postcopy.dirty_ratio) == (5, 60, None)
+    assert Config.from_dict({"hosts": {"host01": {}}}).groups['live'].postcopy is None
+
+    data['groups']['live']['same_group_flags'] = list(DEFAULT_SAME_GROUP_FLAGS)
+    with pytest.raises(Exception) as e:
+        Config.from_dict(data)
+    assert str(e.value) == 'Group "live" postcopy cannot be used with tunnelled same_group_flags'
+
+
+def test_postcopy_switch():
+    class Dom:
+        switches = 0
+        fail = True
+
+        def migrateStartPostCopy(self, flags):
+            if self.fail:
+                self.fail = False
+                raise libvirt.libvirtError('not ready')
+            self.switches += 1
+
+    def stats(iteration, elapsed=1000, dirty_rate=0):
+        return {'type': 2, 'time_elapsed': elapsed, 'memory_iteration': iteration, 'memory_bps': 1000 * 4096,
+                'memory_dirty_rate': dirty_rate, 'memory_page_size': 4096}
+
+    policy = Config.from_dict({"hosts": {"host01": {}}, "groups": {"live": {
+        "same_group_flags": ["live"], "postcopy": {"max_iterations": 10, "max_time": 30, "dirty_ratio": 0.9},
+    }}}).groups['live'].postcopy
+    switch = PostCopySwitch(policy, 'vm01')
+    # Dirty rate is not known during the first pass
+    assert switch.check(summarize_job_stats(stats(1, dirty_rate=2000))) is None
+    assert switch.check(summarize_job_stats(stats(3, dirty_rate=800))) is None
+    assert switch.check(summarize_job_stats(stats(3, dirty_rate=950))).startswith('memory is dirtied')
+    assert switch.check(summarize_job_stats(stats(10))) == 'iteration 10 reached the limit of 10'
+    assert switch.check(summarize_job_stats(stats(2, elapsed=31000))) == 'pre-copy ran for 31.0s, limit is 30s'
+
+    dom = Dom()
+    switch(dom, stats(2))
+    assert not switch.switched
+    with pytest.raises(libvirt.libvirtError):
+        switch(dom, stats(12))
+    assert not switch.switched
+    assert switch.reason is None
+    # Retried with the next sample
+    switch(dom, stats(13))
+    switch(dom, stats(14))
+    assert switch.switched
+    assert switch.reason == 'iteration 13 reached the limit of 10'
+    assert dom.switches == 1
+
+
+def test_adaptive_controller(tmp_path: pathlib.Path):
+    class Dom:
+        def __init__(self):
+            self.calls = []
+
+        def migrateSetMaxDowntime(self, downtime, flags):
+            self.calls.append(('downtime', downtime))
+
+        def migrateSetMaxSpeed(self, bandwidth, flags):
+            self.calls.append(('bandwidth', bandwidth))
+
+    def stats(iteration, remaining, elapsed=1000, dirty_rate=0):
+        return {'type': 2, 'time_elapsed': elapsed, 'memory_iteration': iteration, 'data_remaining': remaining,
+                'memory_bps': 1024 ** 3, 'memory_dirty_rate': dirty_rate, 'memory_page_size': 4096}
+
+    policy = Config.from_dict({"hosts": {"host01": {}}, "groups": {"live": {"adaptive": {
+        "min_downtime": 100, "max_downtime": 1000, "link_bandwidth": 1000, "target_time": 60,
+    }}}}).groups['live'].adaptive
+    links = LinkBudget()
+    metrics = ProgressReporter(metrics_file=str(tmp_path / "metrics.jsonl"))
+    controller = AdaptiveController(policy, 'vm01', 'host01', links, metrics.metrics)
+    dom = Dom()
+    mib = 1024 ** 2
+    with links.use('host01'), links.use('host01'):
+        # 4 GiB in 40s needs about 103 MiB/s, but it could not be sent within max downtime, the share is used
+        controller(dom, stats(1, 4 * 1024 ** 3, elapsed=20000))
+        assert dom.calls == [('downtime', 100), ('bandwidth', 500)]
+        # Remaining data shrank enough, nothing changes
+        controller(dom, stats(2, 3 * 1024 ** 3, elapsed=30000))
+        assert len(dom.calls) == 2
+        # Not converging, downtime is raised to the expected 2.9s and capped
+        controller(dom, stats(3, 2.9 * 1024 ** 3, elapsed=40000))
+        assert dom.calls[2:] == [('downtime', 1000)]
+        # Close to the end, 200 MiB in 10s needs 20 MiB/s, but has to be sent within the 1s max downtime
+        controller(dom, stats(4, 200 * mib, elapsed=50000))
+        assert dom.calls[-1] == ('bandwidth', 200)
+        # Behind schedule, bandwidth goes up to the link share
+        controller(dom, stats(4, 200 * mib, elapsed=61000))
+        assert dom.calls[-1] == ('bandwidth', 500)
+    # Alone on the link, pacing frees bandwidth nobody would use
+    controller(dom, stats(5, 100 * mib, elapsed=62000))
+    assert dom.calls[-1] == ('bandwidth', 1000)
+    metrics.close()
+    decisions = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert [d['setting'] for d in decisions] == ['max_downtime', 'bandwidth', 'max_downtime'] + ['bandwidth'] * 3
+
+    with pytest.raises(Exception) as e:
+        Config.from_dict({"hosts": {"host01": {}}, "groups": {"live": {"adaptive": {"target_time": 60}}}})
+    assert str(e.value) == 'Group "live" adaptive target_time requires link_bandwidth'
+
+
+def test_summarize_job_stats():
+    stats = {
+        'type': 2,
+        'time_elapsed': 12000,
+        'data_total': 8 * 1024 ** 3,
+        'data_processed': 6 * 1024 ** 3,
+        'data_remaining': 2 * 1024 ** 3,
+        'memory_bps': 1024 ** 3,
+        'memory_dirty_rate': 1000,
+        'memory_page_size': 4096,
+        'memory_iteration': 3,
+    }
+    actual = summarize_job_stats(stats)
+    assert actual['elapsed'] == 12
+    assert actual['dirty_rate'] == 4096000
+    assert actual['expected_downtime'] == 2
+    assert actual['downtime'] is None
+    assert format_size(actual['data_remaining']) == '2.0 GiB'
+    assert format_size(512) == '512.0 B'
+
+
+def test_progress_reporter_metrics(tmp_path: pathlib.Path):
+    metrics_file = tmp_path / "metrics.jsonl"
+    reporter = ProgressReporter(metrics_file=str(metrics_file))
+    reporter.report_result('vm01', 'host01', 'host02', 'migrated', 4.5, {'data_processed': 1024, 'downtime': 50})
+    reporter.report_result('vm02', 'host01', 'host02', 'failed', 1.0)
+    reporter.close()
+    records = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+    assert len(records) == 2
+    assert records[0]['domain'] == 'vm01'
+    assert records[0]['data_processed'] == 1024
+    assert records[0]['downtime'] == 0.05
+    assert records[1]['status'] == 'failed'
+    assert records[1]['downtime'] is None
+
+
+
+def test_monitor_survives_failing_observer():
+    class Dom:
+        def jobStats(self):
+            return {'type': 2, 'memory_iteration': 1}
+
+    def _broken(dom, stats):
+        raise ValueError('broken')
+
+    samples = threading.Semaphore(0)
+    with ProgressReporter(interval=0).monitor(Dom(), 'vm01', [_broken, lambda d, s: samples.release()], 0.01):
+        # Every sample reaches the next observer, the monitor keeps polling
+        for _ in range(3):
+            assert samples.acquire(timeout=5)
+
+def test_get_domain_resources():
+    class FakeDomain:
+        def __init__(self, name):
+            self._name = name
+
+        def name(self):
+            return self._name
+
+        def UUIDString(self):
+            return f'uuid-{self._name}'
+
+        def info(self):
+            return [5, 2048, 2048, 2, 0]
+
+    class FakeConnection:
+        def domainListGetStats(self, doms, stats):
+            return [(d, {'balloon.maximum': 4096, 'vcpu.current': 4}) for d in doms if d.name() == 'vm01']
+
+    records = [DomainRecord(FakeDomain('vm01'), True), DomainRecord(FakeDomain('vm02'), False)]
+    get_domain_resources(FakeConnection(), records)
+    assert (records[0].memory, records[0].vcpus) == (4096 * 1024, 4)
+    # Falls back to info() for domains without stats
+    assert (records[1].memory, records[1].vcpus) == (2048 * 1024, 2)
+
+
+def test_run_on_hosts():
+    hang = threading.Event()
+
+    def _query(host: HostConfig) -> str:
+        if host.name == 'hung':
+            hang.wait()
+        elif host.name == 'broken':
+            raise ValueError('unexpected reply')
+        return host.name.upper()
+
+    hosts = [HostConfig(name=n) for n in ('hung', 'broken', 'ok')]
+    start = time.monotonic()
+    try:
+        assert probe.run_on_hosts(hosts, _query, timeout=0.2) == {'ok': 'OK'}
+        assert time.monotonic() - start < 1
+        # Hung hosts run in daemon threads which do not keep the process alive
+        assert all(t.daemon for t in threading.enumerate() if t.name == 'probe-hung')
+    finally:
+        hang.set()
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl=60)
+    calls = []
+
+    def _load():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'value'
+
+    threads = [threading.Thread(target=cache.load, args=('key', _load)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.get('key') == 'value'
+    assert len(calls) == 1
+    cache.set('old', 'value', timestamp=time.monotonic() - 61)
+    assert cache.get('old') is None
+    cache.pop('key')
+    assert cache.get('key') is None
+
+
+def test_probe_hosts_caches_failures():
+    cluster = FakeCluster()
+    cluster.add_hypervisor('fake:///host01')
+    cluster.fail_connect.add('fake:///host02')
+    hosts = [HostConfig(name='host01', uri='fake:///host01'), HostConfig(name='host02', uri='fake:///host02')]
+    cache = probe.HostStatsCache()
+    with ConnectionPool(opener=cluster.open) as pool:
+        assert list(probe.probe_hosts(hosts, pool, cache=cache)) == ['host01']
+        rpc_count = cluster.rpc_count
+        assert list(probe.probe_hosts(hosts, pool, cache=cache)) == ['host01']
+        assert cluster.rpc_count == rpc_count
+        assert cache.failed('host02')
+
+
+def test_inventory(tmp_path: pathlib.Path, caplog: pytest.LogCaptureFixture):
+    # Falls back to a temporary inventory, loudly since lookups then rescan all hosts
+    (tmp_path / "file").write_text("")
+    with open_inventory(str(tmp_path / "file" / "inventory.sqlite")) as inventory:
+        assert inventory.path == ":memory:"
+    assert "using a temporary one" in caplog.text
+
+
+    cluster = FakeCluster()
+    hosts = []
+    for name in ("host01", "host02"):
+        cluster.add_hypervisor(f"fake:///{name}")
+        hosts.append(HostConfig(name=name, uri=f"fake:///{name}"))
+    cluster.hypervisors["fake:///host01"].add_domain("web01", memory=2 * 1024 ** 3, vcpus=2)
+    cluster.hypervisors["fake:///host02"].add_domain("web02", active=False)
+    cluster.hypervisors["fake:///host02"].add_domain("db01")
+    with ConnectionPool(opener=cluster.open) as pool, Inventory(str(tmp_path / "inventory.sqlite")) as inventory:
+        assert sorted(refresh_inventory(inventory, hosts, pool)) == ["host01", "host02"]
+        assert refresh_inventory(inventory, hosts, pool, max_age=60) == []
+        entry, = inventory.find("web01")
+        assert (entry.host, entry.active, entry.memory, entry.vcpus) == ("host01", True, 2 * 1024 ** 3, 2)
+        assert inventory.find(entry.uuid)[0].name == "web01"
+        assert [(e.name, e.host, e.active) for e in inventory.find("web*")] == [
+            ("web01", "host01", True), ("web02", "host02", False),
+        ]
+
+        inventory.move([("web01", "host01", "host02")])
+        assert inventory.find("web01")[0].host == "host02"
+
+        # Lifecycle events update the inventory incrementally
+        watcher = InventoryWatcher(inventory, pool)
+        watcher.watch(hosts[1])
+        conn = pool.get(hosts[1])
+        conn.lookupByName("web02").create()
+        cluster.hypervisors["fake:///host02"].add_domain("db02")
+        conn.lookupByName("db02").create()
+        conn.lookupByName("db01").destroy()
+        watcher.close()
+        assert inventory.find("web02")[0].active
+        assert not inventory.find("db01")[0].active
+        assert inventory.find("db02")[0].host == "host02"
+
+
+def test_copy_domain_disks():
+    cluster = FakeCluster()
+    src = cluster.add_hypervisor('fake:///src')
+    dst = cluster.add_hypervisor('fake:///dst')
+    for hv in (src, dst):
+        hv.add_pool('default', '/var/lib/libvirt/images')
+    root = src.add_volume('default', 'vm01.qcow2', [('data', b'boot' * 1024), ('hole', 10 * 1024 ** 2), ('data', b'x' * 5)])
+    data = src.add_volume('default', 'vm01-data.qcow2', [('hole', 64 * 1024 ** 2)])
+    src.add_domain('vm01', disks=[root.path, data.path])
+    src_conn, dst_conn = cluster.open('fake:///src'), cluster.open('fake:///dst')
+    dom = src_conn.lookupByName('vm01')
+
+    assert storage.get_domain_disk_paths(dom) == [root.path, data.path]
+    copied = storage.copy_domain_disks(dom, src_conn, dst_conn, progress_interval=0)
+    assert sorted(v.name() for v in copied) == ['vm01-data.qcow2', 'vm01.qcow2']
+    assert dst.volumes[root.path].read() == root.read()
+    # Holes are not sent
+    assert dst.volumes[data.path].capacity == 64 * 1024 ** 2
+    assert all(kind == 'hole' for kind, _ in dst.volumes[data.path].extents)
+
+    # Existing volumes are not overwritten
+    with pytest.raises(Exception) as e:
+        storage.copy_domain_disks(dom, src_conn, dst_conn)
+    assert str(e.value) == 'Volume "vm01.qcow2" already exists in pool "default" on the destination'
+
+    # Nothing is left behind if the second volume fails mid-stream
+    dst.volumes.clear()
+    cluster.fail_upload.add(data.path)
+    cluster.rpc_calls.clear()
+    with pytest.raises(Exception) as e:
+        storage.copy_domain_disks(dom, src_conn, dst_conn, progress_interval=0)
+    assert str(e.value) == f'Cannot write to {data.path}'
+    assert not dst.volumes
+    # The failed volume and the copied root volume
+    assert cluster.rpc_calls['storageVolDelete'] == 2
+
+    # Or if the pool is missing on the destination
+    cluster.fail_upload.clear()
+    del dst.pools['default']
+    with pytest.raises(Exception) as e:
+        storage.copy_domain_disks(dom, src_conn, dst_conn)
+    assert str(e.value) == f'Storage pool "default" of "{root.path}" does not exist on the destination'
+    assert not dst.volumes
+
+
+def test_journal(tmp_path: pathlib.Path):
+    path = tmp_path / "journal.jsonl"
+    entries = [JournalEntry(f"uuid{i}", f"vm{i}", "host01", "host02", active=True, offline=True) for i in range(3)]
+    with Journal(str(path)) as journal:
+        journal.begin(entries, auto_stop=True, auto_start=True, command='migrate')
+        journal.record("uuid0", PHASE_STOPPED)
+        journal.record("uuid0", PHASE_MIGRATED)
+        journal.record("uuid1", PHASE_STARTED)
+        journal.record("uuid2", PHASE_FAILED, "broken")
+    # Killed while writing the last line
+    with open(str(path), 'a') as f:
+        f.write('{"event": "phase", "uu')
+
+    journal = Journal(str(path))
+    assert journal.batch['command'] == 'migrate'
+    assert [(e.name, e.phase) for e in journal.unfinished()] == [("vm0", PHASE_MIGRATED)]
+    assert journal.entries["uuid2"].error == "broken"
+    with pytest.raises(Exception) as e:
+        journal.begin(entries, auto_stop=True, auto_start=True)
+    assert 'has an unfinished batch with 1 domains left' in str(e.value)
+
+    # Appending after the torn line does not lose the record
+    journal.record("uuid0", PHASE_STARTED)
+    journal.close()
+    assert not Journal(str(path)).unfinished()
+
+    # Migrated domains are finished if they are not started afterwards
+    with Journal(str(path)) as journal:
+        journal.begin(entries[:1], auto_stop=True, auto_start=False)
+        journal.record("uuid0", PHASE_MIGRATED)
+    assert not Journal(str(path)).unfinished()
+
+
+def test_domain_selector():
+    cluster = FakeCluster()
+    hv = cluster.add_hypervisor("fake:///host01")
+    hv.add_domain("web01", memory=2 * 1024 ** 3, vcpus=2)
+    hv.add_domain("web02", memory=8 * 1024 ** 3, vcpus=4)
+    hv.add_domain("db01", memory=32 * 1024 ** 3, vcpus=8)
+    hv.add_domain("db02", memory=32 * 1024 ** 3, vcpus=8, active=False)
+    hv.domains["db01"].metadata = (f'<mgr:tags xmlns:mgr="{METADATA_NAMESPACE}"><tag name="env">prod</tag>'
+                                   f'<tag name="drain-first"/></mgr:tags>')
+    hv.domains["web02"].metadata = f'<mgr:tags xmlns:mgr="{METADATA_NAMESPACE}"><mgr:tag name="env">dev</mgr:tag></mgr:tags>'
+    conn = cluster.open("fake:///host01")
+
+    def _select(names=None, **kwargs):
+        selected = DomainSelector.from_string(names, **kwargs).select(conn, cache)
+        return sorted(d.name for d in selected)
+
+    cache = DomainMetadataCache()
+    assert _select() == ["db01", "db02", "web01", "web02"]
+    assert _select("web01, db02") == ["db02", "web01"]
+    assert _select("web*") == ["web01", "web02"]
+    assert _select("re:(web|db)0[2]") == ["db02", "web02"]
+    assert _select("db*", states=["active"]) == ["db01"]
+    assert _select(min_memory=8 * 1024 ** 3, max_vcpus=4) == ["web02"]
+    assert _select(min_vcpus=8) == ["db01", "db02"]
+    assert parse_tags(conn.lookupByName("db01").XMLDesc()) == {"env": "prod", "drain-first": ""}
+
+    # Names, states and resources cost one call, XML is fetched once per remaining domain and cached
+    before = dict(cluster.rpc_calls)
+    assert _select(min_memory=4 * 1024 ** 3, tags=["env"]) == ["db01", "web02"]
+    assert cluster.rpc_calls["getAllDomainStats"] - before["getAllDomainStats"] == 1
+    assert cluster.rpc_calls["XMLDesc"] - before.get("XMLDesc", 0) == 3
+    assert _select(tags=["env=prod"]) == ["db01"]
+    assert _select(tags=["drain-first", "env=dev"]) == []
+    assert cluster.rpc_calls["XMLDesc"] - before.get("XMLDesc", 0) == 4
+
+    selector = DomainSelector.from_string("web01,idontexist,db*", min_vcpus=4)
+    assert not selector.exact
+    assert sorted(d.name for d in selector.select(conn, cache)) == ["db01", "db02"]
+    assert selector.missing() == ["idontexist"]
+    assert DomainSelector.from_string("web01,web02").exact
+    with pytest.raises(Exception) as e:
+        DomainSelector.from_string("re:web(")
+    assert str(e.value).startswith('Invalid regular expression "re:web("')
+
+
+def test_migration_estimator(tmp_path):
+    # 8 GiB over 1 GiB/s dirtying 256 MiB/s, every iteration sends a quarter of the previous one
+    duration, downtime, iterations, converges = estimate.predict_precopy(8 * 1024 ** 3, 256 * 1024 ** 2, 1024 ** 3)
+    assert iterations == 3
+    assert downtime == pytest.approx(0.125)
+    assert duration == pytest.approx(8 + 2 + 0.5 + 0.125)
+    assert converges
+    assert not estimate.predict_precopy(8 * 1024 ** 3, 1024 ** 3, 1024 ** 3)[3]
+
+    src = HostConfig(name="host01", uri="fake:///host01")
+    dst = HostConfig(name="host02", uri="fake:///host02")
+    config = Config(hosts={"host01": src, "host02": dst}, groups={})
+    domain = DomainRecord(None, active=True, name="vm01", uuid="uuid-1")
+    domain.memory = 4 * 1024 ** 3
+    task = migrate.MigrationTask(domain, src, dst, None, None, libvirt.VIR_MIGRATE_LIVE, {}, config.groups["live"])
+    path = str(tmp_path / 'estimates.json')
+    estimator = estimate.MigrationEstimator(config, estimate.EstimateHistory(path))
+    predicted = estimator.estimate(task)
+    assert predicted.bandwidth == estimate.DEFAULT_BANDWIDTH
+    assert predicted.duration == pytest.approx(4)
+
+    # It took twice as long, sending 6 GiB at 768 MiB/s
+    estimator.learn(task, predicted, 8.0, 6 * 1024 ** 3)
+    # Two migrations shared the link, each got half of it
+    other = DomainRecord(None, active=True, name="vm02", uuid="uuid-2")
+    other.memory = 2 * 1024 ** 3
+    shared = migrate.MigrationTask(other, src, dst, None, None, libvirt.VIR_MIGRATE_LIVE, {}, config.groups["live"])
+    estimator.learn(shared, estimator.estimate(shared), 8.0, 3 * 1024 ** 3, concurrent=2)
+    # Limited migrations say nothing about the link, and are still predicted at their limit
+    bandwidth_param = getattr(libvirt, 'VIR_MIGRATE_PARAM_BANDWIDTH', 'bandwidth')
+    limited = migrate.MigrationTask(other, src, dst, None, None, libvirt.VIR_MIGRATE_LIVE, {bandwidth_param: 100},
+                                    config.groups["live"])
+    estimator.learn(limited, estimator.estimate(limited), 40.0, 4000 * 1024 ** 2)
+    assert estimator.get_bandwidth(limited) == 100 * 1024 ** 2
+    estimator.history.save()
+    estimator = estimate.MigrationEstimator(config, estimate.EstimateHistory(path))
+    assert estimator.get_bandwidth(task) == 768 * 1024 ** 2
+    assert estimator.history.get('domains', 'uuid-1', 'dirty_rate') == 256 * 1024 ** 2
+    assert estimator.estimate(task).duration == pytest.approx(2 * estimator.estimate(task).model_duration)
+
+    # Two workers, the second migration waits for an outgoing slot of host01
+    config.groups["live"].max_outgoing = 1
+    estimates = [estimate.Estimate(d, 0, d) for d in (3.0, 1.0)]
+    assert estimate.simulate_schedule(config, [task, task], estimates, parallel=2) == [(0, 3.0), (3.0, 4.0)]
+    config.groups["live"].max_outgoing = None
+    assert estimate.simulate_schedule(config, [task, task], estimates, parallel=2) == [(0, 3.0), (0, 1.0)]
+    ordered, _ = estimate.order_tasks(["a", "b"], estimates, estimate.ORDER_SHORTEST)
+    assert ordered == ["b", "a"]